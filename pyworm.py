@@ -1,16 +1,223 @@
 #!/usr/bin/env python3
 
+import argparse
+import sys
+import time
+
 import wormcurses
+import wormlevel
+import wormrecord
+import wormrender
+import wormshm
+import wormsim
+import wormspectate
 import wormstate
 
-if __name__ == "__main__":
+def play(args):
+    if args.split:
+        play_split(args)
+        return
+
+    # Let spectators watch if asked to
+    publisher = None
+    if args.spectate != None:
+        server = wormspectate.SpectatorServer(args.spectate)
+        server.start()
+        publisher = wormspectate.Publisher(server, args.game_name)
+
+    # Draw with curses unless asked to write ANSI escapes directly
+    renderer = None
+    if args.renderer == "ansi":
+        renderer = wormrender.AnsiRenderer(sys.stdout.fileno())
+
     # Start the curses user interface
     worm_interface = wormcurses.WormCurses()
 
     # Create the game state and pass it to the interface
-    worm_interface.set_state(wormstate.WormState())
+    worm_interface.set_state(wormstate.WormState(), seed=args.seed,
+        record_path=args.record, publisher=publisher, board_size=args.board,
+        renderer=renderer, level=args.level, targets=args.targets)
 
     # Start the game loop
-    worm_interface.run()
+    worm_interface.run(tick_rate=args.tick_rate)
+
+    print("Bye!")
+    if args.stats:
+        stats = worm_interface.render_stats
+        print("Drew %d steps with %d cells, %d header fields and %d screen "
+            "updates" % (stats["ticks"], stats["cells"], stats["fields"],
+            stats["flushes"]))
+        print("Timing: " + worm_interface.timing.report())
+        if worm_interface.profiler != None:
+            print("Profile: " + worm_interface.profiler.summary())
+
+def play_split(args):
+    # The game runs in a process of its own and is drawn from shared memory
+    renderer = None
+    if args.renderer == "ansi":
+        renderer = wormrender.AnsiRenderer(sys.stdout.fileno())
+    screen = wormshm.play(tick_rate=args.tick_rate, seed=args.seed,
+        board_size=args.board, level=args.level, record_path=args.record,
+        renderer=renderer, targets=args.targets)
+
+    if screen.exit_code != None:
+        print("The game stopped by itself with exit code %d" %
+            screen.exit_code)
+    print("Bye!")
+    if args.stats and screen.frame != None:
+        print("Drew %d frames of %d ticks, skipped %d frames and dropped "
+            "%d ticks" % (screen.frames, screen.frame.tick,
+            screen.reader.skipped, screen.frame.dropped))
+
+def board_size(text):
+    """Parses a board size given as WIDTHxHEIGHT"""
+    try:
+        (width, height) = (int(n) for n in text.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected WIDTHxHEIGHT, not %r" %
+            text)
+    if width < 1 or height < 1:
+        raise argparse.ArgumentTypeError("board must be at least 1x1")
+    return (width, height)
+
+def game_seed(text):
+    """Parses a seed for a game, which must fit in a recording"""
+    try:
+        seed = int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected a number, not %r" % text)
+    if not 0 <= seed <= wormrecord.MAX_SEED:
+        raise argparse.ArgumentTypeError("seed must be from 0 to %d" %
+            wormrecord.MAX_SEED)
+    return seed
+
+def target_count(text):
+    """Parses a number of targets, which must be at least 1"""
+    try:
+        count = int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected a number, not %r" % text)
+    if count < 1:
+        raise argparse.ArgumentTypeError("there must be at least 1 target")
+    return count
 
-    print("Bye!")
\ No newline at end of file
+def level(text):
+    """Parses a level given as PACK or PACK:INDEX, returning the level"""
+    (path, colon, index) = text.rpartition(":")
+    if not colon or not index.isdigit():
+        (path, index) = (text, "0")
+    try:
+        return wormlevel.open_pack(path)[int(index)]
+    except (OSError, ValueError, IndexError) as e:
+        raise argparse.ArgumentTypeError("can't load level %r: %s" % (text,
+            e))
+
+def simulate(args):
+    out = sys.stdout
+    if args.output != "-":
+        out = open(args.output, "w")
+    try:
+        wormsim.simulate(args.games, width=args.width, height=args.height,
+            policy_name=args.policy, max_steps=args.max_steps,
+            seed=args.seed, workers=args.workers,
+            chunk_size=args.chunk_size, out=out,
+            profile_path=args.profile, profile_every=args.profile_every,
+            levels_path=args.levels)
+    finally:
+        if out != sys.stdout:
+            out.close()
+
+def replay(args):
+    recording = wormrecord.Recording.load(args.recording)
+    if args.headless:
+        # Run through the whole game as fast as possible and report on it
+        start = time.perf_counter()
+        state = wormrecord.fast_forward(recording)
+        elapsed = time.perf_counter() - start
+        print("seed %d: %d ticks, score %d, length %d%s (%.0f ticks/s)" % (
+            recording.seed, state.ticks, state.score, len(state.worm),
+            ", game over" if state.game_over else "",
+            state.ticks / max(elapsed, 1e-9)))
+        return
+
+    worm_interface = wormcurses.WormCurses()
+    worm_interface.set_state(wormstate.WormState())
+    worm_interface.replay(recording, args.speed)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="The classic worm game")
+    parser.set_defaults(command=play, seed=None, record=None, stats=False,
+        tick_rate=1.0, spectate=None, game_name="", board=None,
+        renderer="curses", level=None, split=False, targets=1)
+    commands = parser.add_subparsers(title="commands")
+
+    game = commands.add_parser("play", help="play the game (default)")
+    game.set_defaults(command=play)
+    game.add_argument("--seed", type=game_seed, default=None,
+        help="seed for the first game (default: current time)")
+    game.add_argument("--record", metavar="FILE", default=None,
+        help="record each game to FILE so it can be replayed")
+    game.add_argument("--spectate", metavar="ADDRESS", default=None,
+        help="stream the game to spectators on unix:/path or host:port")
+    game.add_argument("--game-name", default="",
+        help="name spectators use to pick this game")
+    game.add_argument("--tick-rate", type=float, default=1.0,
+        help="steps the worm takes per second (default: 1)")
+    game.add_argument("--board", metavar="WIDTHxHEIGHT", type=board_size,
+        default=None, help="play on a board of this size, scrolling if it "
+        "is bigger than the screen (default: fit the screen)")
+    game.add_argument("--level", metavar="PACK[:INDEX]", type=level,
+        default=None, help="play on a level from a level pack built with "
+        "wormlevel.py (default: an empty board)")
+    game.add_argument("--targets", type=target_count, default=1,
+        help="number of targets on the board at once (default: 1)")
+    game.add_argument("--renderer", choices=("curses", "ansi"),
+        default="curses", help="draw with curses or by writing ANSI "
+        "escapes straight to the terminal (default: curses)")
+    game.add_argument("--stats", action="store_true",
+        help="report how much drawing was done on exit")
+    game.add_argument("--split", action="store_true",
+        help="run the game in a process of its own and draw it from shared "
+        "memory (no spectators)")
+
+    rep = commands.add_parser("replay", help="play back a recorded game")
+    rep.set_defaults(command=replay)
+    rep.add_argument("recording", help="file written by play --record")
+    rep.add_argument("--speed", type=float, default=1.0,
+        help="speed multiplier, 1 being one step a second")
+    rep.add_argument("--headless", action="store_true",
+        help="fast-forward without curses and print the outcome")
+
+    sim = commands.add_parser("simulate",
+        help="play games headless and write results as JSON lines")
+    sim.set_defaults(command=simulate)
+    sim.add_argument("-n", "--games", type=int, default=1000,
+        help="number of games to play")
+    sim.add_argument("-w", "--workers", type=int, default=None,
+        help="number of worker processes (default: one per CPU)")
+    sim.add_argument("--policy", default="wormsim:greedy",
+        help="policy to play with as module:function")
+    sim.add_argument("--width", type=int, default=80)
+    sim.add_argument("--height", type=int, default=20)
+    sim.add_argument("--levels", metavar="PACK", default=None,
+        help="play each game on a level from this level pack, game n on "
+        "level n modulo the number of levels")
+    sim.add_argument("--seed", type=int, default=0,
+        help="seed of the first game, later games count up from it")
+    sim.add_argument("--max-steps", type=int, default=100000,
+        help="stop a game after this many steps")
+    sim.add_argument("--chunk-size", type=int, default=64,
+        help="games handed to a worker at a time")
+    sim.add_argument("-o", "--output", default="-",
+        help="file to write results to (default: stdout)")
+    sim.add_argument("--profile", metavar="FILE", default=None,
+        help="profile the games and export the profile to FILE as JSON, "
+        "or CSV if FILE ends in .csv")
+    sim.add_argument("--profile-every", type=float, default=10.0,
+        help="seconds between exports of the profile (default: 10)")
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    args.command(args)
@@ -0,0 +1,573 @@
+#!/usr/bin/env python3
+
+"""
+An arena: hundreds of worms on one board, all moved at once with NumPy.
+
+Every worm follows the rules of wormstate.WormState, with the same
+direction codes and targets worth 1 to 9 that make it grow, and a worm
+also dies when it runs into any other worm. Worms whose heads move into
+the same cell all die. Dead worms leave the board and come back as a
+single segment somewhere free on the next tick.
+
+There is one occupancy grid for the whole board, holding which worm is in
+each cell, so a collision is one lookup whichever worm is in the way. The
+grid has a border of wall cells all round, so running off the board is
+found by the same lookup. A tick only looks at the cells the heads move
+into, the tails they leave and the bodies of worms that died, never the
+whole board, so its cost follows the number of worms and not the size of
+the board.
+
+Targets live in a fixed number of slots. An eaten target is put back in
+its slot at a new cell on the same tick, so a worm heading for a slot is
+always heading for a target.
+
+A policy here steers every worm at once: called with the Arena it returns
+an array with a direction code for each worm, or -1 to keep going.
+
+    python wormarena.py bench --worms 500 --ticks 2000
+    python wormarena.py view --worms 200
+"""
+
+import argparse
+import curses
+import sys
+import time
+
+import numpy as np
+
+import wormcurses
+import wormrender
+import wormstate
+
+# Codes for how a worm died. The first two are WormState's and the arena
+# adds running into another worm and meeting one head on.
+PLAYING, WALL, SELF = wormstate.PLAYING, wormstate.WALL, wormstate.SELF
+OTHER, HEAD_ON = 5, 6
+
+# What the border around the board holds in the occupancy grid
+BORDER = -1
+
+# (dx, dy) for every direction code
+DX = np.array([d[0] for d in wormstate.DIRECTIONS], dtype=np.int64)
+DY = np.array([d[1] for d in wormstate.DIRECTIONS], dtype=np.int64)
+
+# The order greedy tries directions in. Codes are paired so that d ^ 1 is
+# the opposite of d and d ^ 2 and d ^ 3 are at right angles to it. The
+# first eight rows are for a target to the right (1), below (2) and
+# further across than down (4). The last four are for no target, keeping
+# on in the current direction or else turning.
+ORDERS = []
+for key in range(8):
+    across = wormstate.RIGHT if key & 1 else wormstate.LEFT
+    down = wormstate.DOWN if key & 2 else wormstate.UP
+    (first, second) = (across, down) if key & 4 else (down, across)
+    ORDERS.append((first, second, second ^ 1, first ^ 1))
+for current in range(4):
+    ORDERS.append((current, current ^ 2, current ^ 3, current ^ 1))
+ORDERS = np.array(ORDERS, dtype=np.int64)
+
+class Arena(object):
+    """
+    count worms and targets targets on one board of width by height.
+
+    Cells are numbered (y + 1) * stride + x + 1 where stride is width + 2,
+    leaving room for the border. owner has an entry per cell holding 0 if
+    it is free, BORDER for the border or one more than the number of the
+    worm in it. food holds
+    one more than the slot of the target in each cell, or 0, and
+    food_cell and food_value give the cell, or -1, and value of the target
+    in each slot. ring[w] is a ring buffer of the cells of worm w with its
+    head at head_index[w], as in wormbatch.WormBatch, doubled in size
+    whenever a worm outgrows it.
+    """
+
+    def __init__(self, count: int, width: int, height: int,
+            targets=None, seed=None, capacity: int = 64):
+        if targets == None:
+            targets = count
+        self.count = count
+        self.width = width
+        self.height = height
+        self.rng = np.random.default_rng(seed)
+        self.stride = width + 2
+        cells = self.stride * (height + 2)
+        self.owner = np.zeros(cells, dtype=np.int32)
+        grid = self.owner.reshape(height + 2, self.stride)
+        grid[0] = grid[-1] = grid[:, 0] = grid[:, -1] = BORDER
+        self.food = np.zeros(cells, dtype=np.int32)
+
+        # How far along the cells each direction code moves
+        self.deltas = DX + DY * self.stride
+
+        # Scratch space for finding heads that meet, only ever touched at
+        # the cells heads move into
+        self.claims = np.zeros(cells, dtype=np.int64)
+        self.clash = np.zeros(cells, dtype=bool)
+
+        self.food_cell = np.full(targets, -1, dtype=np.int64)
+        self.food_value = np.zeros(targets, dtype=np.int64)
+
+        self.ring = np.zeros((count, capacity), dtype=np.int64)
+        self.head_index = np.zeros(count, dtype=np.int64)
+        self.length = np.zeros(count, dtype=np.int64)
+        self.direction = np.zeros(count, dtype=np.int64)
+        self.grow_count = np.zeros(count, dtype=np.int64)
+        self.score = np.zeros(count, dtype=np.int64)
+        self.alive = np.zeros(count, dtype=bool)
+        self.cause = np.zeros(count, dtype=np.int8)    # How each last died
+        self.deaths = np.zeros(count, dtype=np.int64)
+        self.kills = np.zeros(count, dtype=np.int64)   # Worms run into it
+        self.goal = self.rng.integers(0, targets, count) # Slot to head for
+        self.ticks = 0
+        self.eaten = 0
+
+        self.spawn_worms(np.arange(count))
+        self.spawn_food(np.arange(targets))
+
+    def random_cells(self, n: int):
+        """
+        Returns up to n different cells drawn at random that are free and
+        have no target. Twice as many cells as needed are drawn, so fewer
+        come back only if the board is crowded, and whatever is short is
+        made up on the next tick.
+        """
+        draw = self.rng.integers(0, len(self.owner), 2 * n)
+        draw = draw[(self.owner[draw] == 0) & (self.food[draw] == 0)]
+
+        # Keep one of each cell drawn more than once, as step does heads
+        index = np.arange(len(draw))
+        self.claims[draw] = index
+        return draw[self.claims[draw] == index][:n]
+
+    def spawn_worms(self, worms):
+        """Puts the worms given back on the board as a single segment"""
+        cells = self.random_cells(len(worms))
+        worms = worms[:len(cells)]
+        self.ring[worms, 0] = cells
+        self.head_index[worms] = 0
+        self.length[worms] = 1
+        self.grow_count[worms] = 0
+        self.direction[worms] = self.rng.integers(0, 4, len(worms))
+        self.alive[worms] = True
+        self.cause[worms] = PLAYING
+        self.owner[cells] = worms + 1
+
+    def spawn_food(self, slots):
+        """Puts a new target in each of the slots given"""
+        cells = self.random_cells(len(slots))
+        slots = slots[:len(cells)]
+        self.food_cell[slots] = cells
+        self.food_value[slots] = self.rng.integers(1, 10, len(slots))
+        self.food[cells] = slots + 1
+
+    def xy(self, cells):
+        """Returns the x and y on the board of cells as two arrays"""
+        return (cells % self.stride - 1, cells // self.stride - 1)
+
+    def heads(self, worms):
+        """Returns the cell of the head of each of worms"""
+        return self.ring[worms, self.head_index[worms]]
+
+    def bodies(self, worms):
+        """Returns the cells of every segment of worms, head first"""
+        lengths = self.length[worms]
+        worm = np.repeat(worms, lengths)
+        starts = np.repeat(np.cumsum(lengths) - lengths, lengths)
+        k = np.arange(len(worm)) - starts
+        return self.ring[worm, (self.head_index[worm] - k) %
+            self.ring.shape[1]]
+
+    def grow_rings(self):
+        """Doubles the size of the ring buffers, keeping every body"""
+        (count, capacity) = self.ring.shape
+        ring = np.zeros((count, 2 * capacity), dtype=np.int64)
+        worms = np.flatnonzero(self.length)
+        lengths = self.length[worms]
+        worm = np.repeat(worms, lengths)
+        k = np.arange(len(worm)) - np.repeat(np.cumsum(lengths) - lengths,
+            lengths)
+
+        # Lay each body out from the tail at slot 0 to the head
+        ring[worm, self.length[worm] - 1 - k] = self.ring[worm,
+            (self.head_index[worm] - k) % capacity]
+        self.ring = ring
+        self.head_index[:] = np.maximum(self.length - 1, 0)
+
+    def kill(self, worms, causes):
+        """Takes worms off the board, noting how each died"""
+        self.owner[self.bodies(worms)] = 0
+        self.alive[worms] = False
+        self.cause[worms] = causes
+        self.deaths[worms] += 1
+        self.length[worms] = 0
+
+    def step(self, directions=None):
+        """
+        Advances every living worm by one step, after turning each worm
+        whose entry in directions isn't -1. Dead worms come back at the
+        end of the step. Returns the number of worms that died.
+        """
+        self.ticks += 1
+        if directions is not None:
+            turning = directions >= 0
+            self.direction[turning] = directions[turning]
+        movers = np.flatnonzero(self.alive)
+
+        # Work out where every head goes and what is in the way, before any
+        # tail moves, so a worm can't follow a tail into its cell
+        cell = self.heads(movers) + self.deltas[self.direction[movers]]
+        hit = self.owner[cell]
+        ok = hit == 0
+
+        # Heads that move into the same cell all die. Each head claims its
+        # cell and those that find another head's claim mark it clashed.
+        free = np.flatnonzero(ok)
+        claimed = cell[free]
+        self.claims[claimed] = free
+        lost = self.claims[claimed] != free
+        head_on = np.zeros(len(movers), dtype=bool)
+        if lost.any():
+            self.clash[claimed[lost]] = True
+            head_on[free] = self.clash[claimed]
+            self.clash[claimed[lost]] = False
+            ok &= ~head_on
+
+        # Take the dead off the board
+        dying = ~ok
+        if dying.any():
+            causes = np.full(len(movers), HEAD_ON, dtype=np.int8)
+            causes[hit > 0] = OTHER
+            causes[hit == movers + 1] = SELF
+            causes[hit == BORDER] = WALL
+            causes = causes[dying]
+            others = hit[(hit > 0) & (hit != movers + 1)] - 1
+            np.add.at(self.kills, others, 1)
+            self.kill(movers[dying], causes)
+
+        # Move the rest: a new head for each, and the tail goes unless the
+        # worm is growing
+        worms = movers[ok]
+        cell = cell[ok]
+        if len(worms):
+            if self.length[worms].max() >= self.ring.shape[1]:
+                self.grow_rings()
+            capacity = self.ring.shape[1]
+            hi = (self.head_index[worms] + 1) % capacity
+            self.ring[worms, hi] = cell
+            self.head_index[worms] = hi
+            self.length[worms] += 1
+            self.owner[cell] = worms + 1
+            growing = self.grow_count[worms] > 0
+            self.grow_count[worms[growing]] -= 1
+            still = worms[~growing]
+            tail = self.ring[still, (self.head_index[still] -
+                self.length[still] + 1) % capacity]
+            self.length[still] -= 1
+            self.owner[tail] = 0
+
+            # Eat the targets the heads moved onto
+            slot = self.food[cell] - 1
+            ate = slot >= 0
+            if ate.any():
+                eaters = worms[ate]
+                slot = slot[ate]
+                value = self.food_value[slot]
+                self.grow_count[eaters] += value
+                self.score[eaters] += value
+                self.eaten += len(slot)
+                self.food[cell[ate]] = 0
+                self.food_cell[slot] = -1
+
+        # Refill empty target slots and bring back the dead
+        empty = np.flatnonzero(self.food_cell < 0)
+        if len(empty):
+            self.spawn_food(empty)
+        dead = np.flatnonzero(~self.alive)
+        if len(dead):
+            self.spawn_worms(dead)
+        return int(dying.sum())
+
+    def check(self):
+        """
+        Returns True if the occupancy grid holds exactly the bodies of the
+        living worms and the food grid exactly the targets in the slots
+        """
+        owner = np.where(self.owner == BORDER, BORDER, 0).astype(np.int32)
+        worms = np.flatnonzero(self.alive)
+        cells = self.bodies(worms)
+        owner[cells] = np.repeat(worms + 1, self.length[worms])
+        food = np.zeros_like(self.food)
+        slots = np.flatnonzero(self.food_cell >= 0)
+        food[self.food_cell[slots]] = slots + 1
+        return (len(np.unique(cells)) == len(cells) and
+            np.array_equal(owner, self.owner) and
+            np.array_equal(food, self.food))
+
+def greedy(arena: Arena):
+    """
+    Heads each worm for the target in its goal slot, along whichever axis
+    is further first, taking the first of the four directions in order of
+    preference that leads to a free cell. Worms with no target to go for
+    prefer to keep going and then to turn.
+    """
+    worms = np.flatnonzero(arena.alive)
+    directions = np.full(arena.count, -1, dtype=np.int64)
+    stride = arena.stride
+    head = arena.heads(worms)
+    target = arena.food_cell[arena.goal[worms]]
+    dx = target % stride - head % stride
+    dy = target // stride - head // stride
+    none = target < 0
+    key = np.where(none, 8 + arena.direction[worms],
+        (dx > 0) + 2 * (dy > 0) + 4 * (abs(dx) >= abs(dy)))
+    order = ORDERS[key]
+    free = arena.owner[head[:, None] + arena.deltas[order]] == 0
+    choice = free.argmax(axis=1)
+    rows = np.arange(len(worms))
+    directions[worms] = np.where(free[rows, choice], order[rows, choice],
+        -1)
+
+    # Worms whose target was eaten by someone else pick a new one
+    lost = worms[none]
+    arena.goal[lost] = arena.rng.integers(0, len(arena.food_cell),
+        len(lost))
+    return directions
+
+def random_turns(arena: Arena, rate: float = 0.1):
+    """Turns each worm a random way with probability rate each tick"""
+    directions = arena.rng.integers(0, 4, arena.count)
+    directions[arena.rng.random(arena.count) >= rate] = -1
+    return directions
+
+def bench(count: int, width: int, height: int, ticks: int, seed=0,
+        policy=greedy, check: bool = False):
+    """
+    Runs an arena of count worms headless for ticks ticks and returns a
+    dict of ticks per second with and without the policy, the deaths and
+    targets eaten, and the longest worm
+    """
+    arena = Arena(count, width, height, seed=seed)
+    steering = 0.0
+    start = time.perf_counter()
+    deaths = 0
+    for i in range(ticks):
+        before = time.perf_counter()
+        directions = policy(arena)
+        steering += time.perf_counter() - before
+        deaths += arena.step(directions)
+    seconds = time.perf_counter() - start
+    if check and not arena.check():
+        raise AssertionError("Arena grid out of step with the worms")
+    return {"ticks_per_second": ticks / seconds,
+        "step_ticks_per_second": ticks / (seconds - steering),
+        "deaths": deaths, "eaten": arena.eaten,
+        "longest": int(arena.length.max()),
+        "top_score": int(arena.score.max())}
+
+class ArenaViewer(wormcurses.WormCurses):
+    """
+    Watches an Arena in the terminal with the same screen as WormCurses,
+    through a view that follows one worm. The followed worm is drawn with
+    '@' and 'o', the others with '#' and '+'. F follows another worm, P
+    pauses and Q quits.
+    """
+
+    def __init__(self, arena: Arena, policy, renderer=None):
+        self.arena = arena
+        self.policy = policy
+        self.follow = 0
+        self.status = ""
+        self.set_renderer(renderer)
+
+    def follow_next(self):
+        """
+        Follows the next living worm after the one followed, going round to
+        the first. Returns False, following the same worm, if none are
+        alive.
+        """
+        alive = np.flatnonzero(self.arena.alive)
+        if not len(alive):
+            return False
+        later = alive[alive > self.follow]
+        self.follow = int(later[0] if len(later) else alive[0])
+        return True
+
+    def place_view(self, width: int, height: int):
+        """Size the view to the play area and center it on the worm"""
+        arena = self.arena
+        self.view_width = min(width, arena.width)
+        self.view_height = min(height, arena.height)
+        (x, y) = arena.xy(arena.heads(self.follow))
+        self.view_x = wormcurses.center(x, self.view_width, arena.width)
+        self.view_y = wormcurses.center(y, self.view_height, arena.height)
+        self.screen = np.full((self.view_height, self.view_width), ord(' '),
+            dtype=np.uint8)
+
+    def view_characters(self):
+        """Returns the character of every cell in view as a byte array"""
+        arena = self.arena
+        (vx, vy) = (self.view_x, self.view_y)
+        (vw, vh) = (self.view_width, self.view_height)
+        rows = slice(vy + 1, vy + vh + 1)
+        columns = slice(vx + 1, vx + vw + 1)
+        owner = arena.owner.reshape(arena.height + 2, arena.stride)[rows,
+            columns]
+        food = arena.food.reshape(arena.height + 2, arena.stride)[rows,
+            columns]
+        chars = np.full((vh, vw), ord(' '), dtype=np.uint8)
+        chars[owner != 0] = ord('+')
+        chars[owner == self.follow + 1] = ord('o')
+        slots = food[food != 0] - 1
+        chars[food != 0] = ord('0') + arena.food_value[slots]
+
+        # Heads of the living worms that are in view
+        worms = np.flatnonzero(arena.alive)
+        (x, y) = arena.xy(arena.heads(worms))
+        x -= vx
+        y -= vy
+        inside = (x >= 0) & (x < vw) & (y >= 0) & (y < vh)
+        chars[y[inside], x[inside]] = np.where(
+            worms[inside] == self.follow, ord('@'), ord('#'))
+        return chars
+
+    def draw_arena(self):
+        """Draw just the cells in view that changed since last drawn"""
+        arena = self.arena
+        if arena.alive[self.follow]:
+            (x, y) = arena.xy(arena.heads(self.follow))
+            view_x = wormcurses.scroll(x, self.view_x, self.view_width,
+                arena.width)
+            view_y = wormcurses.scroll(y, self.view_y, self.view_height,
+                arena.height)
+            if (view_x, view_y) != (self.view_x, self.view_y):
+                (self.view_x, self.view_y) = (view_x, view_y)
+                self.renderer.erase()
+                self.screen[:] = ord(' ')
+        chars = self.view_characters()
+        (ys, xs) = np.nonzero(chars != self.screen)
+        for (y, x) in zip(ys.tolist(), xs.tolist()):
+            self.safe_addch(y + self.view_y, x + self.view_x,
+                chr(chars[y, x]))
+        self.screen = chars
+
+        # The header fields are the followed worm's
+        if self.changed("grow_by", int(arena.grow_count[self.follow])):
+            self.renderer.grow_by(str(arena.grow_count[self.follow]))
+        if self.changed("score", int(arena.score[self.follow])):
+            self.renderer.score(str(arena.score[self.follow]))
+        self.status = ("Tick %d: %d worms, following %d (F for another, "
+            "Q to quit)" % (arena.ticks, arena.alive.sum(), self.follow))
+        if self.changed("status", self.status):
+            self.renderer.status(self.status)
+
+    def draw_all(self):
+        """Redraw everything on the screen"""
+        self.shown.clear()
+        self.draw_static_content()
+        self.screen[:] = ord(' ')
+        self.draw_arena()
+        self.flush()
+
+    def watch(self, tick_rate: float = 20.0):
+        """
+        Runs the arena tick_rate times a second with the policy, drawing
+        each tick, until Q is pressed. Ticks that can't be kept up with are
+        skipped rather than caught up on.
+        """
+        interval = 1 / tick_rate
+        paused = False
+        keys = wormcurses.keys
+        try:
+            self.setup_curses()
+            self.layout()
+            self.place_view(self.play_maxx, self.play_maxy)
+            self.draw_all()
+            next_tick = time.monotonic() + interval
+            while True:
+                wait = next_tick - time.monotonic()
+                self.keyboard.timeout(-1 if paused else
+                    max(int(wait * 1000), 0))
+                ch = self.getch()
+                self.keyboard.timeout(0)
+                while ch != keys.TIMEOUT:
+                    match ch:
+                        case keys.KEY_q | keys.KEY_Q:
+                            return
+                        case keys.KEY_p | keys.KEY_P:
+                            paused = not paused
+                        case keys.KEY_f | keys.KEY_F:
+                            if self.follow_next():
+                                self.place_view(self.play_maxx,
+                                    self.play_maxy)
+                                self.draw_all()
+                        case keys.KEY_CTRL_L | curses.KEY_REFRESH:
+                            self.draw_all()
+                        case curses.KEY_RESIZE:
+                            self.layout()
+                            self.place_view(self.play_maxx,
+                                self.play_maxy)
+                            self.draw_all()
+                    ch = self.keyboard.getch()
+
+                now = time.monotonic()
+                if paused:
+                    next_tick = now + interval
+                    continue
+                if now < next_tick:
+                    continue
+                next_tick = max(next_tick + interval, now)
+                self.arena.step(self.policy(self.arena))
+                self.render_stats["ticks"] += 1
+                self.draw_arena()
+                self.flush()
+        finally:
+            self.teardown_curses()
+
+def board_size(text: str):
+    """Parses a board size given as WIDTHxHEIGHT"""
+    return tuple(int(n) for n in text.lower().split("x"))
+
+POLICIES = {"greedy": greedy, "random": random_turns}
+
+def main():
+    parser = argparse.ArgumentParser(description="Many worms on one board")
+    commands = parser.add_subparsers(dest="command", required=True)
+    b = commands.add_parser("bench", help="time an arena headless")
+    b.add_argument("--worms", type=int, default=500)
+    b.add_argument("--size", type=board_size, default=(400, 200),
+        help="WIDTHxHEIGHT")
+    b.add_argument("--ticks", type=int, default=2000)
+    b.add_argument("--seed", type=int, default=0)
+    b.add_argument("--policy", choices=sorted(POLICIES), default="greedy")
+    b.add_argument("--check", action="store_true",
+        help="check the grids against the worms at the end")
+    v = commands.add_parser("view", help="watch an arena in the terminal")
+    v.add_argument("--worms", type=int, default=200)
+    v.add_argument("--size", type=board_size, default=(200, 100),
+        help="WIDTHxHEIGHT")
+    v.add_argument("--seed", type=int, default=None)
+    v.add_argument("--policy", choices=sorted(POLICIES), default="greedy")
+    v.add_argument("--tick-rate", type=float, default=20.0)
+    v.add_argument("--renderer", choices=("curses", "ansi"),
+        default="curses")
+    args = parser.parse_args()
+
+    (width, height) = args.size
+    policy = POLICIES[args.policy]
+    if args.command == "bench":
+        result = bench(args.worms, width, height, args.ticks, args.seed,
+            policy, args.check)
+        print("%d worms on %dx%d for %d ticks: %.0f ticks/s, %.0f ticks/s "
+            "without the policy, %d deaths, %d targets eaten, longest worm "
+            "%d" % (args.worms, width, height, args.ticks,
+            result["ticks_per_second"], result["step_ticks_per_second"],
+            result["deaths"], result["eaten"], result["longest"]))
+    else:
+        renderer = None
+        if args.renderer == "ansi":
+            renderer = wormrender.AnsiRenderer(sys.stdout.fileno())
+        arena = Arena(args.worms, width, height, seed=args.seed)
+        ArenaViewer(arena, policy, renderer).watch(args.tick_rate)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+
+"""
+A batch engine that plays many games of worm at once with NumPy.
+
+Every game follows the same rules as wormstate.WormState.next_step. Each
+board lives in a row of a set of NumPy arrays and a single call to
+WormBatch.step advances all of them. Targets are drawn from a per-game
+random.Random in exactly the same order as the scalar engine, so a game
+started with the same seed and fed the same directions ends up in the same
+state in both engines.
+
+Run this file directly to check the batch engine against WormState and
+time it:
+
+    python wormbatch.py
+"""
+
+import random
+import time
+
+import numpy as np
+
+import wormstate
+
+# Codes for why a game is over, the same as WormState's
+PLAYING, WALL, SELF, FULL = (wormstate.PLAYING, wormstate.WALL,
+    wormstate.SELF, wormstate.FULL)
+
+class WormBatch(object):
+    """
+    count games of worm on boards of the same width and height.
+
+    For game b, occupied[b] has a byte per cell indexed by y * width + x,
+    and free[b, :free_len[b]] holds its free cells with position[b] giving
+    each cell's slot in free. ring[b] is a ring buffer of the cells of the
+    worm with the head at head_index[b].
+    """
+
+    def __init__(self, count: int, width: int, height: int):
+        self.count = count
+        self.width = width
+        self.height = height
+        cells = width * height
+        self.occupied = np.zeros((count, cells), dtype=np.uint8)
+        self.free = np.zeros((count, cells), dtype=np.int32)
+        self.position = np.zeros((count, cells), dtype=np.int32)
+        self.free_len = np.zeros(count, dtype=np.int64)
+        self.ring = np.zeros((count, cells), dtype=np.int32)
+        self.head_index = np.zeros(count, dtype=np.int64)
+        self.length = np.zeros(count, dtype=np.int64)
+        self.dx = np.zeros(count, dtype=np.int64)
+        self.dy = np.zeros(count, dtype=np.int64)
+        self.grow_count = np.zeros(count, dtype=np.int64)
+        self.score = np.zeros(count, dtype=np.int64)
+        self.target = np.zeros(count, dtype=np.int64)
+        self.target_value = np.zeros(count, dtype=np.int64)
+        self.game_over = np.zeros(count, dtype=bool)
+        self.cause = np.zeros(count, dtype=np.int8)
+        self.steps = np.zeros(count, dtype=np.int64)
+        self.prngs = [None] * count
+
+        # (dx, dy) for every direction code
+        self.deltas = np.array(wormstate.DIRECTIONS, dtype=np.int64)
+
+    def reset(self, seeds):
+        """
+        Starts a new game on every board. seeds holds one seed per game
+        and plays the same role as the seed passed to WormState.reset.
+        """
+        cells = self.width * self.height
+        self.occupied[:] = 0
+        self.free[:] = np.arange(cells, dtype=np.int32)
+        self.position[:] = np.arange(cells, dtype=np.int32)
+        self.free_len[:] = cells
+        self.dx[:], self.dy[:] = wormstate.DIRECTIONS[wormstate.RIGHT]
+        self.grow_count[:] = 0
+        self.score[:] = 0
+        self.game_over[:] = False
+        self.cause[:] = PLAYING
+        self.steps[:] = 0
+
+        # Start with the worm's head at the center
+        games = np.arange(self.count)
+        head = np.full(self.count,
+            (self.height // 2) * self.width + self.width // 2, dtype=np.int64)
+        self.head_index[:] = 0
+        self.length[:] = 0
+        self.push_heads(games, head)
+
+        # Generate a target number for each worm to eat. A worm that
+        # already fills the board has won before it starts, as in
+        # WormState.reset.
+        for b in range(self.count):
+            self.prngs[b] = random.Random(seeds[b])
+            if not self.generate_target(b):
+                self.game_over[b] = True
+                self.cause[b] = FULL
+
+    def push_heads(self, games, head):
+        """
+        Adds a new head at cell head[i] to the worm of games[i] and takes
+        the cell out of its free cells with a swap-remove.
+        """
+        cells = self.width * self.height
+        hi = (self.head_index[games] + 1) % cells
+        self.ring[games, hi] = head
+        self.head_index[games] = hi
+        self.length[games] += 1
+
+        self.occupied[games, head] = 1
+        p = self.position[games, head]
+        n = self.free_len[games] - 1
+        last = self.free[games, n]
+        self.free[games, p] = last
+        self.position[games, last] = p
+        self.free_len[games] = n
+
+    def pop_tails(self, games):
+        """
+        Removes the tail from the worm of each game in games and gives the
+        cell back to its free cells. Returns the vacated cells.
+        """
+        cells = self.width * self.height
+        ti = (self.head_index[games] - self.length[games] + 1) % cells
+        tail = self.ring[games, ti]
+        self.length[games] -= 1
+
+        self.occupied[games, tail] = 0
+        n = self.free_len[games]
+        self.position[games, tail] = n
+        self.free[games, n] = tail
+        self.free_len[games] = n + 1
+        return tail
+
+    def generate_target(self, b: int):
+        """
+        Generates a new target for game b the same way as
+        WormState.generate_target. Returns False if the board is full.
+        """
+        prng = self.prngs[b]
+        tv = prng.randint(1, 9)
+        n = int(self.free_len[b])
+        if n == 0:
+            self.target[b] = -1
+            self.target_value[b] = 0
+            return False
+        self.target[b] = self.free[b, prng.randrange(n)]
+        self.target_value[b] = tv
+        return True
+
+    def step(self, directions=None):
+        """
+        Advances every game that is still running by a single step.
+
+        directions holds a direction code from wormstate for each game, or
+        a negative number to keep going the same way. Returns the cells
+        vacated by tails as an array with -1 for games that lost no tail.
+        """
+        vacated = np.full(self.count, -1, dtype=np.int64)
+        active = ~self.game_over
+
+        # Turn the worms that were given a new direction
+        if directions is not None:
+            directions = np.asarray(directions)
+            turn = active & (directions >= 0)
+            self.dx[turn] = self.deltas[directions[turn], 0]
+            self.dy[turn] = self.deltas[directions[turn], 1]
+
+        # Figure out the new position of each head
+        head = self.ring[np.arange(self.count), self.head_index]
+        x = head % self.width + self.dx
+        y = head // self.width + self.dy
+
+        # See which worms ran into a wall
+        wall = active & ((x < 0) | (x >= self.width) |
+            (y < 0) | (y >= self.height))
+        self.game_over[wall] = True
+        self.cause[wall] = WALL
+        active &= ~wall
+
+        # See which worms ran into themselves
+        cell = np.where(active, y * self.width + x, 0)
+        hit = active & (self.occupied[np.arange(self.count), cell] != 0)
+        self.game_over[hit] = True
+        self.cause[hit] = SELF
+        active &= ~hit
+
+        # Move the surviving worms forward
+        games = np.flatnonzero(active)
+        cell = cell[games]
+        self.push_heads(games, cell)
+        self.steps[games] += 1
+
+        # Drop the tails of the worms that aren't growing
+        growing = self.grow_count[games] > 0
+        self.grow_count[games[growing]] -= 1
+        shrinking = games[~growing]
+        vacated[shrinking] = self.pop_tails(shrinking)
+
+        # Feed the worms that reached their target
+        eaten = cell == self.target[games]
+        for b in games[eaten]:
+            tv = self.target_value[b]
+            self.grow_count[b] += tv
+            self.score[b] += tv
+            if not self.generate_target(b):
+                self.game_over[b] = True
+                self.cause[b] = FULL
+
+        return vacated
+
+    def matches(self, b: int, state: wormstate.WormState):
+        """
+        Returns True if game b is in the same state as the scalar state.
+        """
+        body = [y * self.width + x for (x, y) in state.worm]
+        cells = self.width * self.height
+        n = int(self.length[b])
+        ring = [int(self.ring[b, (int(self.head_index[b]) - i) % cells])
+            for i in range(n)]
+        target = state.target_y * self.width + state.target_x
+        if state.target_value == None:
+            target = -1
+        return (ring == body and
+            bool(self.game_over[b]) == state.game_over and
+            int(self.grow_count[b]) == state.grow_count and
+            int(self.score[b]) == state.score and
+            int(self.target[b]) == target)
+
+def check_against_scalar(count: int = 200, width: int = 20, height: int = 10,
+        steps: int = 400):
+    """
+    Plays count random games in both engines and checks they agree after
+    every step. Returns the number of mismatches found.
+    """
+    rng = np.random.default_rng(0)
+    seeds = list(range(count))
+    batch = WormBatch(count, width, height)
+    batch.reset(seeds)
+    states = []
+    for seed in seeds:
+        state = wormstate.WormState()
+        state.reset(width, height, seed)
+        states.append(state)
+
+    mismatches = 0
+    for i in range(steps):
+        directions = rng.integers(-12, 4, size=count)
+        batch.step(directions)
+        for b in range(count):
+            if directions[b] >= 0:
+                states[b].go(int(directions[b]))
+            result = states[b].next_step()
+            if not batch.matches(b, states[b]):
+                mismatches += 1
+            elif (result.cause != wormstate.OVER and
+                    batch.cause[b] != result.cause):
+                mismatches += 1
+    return mismatches
+
+def benchmark(count: int = 4096, width: int = 80, height: int = 24,
+        steps: int = 1000):
+    """
+    Returns game steps per second of the batch engine. Games are restarted
+    whenever they are all over so every call keeps doing work.
+    """
+    rng = np.random.default_rng(0)
+    batch = WormBatch(count, width, height)
+    batch.reset(range(count))
+    schedule = rng.integers(-32, 4, size=(steps, count))
+    moved = 0
+    start = time.perf_counter()
+    for directions in schedule:
+        batch.step(directions)
+        if batch.game_over.all():
+            moved += int(batch.steps.sum())
+            batch.reset(range(count))
+    moved += int(batch.steps.sum())
+    return moved / (time.perf_counter() - start)
+
+if __name__ == "__main__":
+    print("mismatches against WormState:", check_against_scalar())
+    print("batch game steps per second: %.0f" % benchmark())
@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks for the worm game.
+
+Sweeps board sizes and worm lengths and times the hot paths of the game:
+WormState.next_step, WormState.generate_target, yoke.Sentinel moves and
+WormCurses.draw_worm_full, as well as whole frames of the game. Rendering is
+done into a wormrender.FramebufferRenderer so no terminal is needed.
+
+    python wormbench.py              # run the quick sweep and print it
+    python wormbench.py --full       # include boards up to 4000x4000
+    python wormbench.py --save       # store the results as the baseline
+    python wormbench.py --check      # fail if slower than the baseline
+    python wormbench.py --bodies     # compare the worm body classes
+
+The baseline holds absolute timings, so it only means anything on the
+machine that recorded it. Save a new one before checking anywhere else.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import wormcurses
+import wormrender
+import wormstate
+import yoke
+
+# Board sizes to sweep. The cycle the worm follows needs even heights.
+QUICK_SIZES = [(80, 24), (200, 60)]
+FULL_SIZES = QUICK_SIZES + [(1000, 1000), (4000, 4000)]
+
+# Worm lengths to sweep as a fraction of the board, plus a worm of one
+LENGTHS = [0.0, 0.01, 0.5, 0.95]
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "bench_baseline.json")
+
+# How many times the baseline a median call can take before --check fails.
+# Timings on a busy machine are noisy so this is deliberately loose; the
+# regressions it is meant to catch are orders of magnitude.
+MAX_SLOWDOWN = 2.0
+
+def steer_cycle(state: wormstate.WormState):
+    """
+    Points the worm along a cycle that visits every cell of the play area
+    exactly once, so it can run forever without hitting anything. Rows are
+    swept back and forth from column 1 and column 0 is used to come back to
+    the top. The play area needs an even height for the cycle to close.
+    """
+    x, y = state.worm.head()
+    if x == 0:
+        if y == 0:
+            state.go_right()
+        else:
+            state.go_up()
+    elif y % 2 == 0:
+        if x < state.width - 1:
+            state.go_right()
+        else:
+            state.go_down()
+    elif x > 1:
+        state.go_left()
+    elif y == state.height - 1:
+        state.go_left()
+    else:
+        state.go_down()
+
+def cycle_cells(width: int, height: int):
+    """Yields the cells of the cycle steer_cycle follows, from 0, 0"""
+    for y in range(height):
+        if y % 2 == 0:
+            for x in range(1, width):
+                yield (x, y)
+        else:
+            for x in range(width - 1, 0, -1):
+                yield (x, y)
+    for y in range(height - 1, -1, -1):
+        yield (0, y)
+
+def make_state(width: int, height: int, length: int,
+        body_class=wormstate.RingBody, seed: int = 0):
+    """
+    Returns a game on a width by height board with a worm of the given
+    length laid along the cycle, ready to keep following it.
+    """
+    state = wormstate.WormState(body_class)
+    state.reset(width, height, seed)
+
+    # Swap the starting worm for one of the right length
+    state.cells.vacate(*state.worm.pop_tail())
+    cells = cycle_cells(width, height)
+    for i in range(max(length, 1)):
+        x, y = next(cells)
+        state.worm.push_head(x, y)
+        state.cells.occupy(x, y)
+    state.generate_target()
+    return state
+
+def percentiles(samples):
+    """Returns the 50th, 90th and 99th percentile of samples"""
+    samples = sorted(samples)
+    n = len(samples) - 1
+    return [samples[int(n * p)] for p in (0.50, 0.90, 0.99)]
+
+def time_calls(function, calls: int, batch: int = 1):
+    """
+    Calls function calls times and returns the per-call latencies in
+    nanoseconds. Calls that are too quick to time one at a time can be
+    timed in batches, giving the average of each batch as its latency. A
+    tenth as many untimed calls are made first to warm up.
+    """
+    for i in range(calls // 10):
+        function()
+    clock = time.perf_counter_ns
+    latencies = []
+    for i in range(calls // batch):
+        start = clock()
+        for j in range(batch):
+            function()
+        elapsed = (clock() - start) // batch
+        latencies.extend([elapsed] * batch)
+    return latencies
+
+def summarize(latencies):
+    """Turns per-call latencies into calls per second and percentiles"""
+    p50, p90, p99 = percentiles(latencies)
+    return {
+        "per_second": round(len(latencies) * 1e9 / max(sum(latencies), 1)),
+        "p50_ns": p50,
+        "p90_ns": p90,
+        "p99_ns": p99,
+    }
+
+def bench_next_step(state: wormstate.WormState, ticks: int):
+    """
+    Times WormState.next_step while the worm follows the cycle. Growth is
+    cancelled every tick so the worm keeps the length being measured.
+    """
+    def tick():
+        steer_cycle(state)
+        state.next_step()
+        state.grow_count = 0
+    result = summarize(time_calls(tick, ticks))
+
+    # Measure how far memory in use rises above where it started during a
+    # tick, on average. This is bytes at the peak, not a count of
+    # allocations.
+    tracemalloc.start()
+    peak = 0
+    for i in range(min(ticks, 1000)):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        tick()
+        peak += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    result["peak_bytes_per_tick"] = round(peak / min(ticks, 1000), 1)
+    return result
+
+def bench_generate_target(state: wormstate.WormState, calls: int):
+    """Times WormState.generate_target"""
+    return summarize(time_calls(state.generate_target, calls))
+
+def bench_sentinel_move(length: int, calls: int):
+    """
+    Times popping the tail of a yoke.Sentinel list of the given length and
+    pushing a new head, which reuses the popped node, as next_step does on
+    a LinkedBody every tick.
+    """
+    sentinel = yoke.Sentinel()
+    for i in range(max(length, 1)):
+        sentinel.push_left(i, 0)
+    def move():
+        tail = sentinel.pop_right()
+        sentinel.push_left(tail.x, tail.y)
+    return summarize(time_calls(move, calls, batch=100))
+
+def make_ui(state: wormstate.WormState):
+    """
+    Returns a WormCurses showing state on a framebuffer just big enough for
+    the whole board, with everything drawn.
+    """
+    ui = wormcurses.WormCurses()
+    ui.set_state(state, renderer=wormrender.FramebufferRenderer(
+        state.width + 2, state.height + 4))
+    ui.layout()
+    ui.place_view(state.width, state.height)
+    ui.status = ""
+    ui.draw_all()
+    return ui
+
+def bench_draw_worm_full(state: wormstate.WormState, calls: int):
+    """Times WormCurses.draw_worm_full into a framebuffer"""
+    ui = make_ui(state)
+    return summarize(time_calls(ui.draw_worm_full, calls))
+
+def bench_frame(state: wormstate.WormState, frames: int):
+    """
+    Times whole frames of the game drawn into a framebuffer: a step of
+    WormCurses.next_step with its drawing and flush.
+    """
+    ui = make_ui(state)
+    def frame():
+        steer_cycle(state)
+        ui.next_step(1)
+        state.grow_count = 0
+    return summarize(time_calls(frame, frames))
+
+def run_suite(sizes, ticks: int = 20000):
+    """
+    Runs every benchmark for every board size and worm length and returns
+    the results keyed by benchmark name.
+    """
+    results = {}
+    for (width, height) in sizes:
+        for fraction in LENGTHS:
+            length = max(1, int(width * height * fraction))
+            state = make_state(width, height, length)
+            key = "%dx%d/%d" % (width, height, length)
+
+            # Fewer repeats for the calls that walk the whole worm
+            draw_calls = max(3, min(200, 200000 // length))
+
+            results["next_step/" + key] = bench_next_step(state, ticks)
+            results["generate_target/" + key] = bench_generate_target(
+                state, ticks)
+            results["sentinel_move/" + key] = bench_sentinel_move(length,
+                ticks)
+            results["draw_worm_full/" + key] = bench_draw_worm_full(
+                state, draw_calls)
+            results["frame/" + key] = bench_frame(state, ticks)
+            report(results, key)
+    return results
+
+def report(results, key: str):
+    """Prints the results for one board size and worm length"""
+    for name, result in results.items():
+        if name.endswith("/" + key):
+            print("%-40s %12d/s  p50 %8dns  p90 %8dns  p99 %8dns%s" % (
+                name, result["per_second"], result["p50_ns"],
+                result["p90_ns"], result["p99_ns"],
+                "  %6.1f B peak/tick" % result["peak_bytes_per_tick"]
+                    if "peak_bytes_per_tick" in result else ""))
+    sys.stdout.flush()
+
+def check(results, baseline):
+    """
+    Compares results to a stored baseline. Returns the names of the
+    benchmarks whose median call took more than MAX_SLOWDOWN times as long,
+    and the names of those the baseline has no timing for, which can't be
+    checked until it is saved again.
+    """
+    regressions = []
+    unchecked = []
+    for name, result in results.items():
+        if name not in baseline:
+            unchecked.append(name)
+            continue
+        expected = baseline[name]["p50_ns"]
+        if result["p50_ns"] > expected * MAX_SLOWDOWN:
+            regressions.append("%s: p50 %dns, baseline %dns" % (
+                name, result["p50_ns"], expected))
+    return (regressions, unchecked)
+
+def body_bytes_per_segment(body_class, segments: int):
+    """
+    Returns the number of bytes allocated per segment when building a body
+    of the given length with body_class.
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    body = body_class(segments)
+    for i in range(segments):
+        body.push_head(i, 0)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / segments
+
+def ticks_per_second(body_class, width: int, height: int, ticks: int):
+    """
+    Returns how many times per second WormState.next_step runs with
+    body_class while the worm follows steer_cycle.
+    """
+    state = wormstate.WormState(body_class)
+    state.reset(width, height)
+    start = time.perf_counter()
+    for i in range(ticks):
+        steer_cycle(state)
+        state.next_step()
+    return ticks / (time.perf_counter() - start)
+
+def compare_bodies(width: int = 200, height: int = 60, ticks: int = 200000):
+    """ Print memory and speed of each body representation side by side. """
+    print("%-12s %14s %14s" % ("body", "bytes/segment", "ticks/second"))
+    for body_class in (wormstate.LinkedBody, wormstate.RingBody):
+        size = body_bytes_per_segment(body_class, width * height)
+        rate = ticks_per_second(body_class, width, height, ticks)
+        print("%-12s %14.1f %14.0f" % (body_class.__name__, size, rate))
+
+def main():
+    parser = argparse.ArgumentParser(description="Worm benchmarks")
+    parser.add_argument("--full", action="store_true",
+        help="sweep boards up to 4000x4000 (slow)")
+    parser.add_argument("--ticks", type=int, default=20000,
+        help="calls timed per benchmark")
+    parser.add_argument("--save", action="store_true",
+        help="store the results as the new baseline")
+    parser.add_argument("--check", action="store_true",
+        help="exit with an error if slower than the baseline")
+    parser.add_argument("--bodies", action="store_true",
+        help="compare the worm body classes instead")
+    args = parser.parse_args()
+
+    if args.bodies:
+        compare_bodies()
+        return 0
+
+    results = run_suite(FULL_SIZES if args.full else QUICK_SIZES, args.ticks)
+
+    if args.save:
+        with open(BASELINE_FILE, "w") as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    if args.check:
+        with open(BASELINE_FILE) as f:
+            (regressions, unchecked) = check(results, json.load(f))
+        if unchecked:
+            print("\nNO BASELINE (save one with --save):")
+            for name in unchecked:
+                print("  " + name)
+        if regressions:
+            print("\nREGRESSIONS:")
+            for regression in regressions:
+                print("  " + regression)
+            return 1
+        print("\nNo regressions against the baseline")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
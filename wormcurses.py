@@ -1,8 +1,13 @@
+import collections
 import curses
 import random
 import time
 import types
 
+import wormpilot
+import wormprofile
+import wormrecord
+import wormrender
 import wormstate
 
 """
@@ -20,6 +25,10 @@ The screen will be divided into the following areas:
 # Constants that can be used in a match statement
 keys = types.SimpleNamespace()
 keys.TIMEOUT = -1
+keys.KEY_a = ord('a')
+keys.KEY_A = ord('A')
+keys.KEY_f = ord('f')
+keys.KEY_F = ord('F')
 keys.KEY_h = ord('h')
 keys.KEY_H = ord('H')
 keys.KEY_j = ord('j')
@@ -34,6 +43,8 @@ keys.KEY_p = ord('p')
 keys.KEY_P = ord('P')
 keys.KEY_q = ord('q')
 keys.KEY_Q = ord('Q')
+keys.KEY_t = ord('t')
+keys.KEY_T = ord('T')
 keys.KEY_CTRL_L = ord('L') - 64
 # Curses doesn't define shifted up or down keys for some reason
 # And these don't work in a MacOS standard terminal. They do work in the
@@ -41,6 +52,24 @@ keys.KEY_CTRL_L = ord('L') - 64
 keys.KEY_SDOWN = 336
 keys.KEY_SUP = 337
 
+# Most moves that can be queued up ahead of the ticks that take them
+MOVE_QUEUE_LIMIT = 3
+
+# Methods timed as drawing when profiling
+DRAW_METHODS = ("draw_static_content", "draw_target", "draw_placed",
+    "draw_grow_by", "draw_score", "draw_walls", "draw_worm_full",
+    "draw_worm_update", "draw_status")
+
+# Seconds between updates of the profiling HUD
+HUD_INTERVAL = 1.0
+
+# Status shown while the autopilot is steering
+AUTOPILOT_STATUS = "Autopilot: Hit A to take over"
+
+# On boards bigger than the screen the view jumps to center the head once
+# the head gets this close to its edge
+VIEW_MARGIN = 4
+
 # Every time the worm eats a number it says a random phrase from this list
 worm_quotes = [
     "Yum!", "Delicious!", "I want MORE!", "Tasty!", "I'm still hungry!",
@@ -50,13 +79,112 @@ worm_quotes = [
 ]
 worm_max_quote = len(worm_quotes) - 1
 
+def center(pos: int, size: int, total: int):
+    """
+    Returns where a view of size cells along one axis of a board of total
+    cells starts when centered on pos, keeping it on the board.
+    """
+    return min(max(pos - size // 2, 0), total - size)
+
+def scroll(pos: int, origin: int, size: int, total: int):
+    """
+    Returns where a view of size cells along one axis of a board of total
+    cells starting at origin should start so that pos is not within
+    VIEW_MARGIN of its edges. It stays put unless pos got too close.
+    """
+    margin = min(VIEW_MARGIN, size // 4)
+    if origin + margin <= pos < origin + size - margin:
+        return origin
+    return center(pos, size, total)
+
+class TickTiming(object):
+    """
+    Running statistics for the game loop: how late each tick started
+    (jitter), how long a key press took to show on screen (latency) and
+    how many ticks were skipped to catch up (dropped).
+    """
+
+    def __init__(self):
+        self.count = {"jitter": 0, "latency": 0}
+        self.total = {"jitter": 0.0, "latency": 0.0}
+        self.worst = {"jitter": 0.0, "latency": 0.0}
+        self.dropped = 0
+
+    def add(self, name: str, seconds: float):
+        """Add a measurement in seconds"""
+        self.count[name] += 1
+        self.total[name] += seconds
+        self.worst[name] = max(self.worst[name], seconds)
+
+    def mean(self, name: str):
+        """Returns the mean of a measurement in seconds"""
+        return self.total[name] / max(self.count[name], 1)
+
+    def report(self):
+        """Returns a one line summary"""
+        return ("jitter mean %.2fms max %.2fms, input latency mean %.2fms "
+            "max %.2fms over %d moves, %d ticks dropped" % (
+            self.mean("jitter") * 1000, self.worst["jitter"] * 1000,
+            self.mean("latency") * 1000, self.worst["latency"] * 1000,
+            self.count["latency"], self.dropped))
+
 class WormCurses(object):
     """
     A curses user interface for the game of worm
     """
-    def set_state(self, state: wormstate.WormState):
+    def set_state(self, state: wormstate.WormState, seed=None,
+            record_path=None, publisher=None, board_size=None,
+            renderer=None, level=None, targets=1):
+        """
+        Use state for the game. If seed is given the first game is started
+        with it. If record_path is given each game is recorded to that file,
+        replacing the previous one. If publisher is given, a
+        wormspectate.Publisher, every change is streamed to spectators. If
+        board_size is given as (width, height) games are played on a board
+        of that size, however big, instead of one that fits the screen. The
+        screen is drawn with renderer, a wormrender.Renderer, or with curses
+        if none is given. If level is given, a wormlevel.Level, every game
+        is played on it, at its size. targets is how many targets are on
+        the board at once.
+        """
         self.state = state
+        self.board_size = board_size
+        self.level = level
+        self.targets = targets
+        self.counter = 0
         self.prng = random.Random(time.time())
+        self.seed = seed
+        self.record_path = record_path
+        self.recorder = None
+        self.publisher = publisher
+        self.set_renderer(renderer)
+
+        # A wormpilot.Autopilot while the worm is playing itself
+        self.pilot = None
+
+    def set_renderer(self, renderer=None):
+        """
+        Draw with renderer, a wormrender.Renderer, or with curses if None,
+        starting the record of what has been drawn afresh. Anything that
+        draws with this screen but doesn't play a WormState calls this
+        instead of set_state.
+        """
+        self.renderer = renderer
+
+        # Values last drawn for each header field so that only the ones
+        # that change get drawn again
+        self.shown = {}
+
+        # Whether anything has been drawn since the screen was last updated
+        self.damaged = False
+
+        # Running totals of the drawing done, to check it stays minimal
+        self.render_stats = {"ticks": 0, "cells": 0, "fields": 0,
+            "flushes": 0}
+
+        # A wormprofile.Profiler while profiling is turned on
+        self.profiler = None
+        self.hud_drawn = 0.0
 
     def setup_curses(self):
         """
@@ -68,7 +196,18 @@ class WormCurses(object):
         curses.cbreak()
         curses.curs_set(0)
         self.stdscr.keypad(True)
-        self.stdscr.timeout(1000)
+        if self.renderer == None:
+            self.renderer = wormrender.CursesRenderer(self.stdscr)
+
+        # Keys are read through a window, which curses refreshes first. When
+        # something else draws the screen they are read from a tiny window
+        # of their own so that curses never paints over the screen.
+        self.keyboard = self.stdscr
+        if not isinstance(self.renderer, wormrender.CursesRenderer):
+            self.keyboard = curses.newwin(1, 1, 0, 0)
+            self.keyboard.keypad(True)
+        self.keyboard.timeout(1000)
+        self.keyboard.refresh()
 
     def teardown_curses(self):
         """
@@ -86,219 +225,560 @@ class WormCurses(object):
         """
         Draw all of the content that shouldn't change at all during the game
         """
-        # Clear the entire screen
-        self.stdscr.clear()
+        # Clear the entire screen, then draw the header row labels and a
+        # border around the play area
+        self.renderer.draw_static()
+        self.damaged = True
 
-        # Draw header row labels
-        self.stdscr.addstr(0, 1, "Grow By:")
-        self.stdscr.addstr(0, self.maxx - 12, "Score:")
+    def safe_addch(self, y, x, c):
+        """
+        Draws a character at a cell of the board if the cell is in view.
+        """
+        x -= self.view_x
+        y -= self.view_y
+        if not (0 <= x < self.view_width and 0 <= y < self.view_height):
+            return
+        self.damaged = True
+        self.render_stats["cells"] += 1
+        self.renderer.put(y, x, c)
 
-        # Draw a border around the play area
-        border_area = self.stdscr.subwin(self.maxy - 2, self.maxx, 1, 0)
-        border_area.box()
-        self.stdscr.noutrefresh()
+    def changed(self, field, value):
+        """
+        Returns True if value differs from what was last drawn for field,
+        remembering it as drawn.
+        """
+        if self.shown.get(field) == value:
+            return False
+        self.shown[field] = value
+        self.damaged = True
+        self.render_stats["fields"] += 1
+        return True
 
-    def safe_addch(self, y, x, c):
+    def flush(self):
         """
-        Wraps the curses addch method which will throw an exception when
-        writing to the lower right corner of the screen
+        Push everything drawn since the last flush to the terminal in a
+        single update. Does nothing if nothing was drawn.
         """
-        try:
-            self.play_area.addch(y, x, c)
-        except curses.error:
-            pass
+        if self.damaged:
+            self.renderer.flush()
+            self.damaged = False
+            self.render_stats["flushes"] += 1
 
     def draw_target(self):
-        """ Draw the random target number on the screen."""
-        self.play_area.addch(self.state.target_y, self.state.target_x,
-             str(self.state.target_value))
+        """
+        Draw the target numbers that are in view. When there are more
+        targets than cells in view the view is scanned instead, as in
+        draw_worm_full.
+        """
+        state = self.state
+        if len(state.targets) <= self.view_width * self.view_height:
+            for (x, y, value) in state.target_cells():
+                self.safe_addch(y, x, str(value))
+            return
+        targets = state.targets
+        for y in range(self.view_y, self.view_y + self.view_height):
+            for x in range(self.view_x, self.view_x + self.view_width):
+                value = targets.get(y * state.width + x)
+                if value != None:
+                    self.safe_addch(y, x, str(value))
+
+    def draw_placed(self, result):
+        """
+        Draw just the targets placed during an advance, given its
+        wormstate.AdvanceResult. Targets eaten need no erasing as the worm
+        is drawn over them.
+        """
+        targets = self.state.targets
+        width = self.state.width
+        for (x, y, value) in result.placed:
+            if targets.get(y * width + x) == value:
+                self.safe_addch(y, x, str(value))
 
     def draw_grow_by(self):
         """ Draw the 'grow by' value on the screen."""
-        self.stdscr.addstr(0, 10, str(self.state.grow_count))
+        if self.changed("grow_by", self.state.grow_count):
+            self.renderer.grow_by(str(self.state.grow_count))
 
     def draw_score(self):
         """ Draw the score value on the screen. """
-        self.stdscr.addstr(0, self.maxx - 5, str(self.state.score).ljust(4))
+        if self.changed("score", self.state.score):
+            self.renderer.score(str(self.state.score))
 
     def draw_worm_full(self):
-        """ Draw the entire worm on the screen. """
-        w = self.state.worm.left
-        c = '@'
-        while w != self.state.worm:
-            self.safe_addch(w.y, w.x, c)
-            c = 'o'
-            w = w.left
-
-    def draw_worm_update(self, old_xy):
-        """
-        Efficiently animate a single step of the worm by only drawing the
-        new head, overwriting the old head, and if necessary, erase the
-        old tail.
-        """
-        w = self.state.worm.left
-        self.safe_addch(w.y, w.x, '@')
-        w = w.left
-        if w != self.state.worm:
-            self.safe_addch(w.y, w.x, 'o')
-        if (old_xy != None):
-            x, y = old_xy
-            self.safe_addch(y, x, ' ')
+        """
+        Draw all of the worm that is in view. A worm longer than the view
+        has cells is drawn by scanning the view instead of walking the worm,
+        so this never costs more than the size of the view.
+        """
+        worm = self.state.worm
+        if len(worm) <= self.view_width * self.view_height:
+            c = '@'
+            for (x, y) in worm:
+                self.safe_addch(y, x, c)
+                c = 'o'
+            return
+        is_occupied = self.state.cells.is_occupied
+        level = self.state.level
+        for y in range(self.view_y, self.view_y + self.view_height):
+            for x in range(self.view_x, self.view_x + self.view_width):
+                if is_occupied(x, y) and not (level != None and
+                        level.is_wall(x, y)):
+                    self.safe_addch(y, x, 'o')
+        x, y = worm.head()
+        self.safe_addch(y, x, '@')
+
+    def draw_walls(self):
+        """ Draw the walls of the level that are in view, if there is one. """
+        level = self.state.level
+        if level == None:
+            return
+        for y in range(self.view_y, self.view_y + self.view_height):
+            for x in range(self.view_x, self.view_x + self.view_width):
+                if level.is_wall(x, y):
+                    self.safe_addch(y, x, '#')
+
+    def place_view(self, width: int, height: int):
+        """
+        Size the view of the board to a play area of width by height and
+        center it on the head.
+        """
+        self.view_width = min(width, self.state.width)
+        self.view_height = min(height, self.state.height)
+        x, y = self.state.worm.head()
+        self.view_x = center(x, self.view_width, self.state.width)
+        self.view_y = center(y, self.view_height, self.state.height)
+
+    def follow_head(self):
+        """
+        Move the view if the head has got too close to its edge. Returns
+        True if it moved, in which case the play area needs redrawing.
+        """
+        x, y = self.state.worm.head()
+        view_x = scroll(x, self.view_x, self.view_width, self.state.width)
+        view_y = scroll(y, self.view_y, self.view_height, self.state.height)
+        if view_x == self.view_x and view_y == self.view_y:
+            return False
+        self.view_x = view_x
+        self.view_y = view_y
+        return True
+
+    def draw_play_area(self):
+        """ Redraw the target and worm in a freshly scrolled view. """
+        self.renderer.erase()
+        self.draw_walls()
+        self.draw_target()
+        self.draw_worm_full()
+        self.damaged = True
+
+    def draw_worm_update(self, start, result):
+        """
+        Efficiently animate the steps of an advance of the worm from start,
+        given its wormstate.AdvanceResult, by only drawing the new head,
+        overwriting the old heads, and erasing the old tails. Cells the
+        worm moved into and out of again within the steps end up drawn as
+        they finish.
+        """
+        is_occupied = self.state.cells.is_occupied
+        for xy in result.tails:
+            if xy != None and not is_occupied(*xy):
+                self.safe_addch(xy[1], xy[0], ' ')
+        for (x, y) in [start] + result.heads[:-1]:
+            if is_occupied(x, y):
+                self.safe_addch(y, x, 'o')
+        x, y = self.state.worm.head()
+        self.safe_addch(y, x, '@')
 
     def draw_status(self):
         """ Draw the status line. """
+        if not self.changed("status", self.status):
+            return
+        if self.publisher != None:
+            self.publisher.set_status(self.status)
+        self.renderer.status(self.status)
+
+    def turn(self, direction: int):
+        """ Point the worm in a new direction, recording it if needed. """
+        self.state.go(direction)
+        if self.recorder != None:
+            self.recorder.turn(self.state)
+
+    def save_recording(self):
+        """ Write the recording of the current game, if there is one. """
+        if self.recorder != None:
+            self.recorder.finish(self.state).save(self.record_path)
+
+    def save_recording_status(self):
+        """
+        Write the recording of the current game, if there is one, and
+        return what to tell the player if it couldn't be written, so that
+        a bad path doesn't end the session.
+        """
         try:
-            y = self.maxy - 1
-            x = (self.maxx - len(self.status)) // 2
-            self.stdscr.move(y, 0)
-            self.stdscr.deleteln()
-            self.stdscr.addstr(y, x, self.status)
-        except curses.error:
-            pass
+            self.save_recording()
+        except OSError as e:
+            return "Couldn't save the recording: %s" % e.strerror
+        return None
 
-    def next_step(self, n):
+    def next_step(self, n, flush=True):
         """
         Advance the state of the game by n steps. If we hit a target number,
-        the wall, or the worm, we stop advancing.
+        the wall, or the worm, we stop advancing. The steps are taken in a
+        single WormState.advance, only what they changed gets drawn and the
+        screen is updated once for all n steps, or not at all if flush is
+        False so the caller can batch more updates.
         """
-        try:
-            for i in range(n):
-                (old_xy, status) = self.state.next_step()
-                if status != None:
-                    if old_xy != None:
-                        (x, y) = old_xy
-                        x = max(x, 0)
-                        y = max(y, 0)
-                        self.play_area.addch(y, x, 'X')
-                    self.status = status + ": Hit 'N' for new game or Q to quit"
-                    self.draw_status()
-                    return
-                else:
-                    self.draw_target()
-                    self.draw_worm_update(old_xy)
-                    self.draw_grow_by()
-                    self.draw_score()
-                    self.draw_status()
-                    self.counter += 1
-                    if self.old_grow_count < self.state.grow_count:
-                        self.status = worm_quotes[self.prng.randint(0, worm_max_quote)]
-                        return
-        finally:
-            self.old_grow_count = self.state.grow_count
-            self.play_area.refresh()
-            self.stdscr.refresh()
+        start = self.state.worm.head()
+        result = self.state.advance(n)
+        self.counter += len(result.heads)
+        self.render_stats["ticks"] += len(result.heads)
+        if result.heads:
+            if self.follow_head():
+                self.draw_play_area()
+            else:
+                self.draw_worm_update(start, result)
+                if result.placed:
+                    self.draw_placed(result)
+        if result.stop == wormstate.DIED:
+            if result.crash != None:
+                (x, y) = result.crash
+                x = min(max(x, 0), self.state.width - 1)
+                y = min(max(y, 0), self.state.height - 1)
+                self.safe_addch(y, x, 'X')
+            self.status = (result.message() +
+                ": Hit 'N' for new game or Q to quit")
+            problem = self.save_recording_status()
+            if problem != None:
+                self.status = problem
+            if self.publisher != None:
+                self.publisher.snapshot(self.state, self.status)
+        else:
+            if self.publisher != None:
+                self.publisher.advance(self.state, result)
+            if result.stop == wormstate.ATE:
+                self.status = worm_quotes[self.prng.randint(0, worm_max_quote)]
+        if result.grow:
+            self.draw_grow_by()
+        if result.eaten:
+            self.draw_score()
+        self.draw_status()
+        if flush:
+            self.flush()
 
     def draw_all(self):
         """ Redraw everything on the screen (completely refresh). """
+        self.shown.clear()
         self.draw_static_content()
         self.draw_grow_by()
         self.draw_score()
         self.draw_status()
-        self.stdscr.refresh()
+        self.draw_walls()
         self.draw_target()
         self.draw_worm_full()
-        self.play_area.refresh()
+        if self.profiler != None:
+            self.draw_hud()
+        self.damaged = True
+        self.flush()
+
+    def draw_hud(self):
+        """ Draw the profiling summary over the top of the border. """
+        self.hud_drawn = time.monotonic()
+        self.renderer.hud(self.profiler.summary())
+        self.damaged = True
+
+    def toggle_profiling(self):
+        """
+        Turn profiling and its HUD on or off. While off nothing is timed at
+        all; turning it on starts a fresh profile.
+        """
+        if self.profiler == None:
+            self.profiler = wormprofile.Profiler()
+            wormprofile.instrument_state(self.profiler, self.state)
+            wormprofile.instrument(self.profiler, self, "draw", *DRAW_METHODS)
+            wormprofile.instrument(self.profiler, self, "flush", "flush")
+            wormprofile.instrument(self.profiler, self, "input_wait", "getch")
+            self.draw_hud()
+            self.flush()
+        else:
+            wormprofile.uninstrument_state(self.state)
+            wormprofile.uninstrument(self, "flush", "getch", *DRAW_METHODS)
+            self.profiler = None
+            self.draw_all()
+
+    def toggle_autopilot(self):
+        """
+        Let the worm play itself, or hand it back to the player. Moves the
+        player has already queued are still taken first.
+        """
+        if self.pilot == None:
+            self.pilot = wormpilot.Autopilot()
+            self.status = AUTOPILOT_STATUS
+        else:
+            self.pilot = None
+            self.status = ""
+        self.draw_status()
+        self.flush()
 
-    def reset_all(self):
-        """ Reset all state to start a new game. """
-        # Get the size of the total screen
-        (self.maxy, self.maxx) = self.stdscr.getmaxyx()
+    def layout(self):
+        """ Work out where everything goes on the screen. """
+        # Get the size of the total screen and of the game area
+        self.renderer.resize()
+        (self.maxy, self.maxx) = (self.renderer.maxy, self.renderer.maxx)
+        self.play_maxx = self.renderer.play_maxx
+        self.play_maxy = self.renderer.play_maxy
 
-        # The first line of the screen will hold the score and growth count
-        self.top_line = 0
-        self.score_col = self.maxx - 11
-        self.growth_col = 1
+    def resize(self):
+        """
+        Fit the screen to a new terminal size. A board sized to the screen
+        needs a new game, while a board of its own size just gets a new view
+        and costs no more to redraw than the view holds.
+        """
+        if self.board_size == None and self.level == None:
+            self.reset_all()
+            return
+        self.layout()
+        self.place_view(self.play_maxx, self.play_maxy)
+        self.draw_all()
 
-        # The game area
-        self.play_area = self.stdscr.subwin(2, 1)
-        self.play_maxx = self.maxx - 2  # account for border on both sides
-        self.play_maxy = self.maxy - 4  # account for border, header, and footer
-        self.state.reset(width = self.maxx - 2, height = self.maxy - 4)
+    def reset_all(self, width=None, height=None, seed=None):
+        """
+        Reset all state to start a new game. The play area fills the screen
+        unless a width and height are given or set_state was given a board
+        size or a level. Boards bigger than the screen are seen through a
+        view that follows the head.
+        """
+        self.layout()
+        if width == None or height == None:
+            if self.board_size != None:
+                width, height = self.board_size
+            else:
+                width, height = self.play_maxx, self.play_maxy
+        self.state.reset(width = width, height = height, seed = seed,
+            level = self.level, targets = self.targets)
+        self.place_view(self.play_maxx, self.play_maxy)
+
+        # Record the new game if asked to
+        if self.record_path != None:
+            self.recorder = wormrecord.Recorder(self.state)
 
         # No status to report
-        self.status = ""
+        self.status = AUTOPILOT_STATUS if self.pilot != None else ""
 
-        # Remember the grow count so we can tell whenever it increases
-        self.old_grow_count = self.state.grow_count
+        # Show spectators the new game
+        if self.publisher != None:
+            self.publisher.snapshot(self.state)
 
         # Draw everything
         self.draw_all()
 
-    def run(self):
-        """ Main game loop. """
+    def handle_key(self, ch):
+        """
+        Act on a single key press. Moves are queued for the next tick rather
+        than taken straight away. Returns False if the player quit.
+        """
+        if self.state.game_over:
+            match ch:
+                case keys.KEY_n | keys.KEY_N:
+                    self.reset_all()
+                case keys.KEY_q | keys.KEY_Q:
+                    return False
+                case curses.KEY_RESIZE:
+                    self.resize()
+        elif self.paused:
+            match ch:
+                case keys.KEY_p | keys.KEY_P:
+                    self.status = ""
+                    self.paused = False
+                    self.draw_status()
+                    self.flush()
+                case keys.KEY_q | keys.KEY_Q:
+                    return False
+                case curses.KEY_RESIZE:
+                    self.resize()
+        else:
+            match ch:
+                case keys.KEY_h | curses.KEY_LEFT:
+                    self.queue_move(wormstate.LEFT, 1)
+                case keys.KEY_j | curses.KEY_DOWN:
+                    self.queue_move(wormstate.DOWN, 1)
+                case keys.KEY_k | curses.KEY_UP:
+                    self.queue_move(wormstate.UP, 1)
+                case keys.KEY_l | curses.KEY_RIGHT:
+                    self.queue_move(wormstate.RIGHT, 1)
+                case keys.KEY_H | curses.KEY_SLEFT:
+                    self.queue_move(wormstate.LEFT, 5)
+                case keys.KEY_J | keys.KEY_SDOWN: # special case
+                    self.queue_move(wormstate.DOWN, 5)
+                case keys.KEY_K | keys.KEY_SUP: # special case
+                    self.queue_move(wormstate.UP, 5)
+                case keys.KEY_L | curses.KEY_SRIGHT:
+                    self.queue_move(wormstate.RIGHT, 5)
+                case keys.KEY_CTRL_L | curses.KEY_REFRESH:
+                    self.draw_all()
+                case keys.KEY_q | keys.KEY_Q:
+                    return False
+                case keys.KEY_t | keys.KEY_T:
+                    self.toggle_profiling()
+                case keys.KEY_a | keys.KEY_A:
+                    self.toggle_autopilot()
+                case keys.KEY_p | keys.KEY_P:
+                    self.status = "Paused: Hit P to continue"
+                    self.draw_status()
+                    self.flush()
+                    self.paused = True
+                case curses.KEY_RESIZE:
+                    self.resize()
+        return True
+
+    def getch(self):
+        """
+        Wait for a key as set up with timeout. This is a method of its own
+        so that profiling can time the wait.
+        """
+        return self.keyboard.getch()
+
+    def queue_move(self, direction: int, steps: int):
+        """
+        Queue a turn to be taken on a coming tick, moving steps steps on
+        that tick. Moves beyond MOVE_QUEUE_LIMIT are dropped.
+        """
+        if len(self.moves) < MOVE_QUEUE_LIMIT:
+            self.moves.append((direction, steps, time.monotonic()))
+
+    def tick(self, ticks: int):
+        """
+        Run ticks ticks of the game, each taking the next queued move if
+        there is one, and then update the screen once.
+        """
+        pressed = []
+        for i in range(ticks):
+            steps = 1
+            if self.moves:
+                (direction, steps, when) = self.moves.popleft()
+                self.turn(direction)
+                pressed.append(when)
+            elif self.pilot != None:
+                # Steer through turn like the player so that recordings
+                # and spectators see the same moves
+                direction = self.pilot(self.state)
+                if direction != None:
+                    self.turn(direction)
+            self.next_step(steps, flush=False)
+            if self.state.game_over:
+                self.moves.clear()
+                break
+        if (self.profiler != None and
+                time.monotonic() - self.hud_drawn >= HUD_INTERVAL):
+            self.draw_hud()
+        self.flush()
+
+        # Time from each key press to the screen showing its move
+        done = time.monotonic()
+        for when in pressed:
+            self.timing.add("latency", done - when)
+
+    def run(self, tick_rate: float = 1.0, max_catchup: int = 5):
+        """
+        Main game loop. The worm moves tick_rate times a second on a
+        monotonic clock however quickly keys are pressed. Every key waiting
+        is read each time round the loop and moves are queued for the ticks
+        to come. If the loop falls behind, up to max_catchup late ticks are
+        run at once and any more than that are skipped and counted as
+        dropped.
+        """
+        interval = 1 / tick_rate
         self.counter = 0
         self.paused = False
+        self.moves = collections.deque()
+        self.timing = TickTiming()
         try:
             self.setup_curses()
-            self.reset_all()
+            self.reset_all(seed = self.seed)
+            next_tick = time.monotonic() + interval
             while True:
-                ch = self.stdscr.getch()
-                if self.state.game_over:
-                    match ch:
-                        case keys.KEY_n | keys.KEY_N:
-                            self.reset_all()
-                        case keys.KEY_q | keys.KEY_Q:
-                            return
-                        case curses.KEY_RESIZE:
-                            self.reset_all()
-                            continue
-                        case _:
-                            continue
-                elif self.paused:
-                    match ch:
-                        case keys.KEY_p | keys.KEY_P:
-                            self.status = ""
-                            self.paused = False
-                            self.draw_status()
-                            self.stdscr.refresh()
-                        case keys.KEY_q | keys.KEY_Q:
-                            return
-                        case curses.KEY_RESIZE:
-                            self.reset_all()
-                            continue
-                        case _:
-                            continue
+                # Wait for a key, but no longer than until the next tick
+                waiting = self.state.game_over or self.paused
+                if waiting:
+                    self.keyboard.timeout(-1)
                 else:
-                    match ch:
-                        case keys.TIMEOUT:
-                            self.next_step(1)
-                        case keys.KEY_h | curses.KEY_LEFT:
-                            self.state.go_left()
-                            self.next_step(1)
-                        case keys.KEY_j | curses.KEY_DOWN:
-                            self.state.go_down()
-                            self.next_step(1)
-                        case keys.KEY_k | curses.KEY_UP:
-                            self.state.go_up()
-                            self.next_step(1)
-                        case keys.KEY_l | curses.KEY_RIGHT:
-                            self.state.go_right()
-                            self.next_step(1)
-                        case keys.KEY_H | curses.KEY_SLEFT:
-                            self.state.go_left()
-                            self.next_step(5)
-                        case keys.KEY_J | keys.KEY_SDOWN: # special case
-                            self.state.go_down()
-                            self.next_step(5)
-                        case keys.KEY_K | keys.KEY_SUP: # special case
-                            self.state.go_up()
-                            self.next_step(5)
-                        case keys.KEY_L | curses.KEY_SRIGHT:
-                            self.state.go_right()
-                            self.next_step(5)
-                        case keys.KEY_CTRL_L | curses.KEY_REFRESH:
-                            self.draw_all()
-                        case keys.KEY_q | keys.KEY_Q:
-                            return
-                        case keys.KEY_p | keys.KEY_P:
-                            self.status = "Paused: Hit P to continue"
+                    wait = next_tick - time.monotonic()
+                    if wait >= 0.001:
+                        self.keyboard.timeout(int(wait * 1000))
+                    else:
+                        # curses can't wait less than a millisecond
+                        if wait > 0:
+                            time.sleep(wait)
+                        self.keyboard.timeout(0)
+                ch = self.getch()
+
+                # Handle every key that is waiting before moving on
+                self.keyboard.timeout(0)
+                while ch != keys.TIMEOUT:
+                    if not self.handle_key(ch):
+                        return
+                    ch = self.keyboard.getch()
+
+                # The clock only runs while the game is being played
+                if waiting or self.state.game_over or self.paused:
+                    next_tick = time.monotonic() + interval
+                    continue
+
+                now = time.monotonic()
+                if now < next_tick:
+                    continue
+                due = int((now - next_tick) / interval) + 1
+                ticks = min(due, max_catchup)
+                self.timing.add("jitter", now - next_tick)
+                self.timing.dropped += due - ticks
+                next_tick += due * interval
+                self.tick(ticks)
+        finally:
+            # The terminal is put back even if the recording can't be saved
+            try:
+                problem = self.save_recording_status()
+            finally:
+                self.teardown_curses()
+            if problem != None:
+                print(problem)
+
+    def replay(self, recording: wormrecord.Recording, speed: float = 1.0):
+        """
+        Play back a recorded game at speed times the normal pace of one
+        step a second. P pauses and Q quits.
+        """
+        self.counter = 0
+        self.record_path = None
+        self.level = recording.level
+        self.targets = recording.targets
+        paused = False
+        try:
+            self.setup_curses()
+
+            # Take as many steps per screen update as needed to keep up
+            interval = 1000 / speed
+            self.keyboard.timeout(max(1, int(interval)))
+            steps = max(1, round(1 / interval))
+
+            self.reset_all(recording.width, recording.height, recording.seed)
+            replayer = wormrecord.Replayer(recording, self.state)
+            while True:
+                ch = self.keyboard.getch()
+                match ch:
+                    case keys.KEY_q | keys.KEY_Q:
+                        return
+                    case keys.KEY_p | keys.KEY_P:
+                        paused = not paused
+                    case keys.KEY_CTRL_L | curses.KEY_REFRESH:
+                        self.draw_all()
+                    case keys.TIMEOUT if not paused:
+                        for i in range(steps):
+                            if replayer.finished():
+                                break
+                            replayer.apply_turns()
+                            self.next_step(1, flush=False)
+                        self.flush()
+                        if replayer.finished():
+                            self.status = "End of replay: Hit Q to quit"
                             self.draw_status()
-                            self.stdscr.refresh()
-                            self.paused = True
-                        case curses.KEY_RESIZE:
-                            self.reset_all()
-                            continue
-                        case _:
-                            pass
+                            self.flush()
         finally:
             self.teardown_curses()
\ No newline at end of file
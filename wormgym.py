@@ -0,0 +1,477 @@
+#!/usr/bin/env python3
+
+"""
+Worm as an environment for learning agents, with the reset and step of the
+Gymnasium API.
+
+The observation is the board as a NumPy array of CHANNELS by height by
+width bytes: the body, the head, the value of any target and the walls of
+the level, one channel each. It is never rebuilt. Each step writes just
+the cells its wormstate.StepResult says changed, the old and new head,
+the dropped tail and any target placed, so a step costs the same however
+big the board or long the worm. What reset and step return is a
+read-only view of that one array, which is only valid until the next
+step, the same as the buffers of a vector environment.
+
+VectorWormEnv runs many environments in worker processes. Their
+observations, actions, rewards and flags live in one block of
+multiprocessing.shared_memory, each environment writing its observation
+straight into its slice, so nothing but a short command and the results
+of finished episodes ever goes through a pipe.
+
+Gymnasium is optional. When it is installed WormEnv is a gymnasium.Env
+with an observation and action space, and otherwise a plain class with
+the same methods.
+
+    python wormgym.py bench
+    python wormgym.py bench --envs 64 --workers 4
+"""
+
+import argparse
+import multiprocessing
+import random
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import wormlevel
+import wormstate
+
+try:
+    import gymnasium
+except ImportError:
+    gymnasium = None
+
+# Channels of the observation
+BODY, HEAD, TARGET, WALL = range(4)
+CHANNELS = 4
+
+# Reward for a step that ends the game other than by filling the board
+DEATH_REWARD = -1.0
+
+class WormEnv(gymnasium.Env if gymnasium != None else object):
+    """
+    A game of worm on a board of width by height, or on level, a
+    wormlevel.Level, with targets targets at once. Actions are direction
+    codes from wormstate. The reward for a step is the value of the
+    target eaten, plus death_reward on the step the worm dies. Steps
+    taken after the game ended change nothing and earn nothing. An
+    episode is truncated after max_steps steps if given.
+
+    buffer, if given, is where the observation lives, which must hold
+    CHANNELS * height * width bytes. seed seeds the episodes, each of
+    which gets a seed of its own from it.
+    """
+
+    metadata = {"render_modes": ["ansi"]}
+
+    def __init__(self, width: int = 20, height: int = 10, max_steps=None,
+            seed=None, level=None, targets: int = 1, buffer=None,
+            death_reward: float = DEATH_REWARD,
+            body_class=wormstate.RingBody):
+        if level != None:
+            width = level.width
+            height = level.height
+        self.width = width
+        self.height = height
+        self.max_steps = max_steps
+        self.level = level
+        self.targets = targets
+        self.death_reward = death_reward
+        self.state = wormstate.WormState(body_class)
+        self.seeds = random.Random(seed)
+        self.steps = 0
+
+        shape = (CHANNELS, height, width)
+        self.board = np.ndarray(shape, dtype=np.uint8, buffer=buffer)
+        self.observation = self.board.view()
+        self.observation.flags.writeable = False
+
+        # Single cells are written through a flat memoryview, which is
+        # much quicker at it than indexing the array
+        self.cells = memoryview(self.board.reshape(-1))
+        self.plane = width * height
+
+        if gymnasium != None:
+            self.observation_space = gymnasium.spaces.Box(0, 9, shape,
+                dtype=np.uint8)
+            self.action_space = gymnasium.spaces.Discrete(4)
+
+    def reset(self, *, seed=None, options=None):
+        """
+        Starts a new episode and returns the observation and an empty info
+        dict. A seed given here replaces the one the environment was made
+        with.
+        """
+        if seed != None:
+            self.seeds.seed(seed)
+        state = self.state
+        state.reset(self.width, self.height, self.seeds.getrandbits(63),
+            self.level, self.targets)
+        self.steps = 0
+
+        # The only time the whole board is written
+        board = self.board
+        board[:] = 0
+        for (x, y) in state.worm:
+            board[BODY, y, x] = 1
+        (x, y) = state.worm.head()
+        board[HEAD, y, x] = 1
+        for (x, y, value) in state.target_cells():
+            board[TARGET, y, x] = value
+        if self.level != None:
+            for (x, y) in self.level.wall_cells():
+                board[WALL, y, x] = 1
+        return (self.observation, {})
+
+    def step(self, action):
+        """
+        Turns the worm to action, a direction code, takes a step and
+        returns the observation, the reward, whether the game ended,
+        whether the episode was cut short and an info dict with the score
+        and how the step ended the game
+        """
+        state = self.state
+        state.go(action)
+        (x, y) = state.worm.head()
+        result = state.next_step()
+        self.steps += 1
+
+        # Write just the cells the step changed
+        if result.head != None:
+            cells = self.cells
+            width = self.width
+            plane = self.plane
+            cells[HEAD * plane + y * width + x] = 0
+            if result.tail != None:
+                (x, y) = result.tail
+                cells[BODY * plane + y * width + x] = 0
+            (x, y) = result.head
+            i = y * width + x
+            cells[BODY * plane + i] = 1
+            cells[HEAD * plane + i] = 1
+            cells[TARGET * plane + i] = 0
+            if result.placed != None:
+                (x, y, value) = result.placed
+                cells[TARGET * plane + y * width + x] = value
+
+        # Only the step that crashed is penalized, not any taken after it
+        reward = float(result.eaten)
+        terminated = state.game_over
+        if result.cause in (wormstate.WALL, wormstate.SELF):
+            reward += self.death_reward
+        truncated = (not terminated and self.max_steps != None and
+            self.steps >= self.max_steps)
+        return (self.observation, reward, terminated, truncated,
+            {"score": state.score, "cause": result.cause})
+
+    def render(self):
+        """Returns the board as text, as the ansi render mode does"""
+        board = self.board
+        rows = []
+        for y in range(self.height):
+            row = []
+            for x in range(self.width):
+                if board[HEAD, y, x]:
+                    row.append('@')
+                elif board[BODY, y, x]:
+                    row.append('o')
+                elif board[WALL, y, x]:
+                    row.append('#')
+                elif board[TARGET, y, x]:
+                    row.append(str(board[TARGET, y, x]))
+                else:
+                    row.append(' ')
+            rows.append("".join(row))
+        return "\n".join(rows) + "\n"
+
+def build_observation(state: wormstate.WormState):
+    """
+    Returns a new observation of state built from scratch, walking the
+    worm, the way a wrapper would without WormEnv. bench times the two
+    and with --check makes sure they agree.
+    """
+    board = np.zeros((CHANNELS, state.height, state.width), dtype=np.uint8)
+    for (x, y) in state.worm:
+        board[BODY, y, x] = 1
+    (x, y) = state.worm.head()
+    board[HEAD, y, x] = 1
+    for (x, y, value) in state.target_cells():
+        board[TARGET, y, x] = value
+    if state.level != None:
+        for (x, y) in state.level.wall_cells():
+            board[WALL, y, x] = 1
+    return board
+
+def layout(count: int, width: int, height: int):
+    """
+    Returns where the arrays of a VectorWormEnv go in its shared memory, as
+    a list of (name, shape, dtype, offset), and the bytes they take. Each
+    array starts on an 8 byte boundary.
+    """
+    arrays = []
+    offset = 0
+    for (name, shape, dtype) in (
+            ("observations", (count, CHANNELS, height, width), np.uint8),
+            ("actions", (count,), np.int64),
+            ("rewards", (count,), np.float64),
+            ("terminated", (count,), np.bool_),
+            ("truncated", (count,), np.bool_)):
+        arrays.append((name, shape, dtype, offset))
+        offset += (int(np.prod(shape)) * np.dtype(dtype).itemsize + 7) & ~7
+    return (arrays, offset)
+
+class SharedArrays(object):
+    """
+    The arrays of a VectorWormEnv in a block of shared memory: the
+    observations of count environments on boards of width by height, and
+    an action, reward, terminated flag and truncated flag for each
+    """
+
+    def __init__(self, buffer, count: int, width: int, height: int):
+        for (name, shape, dtype, offset) in layout(count, width,
+                height)[0]:
+            setattr(self, name, np.ndarray(shape, dtype=dtype,
+                buffer=buffer, offset=offset))
+
+def work(connection, memory, start: int, stop: int, count: int,
+        width: int, height: int, options: dict):
+    """
+    The body of a VectorWormEnv worker, running environments start to stop
+    on their slices of the shared arrays until told to close
+    """
+    level = options.pop("level", None)
+    if level != None:
+        level = wormlevel.Level.from_buffer(level)[0]
+    arrays = SharedArrays(memory.buf, count, width, height)
+    envs = [WormEnv(width, height, level=level,
+        buffer=arrays.observations[i], **options)
+        for i in range(start, stop)]
+    try:
+        while True:
+            command = connection.recv()
+            match command:
+                case ("step",):
+                    # Finished episodes start again at once, and only their
+                    # info goes back
+                    finished = []
+                    for (i, env) in enumerate(envs, start):
+                        (observation, reward, terminated, truncated,
+                            info) = env.step(int(arrays.actions[i]))
+                        arrays.rewards[i] = reward
+                        arrays.terminated[i] = terminated
+                        arrays.truncated[i] = truncated
+                        if terminated or truncated:
+                            info["steps"] = env.steps
+                            finished.append((i, info))
+                            env.reset()
+                    connection.send(finished)
+                case ("reset", seeds):
+                    for (env, seed) in zip(envs, seeds):
+                        env.reset(seed=seed)
+                    connection.send([])
+                case ("close",):
+                    return
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        del envs, arrays
+
+class VectorWormEnv(object):
+    """
+    count WormEnvs of the same size run by workers worker processes, with
+    their observations and results in shared memory. reset and step return
+    read-only views of the shared arrays, which the next step overwrites.
+    An environment whose episode ends starts a new one within the same
+    step, so its observation is already the new episode's and the info of
+    the one that ended is in the infos, keyed by environment.
+
+    The other arguments are as for WormEnv.
+    """
+
+    def __init__(self, count: int, width: int = 20, height: int = 10,
+            workers=None, max_steps=None, seed=None, level=None,
+            targets: int = 1, death_reward: float = DEATH_REWARD):
+        if level != None:
+            width = level.width
+            height = level.height
+        if workers == None:
+            workers = multiprocessing.cpu_count()
+        workers = max(1, min(workers, count))
+        self.count = count
+        self.width = width
+        self.height = height
+        self.seed = seed
+        self.memory = shared_memory.SharedMemory(create=True,
+            size=layout(count, width, height)[1])
+        self.arrays = SharedArrays(self.memory.buf, count, width, height)
+        self.observations = self.arrays.observations.view()
+        self.observations.flags.writeable = False
+        self.rewards = self.arrays.rewards.view()
+        self.rewards.flags.writeable = False
+        self.terminated = self.arrays.terminated.view()
+        self.terminated.flags.writeable = False
+        self.truncated = self.arrays.truncated.view()
+        self.truncated.flags.writeable = False
+
+        # Give each worker an even share of the environments. A level read
+        # from a pack can't be handed between processes, so its bytes are.
+        options = {"max_steps": max_steps, "targets": targets,
+            "death_reward": death_reward,
+            "level": level.to_bytes() if level != None else None}
+        self.connections = []
+        self.processes = []
+        self.ranges = []
+        for w in range(workers):
+            start = count * w // workers
+            stop = count * (w + 1) // workers
+            (connection, child) = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=work, args=(child,
+                self.memory, start, stop, count, width, height,
+                dict(options)), daemon=True)
+            process.start()
+            self.connections.append(connection)
+            self.processes.append(process)
+            self.ranges.append((start, stop))
+
+    def gather(self):
+        """Waits for every worker and returns the infos they sent back"""
+        infos = {}
+        for connection in self.connections:
+            for (i, info) in connection.recv():
+                infos[i] = info
+        return infos
+
+    def reset(self, seed=None):
+        """
+        Starts a new episode in every environment, environment i seeded
+        with seed + i if a seed is given, and returns the observations and
+        an empty info dict
+        """
+        if seed == None:
+            seed = self.seed
+        for (connection, (start, stop)) in zip(self.connections,
+                self.ranges):
+            seeds = [None if seed == None else seed + i
+                for i in range(start, stop)]
+            connection.send(("reset", seeds))
+        self.gather()
+        return (self.observations, {})
+
+    def step(self, actions):
+        """
+        Takes a step in every environment, environment i turning to
+        actions[i], and returns the observations, rewards, terminated and
+        truncated flags and the infos of the episodes that ended
+        """
+        self.arrays.actions[:] = actions
+        for connection in self.connections:
+            connection.send(("step",))
+        infos = self.gather()
+        return (self.observations, self.rewards, self.terminated,
+            self.truncated, infos)
+
+    def close(self):
+        """Stops the workers and frees the shared memory"""
+        for connection in self.connections:
+            try:
+                connection.send(("close",))
+            except (BrokenPipeError, OSError):
+                pass
+        for process in self.processes:
+            process.join(1)
+        self.connections = []
+        self.processes = []
+        del (self.arrays, self.observations, self.rewards, self.terminated,
+            self.truncated)
+        self.memory.close()
+        self.memory.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def bench_env(width: int, height: int, steps: int, seed: int = 0,
+        check: bool = False):
+    """
+    Times random play in a WormEnv and the same steps with each
+    observation built from scratch instead. Returns steps per second for
+    both. If check, the steps are then played again untimed, raising
+    AssertionError if WormEnv's observation ever differs from one built
+    from scratch.
+    """
+    rng = np.random.default_rng(seed)
+    actions = rng.integers(0, 4, steps)
+    results = {}
+    for name in ("in_place", "rebuilt"):
+        env = WormEnv(width, height, seed=seed)
+        env.reset()
+        start = time.perf_counter()
+        for action in actions.tolist():
+            (observation, reward, terminated, truncated,
+                info) = env.step(action)
+            if name == "rebuilt":
+                build_observation(env.state)
+            if terminated or truncated:
+                env.reset()
+        results[name] = steps / (time.perf_counter() - start)
+
+    if check:
+        env = WormEnv(width, height, seed=seed)
+        def agree(observation):
+            if not np.array_equal(observation, build_observation(env.state)):
+                raise AssertionError("WormEnv observation out of step with "
+                    "the game at tick %d" % env.state.ticks)
+        agree(env.reset()[0])
+        for action in actions.tolist():
+            (observation, reward, terminated, truncated,
+                info) = env.step(action)
+            agree(observation)
+            if terminated or truncated:
+                agree(env.reset()[0])
+    return results
+
+def bench_vector(count: int, workers, width: int, height: int, steps: int,
+        seed: int = 0):
+    """Times random play in a VectorWormEnv. Returns env steps per second."""
+    rng = np.random.default_rng(seed)
+    with VectorWormEnv(count, width, height, workers, seed=seed) as envs:
+        envs.reset()
+        start = time.perf_counter()
+        for i in range(steps):
+            envs.step(rng.integers(0, 4, count))
+        return count * steps / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description="Worm for learning agents")
+    commands = parser.add_subparsers(dest="command", required=True)
+    b = commands.add_parser("bench", help="time stepping environments")
+    b.add_argument("--width", type=int, default=80)
+    b.add_argument("--height", type=int, default=40)
+    b.add_argument("--steps", type=int, default=20000)
+    b.add_argument("--envs", type=int, default=0,
+        help="time a vector environment of this many (default: just one "
+        "environment in this process)")
+    b.add_argument("--workers", type=int, default=None)
+    b.add_argument("--check", action="store_true",
+        help="also check every observation against one built from scratch")
+    args = parser.parse_args()
+
+    if args.envs:
+        rate = bench_vector(args.envs, args.workers, args.width, args.height,
+            args.steps // args.envs or 1)
+        print("%d environments of %dx%d: %.0f steps/s" % (args.envs,
+            args.width, args.height, rate))
+    else:
+        rates = bench_env(args.width, args.height, args.steps,
+            check=args.check)
+        print("%dx%d: %.0f steps/s in place, %.0f steps/s rebuilding the "
+            "observation (%.1fx)" % (args.width, args.height,
+            rates["in_place"], rates["rebuilt"],
+            rates["in_place"] / rates["rebuilt"]))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+
+"""
+Levels: boards with walls in them, a spawn point for the worm and zones
+where targets appear.
+
+Levels are kept in level packs, binary files opened with mmap. Opening a
+pack only reads its header however many levels it holds, a level is only
+looked at when it's asked for, and every process playing from the same pack
+shares one read-only copy of it. The format is little endian:
+
+    magic       4 bytes  b"WLVL"
+    version     2 bytes  1
+    reserved    2 bytes
+    count       4 bytes  number of levels
+    offsets     8 bytes per level, where in the file each level starts
+
+and then the levels, each of which is
+
+    width       4 bytes  unsigned
+    height      4 bytes  unsigned
+    spawn       4 bytes each for x and y
+    zones       4 bytes  number of target zones
+    zone        16 bytes per zone: x, y, width and height
+    walls       a bit per cell, (width * height + 7) // 8 bytes, with cell
+                i = y * width + x in bit i & 7 of byte i >> 3
+
+A level with no zones gets its targets anywhere free. Levels are written as
+text, a line per row with every row as wide as the level, with '#' for a
+wall, '@' for the spawn point and a space for anything else, and any zones
+after the rows as "zone x y width height". An empty line starts the next
+level, while a row of spaces is just a row with no walls:
+
+    python wormlevel.py build levels.pack mazes.txt
+    python wormlevel.py generate levels.pack --count 5000 --size 80x20
+    python wormlevel.py show levels.pack 3
+"""
+
+import argparse
+import bisect
+import mmap
+import random
+import struct
+import sys
+import time
+
+MAGIC = b"WLVL"
+VERSION = 1
+HEADER = struct.Struct("<4sHHI")
+OFFSET = struct.Struct("<Q")
+LEVEL = struct.Struct("<IIIII")
+ZONE = struct.Struct("<IIII")
+
+class Level(object):
+    """
+    A board with walls. walls holds a bit per cell as in a level pack and
+    is a read-only view of the pack itself for a level that came from one.
+    spawn is the (x, y) the worm starts at and zones are the (x, y, width,
+    height) of the rectangles targets are placed in.
+
+    Raises ValueError if the walls don't cover the board, the spawn point
+    is off the board or in a wall, or a zone is empty or goes off the
+    board, as a game on such a level would go wrong later and far away.
+    """
+
+    def __init__(self, width: int, height: int, walls, spawn, zones=()):
+        self.width = width
+        self.height = height
+        self.walls = walls
+        self.spawn = spawn
+        self.zones = list(zones)
+
+        if width < 1 or height < 1:
+            raise ValueError("Level is %dx%d" % (width, height))
+        if len(walls) < (width * height + 7) // 8:
+            raise ValueError("Level walls don't cover its %dx%d cells" % (
+                width, height))
+        (x, y) = spawn
+        if not (0 <= x < width and 0 <= y < height):
+            raise ValueError("Level spawn point %d,%d is off the board" % (
+                x, y))
+        if self.is_wall(x, y):
+            raise ValueError("Level spawn point %d,%d is a wall" % (x, y))
+        for zone in self.zones:
+            (x, y, w, h) = zone
+            if (w < 1 or h < 1 or x < 0 or y < 0 or x + w > width or
+                    y + h > height):
+                raise ValueError("Level zone %d %d %d %d is empty or off "
+                    "the board" % zone)
+
+        # Number of cells in the zones up to and including each one, for
+        # picking a cell in them with a single draw
+        self.zone_ends = []
+        total = 0
+        for (x, y, w, h) in self.zones:
+            total += w * h
+            self.zone_ends.append(total)
+
+    def is_wall(self, x: int, y: int):
+        """Returns true if the cell at x, y is a wall"""
+        i = y * self.width + x
+        return self.walls[i >> 3] >> (i & 7) & 1
+
+    def wall_cells(self):
+        """Yields the (x, y) of every wall"""
+        width = self.width
+        for (i, byte) in enumerate(self.walls):
+            while byte:
+                low = byte & -byte
+                cell = i << 3 | low.bit_length() - 1
+                yield (cell % width, cell // width)
+                byte ^= low
+
+    def zone_cell(self, prng: random.Random):
+        """
+        Returns the (x, y) of a cell chosen with prng from the zones, every
+        cell in them being as likely, or None if there are no zones.
+        """
+        if not self.zone_ends:
+            return None
+        n = prng.randrange(self.zone_ends[-1])
+        i = bisect.bisect_right(self.zone_ends, n)
+        if i > 0:
+            n -= self.zone_ends[i - 1]
+        (x, y, w, h) = self.zones[i]
+        return (x + n % w, y + n // w)
+
+    def to_bytes(self):
+        """Returns the level in the binary format"""
+        data = bytearray(LEVEL.pack(self.width, self.height, self.spawn[0],
+            self.spawn[1], len(self.zones)))
+        for zone in self.zones:
+            data += ZONE.pack(*zone)
+        data += self.walls
+        return bytes(data)
+
+    @classmethod
+    def from_buffer(cls, buffer, offset: int = 0):
+        """
+        Returns the level in the binary format at offset in buffer, and the
+        offset just after it. The walls are a view of buffer rather than a
+        copy.
+        """
+        (width, height, x, y, count) = LEVEL.unpack_from(buffer, offset)
+        offset += LEVEL.size
+        zones = [ZONE.unpack_from(buffer, offset + i * ZONE.size)
+            for i in range(count)]
+        offset += count * ZONE.size
+        end = offset + (width * height + 7) // 8
+        walls = memoryview(buffer)[offset:end].toreadonly()
+        if len(walls) != end - offset:
+            raise ValueError("Level is cut short")
+        return (cls(width, height, walls, (x, y), zones), end)
+
+    @classmethod
+    def from_text(cls, text: str):
+        """
+        Parses a level written as text. Raises ValueError if its rows
+        aren't all the same width. Without an '@' the worm starts in the
+        middle, which must then be free.
+        """
+        rows = []
+        zones = []
+        for line in text.strip("\n").splitlines():
+            if line.startswith("zone"):
+                zone = tuple(int(n) for n in line.split()[1:])
+                if len(zone) != 4:
+                    raise ValueError("Level zone %r isn't x y width height"
+                        % line)
+                zones.append(zone)
+            else:
+                rows.append(line)
+        if not rows:
+            raise ValueError("Level has no rows")
+        width = len(rows[0])
+        height = len(rows)
+        for (y, row) in enumerate(rows):
+            if len(row) != width:
+                raise ValueError("Level row %d is %d wide, not %d" % (y,
+                    len(row), width))
+        walls = bytearray((width * height + 7) // 8)
+        spawn = (width // 2, height // 2)
+        for (y, row) in enumerate(rows):
+            for (x, c) in enumerate(row):
+                i = y * width + x
+                if c == '#':
+                    walls[i >> 3] |= 1 << (i & 7)
+                elif c == '@':
+                    spawn = (x, y)
+        return cls(width, height, bytes(walls), spawn, zones)
+
+    def to_text(self):
+        """Returns the level written as text"""
+        rows = []
+        for y in range(self.height):
+            row = ['#' if self.is_wall(x, y) else ' '
+                for x in range(self.width)]
+            if y == self.spawn[1]:
+                row[self.spawn[0]] = '@'
+            rows.append("".join(row))
+        rows.extend("zone %d %d %d %d" % zone for zone in self.zones)
+        return "\n".join(rows) + "\n"
+
+class LevelPack(object):
+    """
+    A level pack opened read-only with mmap. Levels are read from it as
+    they are asked for, by index.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, reserved, self.count) = HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a version %d worm level pack" % VERSION)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index: int):
+        """Returns level index of the pack"""
+        if not -self.count <= index < self.count:
+            raise IndexError("No level %d in %s" % (index, self.path))
+        (offset,) = OFFSET.unpack_from(self.map,
+            HEADER.size + OFFSET.size * (index % self.count))
+        return Level.from_buffer(self.map, offset)[0]
+
+# Level packs already opened by this process, by path
+packs = {}
+
+def open_pack(path: str):
+    """
+    Returns the LevelPack at path, opening it only the first time it's
+    asked for in each process
+    """
+    pack = packs.get(path)
+    if pack == None:
+        pack = packs[path] = LevelPack(path)
+    return pack
+
+def write_pack(path: str, levels):
+    """Writes levels to path as a level pack"""
+    blobs = [level.to_bytes() for level in levels]
+    offset = HEADER.size + OFFSET.size * len(blobs)
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, 0, len(blobs)))
+        for blob in blobs:
+            f.write(OFFSET.pack(offset))
+            offset += len(blob)
+        for blob in blobs:
+            f.write(blob)
+
+def read_text(text: str):
+    """Returns the levels in text, separated by empty lines"""
+    levels = []
+    lines = []
+    for line in text.splitlines() + [""]:
+        if line:
+            lines.append(line)
+        elif lines:
+            levels.append(Level.from_text("\n".join(lines)))
+            lines = []
+    return levels
+
+def generate(width: int, height: int, seed: int, boxes: int = 8):
+    """
+    Returns a level with a wall around the edge and boxes random blocks of
+    wall, keeping the middle row clear for the worm to start on
+    """
+    prng = random.Random(seed)
+    walls = bytearray((width * height + 7) // 8)
+    def wall(x, y):
+        i = y * width + x
+        walls[i >> 3] |= 1 << (i & 7)
+    for x in range(width):
+        wall(x, 0)
+        wall(x, height - 1)
+    for y in range(height):
+        wall(0, y)
+        wall(width - 1, y)
+    for i in range(boxes):
+        w = prng.randint(1, max(width // 8, 1))
+        h = prng.randint(1, max(height // 4, 1))
+        x = prng.randrange(width - w + 1)
+        y = prng.randrange(height - h + 1)
+        for by in range(y, y + h):
+            if by != height // 2:
+                for bx in range(x, x + w):
+                    wall(bx, by)
+    spawn = (width // 4, height // 2)
+    return Level(width, height, bytes(walls), spawn,
+        [(1, 1, width - 2, height - 2)])
+
+def main():
+    parser = argparse.ArgumentParser(description="Worm level packs")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build",
+        help="build a level pack from levels written as text")
+    build.add_argument("pack")
+    build.add_argument("text", nargs="+")
+    gen = commands.add_parser("generate",
+        help="build a level pack of random levels")
+    gen.add_argument("pack")
+    gen.add_argument("--count", type=int, default=1000)
+    gen.add_argument("--size", default="80x20", help="WIDTHxHEIGHT")
+    gen.add_argument("--seed", type=int, default=0)
+    show = commands.add_parser("show", help="print a level of a pack")
+    show.add_argument("pack")
+    show.add_argument("index", type=int, nargs="?", default=0)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        levels = []
+        for path in args.text:
+            with open(path) as f:
+                levels.extend(read_text(f.read()))
+        write_pack(args.pack, levels)
+        print("Wrote %d levels to %s" % (len(levels), args.pack))
+    elif args.command == "generate":
+        (width, height) = (int(n) for n in args.size.lower().split("x"))
+        write_pack(args.pack, (generate(width, height, args.seed + i)
+            for i in range(args.count)))
+        start = time.perf_counter()
+        pack = LevelPack(args.pack)
+        pack[len(pack) - 1]
+        print("Wrote %d levels to %s, reopened and read the last in "
+            "%.0fus" % (len(pack), args.pack,
+            (time.perf_counter() - start) * 1e6))
+    else:
+        sys.stdout.write(open_pack(args.pack)[args.index].to_text())
+
+if __name__ == "__main__":
+    main()
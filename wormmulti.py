@@ -0,0 +1,493 @@
+#!/usr/bin/env python3
+
+"""
+Multiplayer worm: an authoritative server with many worms on one board.
+
+The server owns the board and runs the game at a fixed tick rate. Clients
+connect over TCP, send single byte direction codes from wormstate (or
+RESPAWN to get a new worm after dying) and receive the board as binary
+frames. A keyframe lists every non-empty cell and is sent when a client
+joins, every KEYFRAME_INTERVAL ticks and to any client that fell behind.
+Every other tick only the cells that changed are sent.
+
+All numbers are little endian. On joining a client receives
+
+    b"H", worm id u16, width u16, height u16
+
+and after that one frame per tick
+
+    b"K" or b"D", tick u32, score u32, alive u8, count u32,
+    count times (cell u32, value u16)
+
+where cell is y * width + x and value is EMPTY, a target value from 1 to
+9, or WORM + 2 * worm id for a body segment plus one for a head. Worm ids
+of players that left are given to new players and the tick and score
+wrap around at 2**32.
+
+    python wormmulti.py serve [--port N] [--width W] [--height H]
+    python wormmulti.py play [--port N]
+    python wormmulti.py load [--clients N] [--seconds S]
+"""
+
+import argparse
+import asyncio
+import collections
+import heapq
+import random
+import struct
+import time
+
+import wormstate
+
+# Cell values sent to clients
+EMPTY = 0
+WORM = 16
+
+# Byte a client sends to get a new worm
+RESPAWN = 4
+
+# Ticks between keyframes
+KEYFRAME_INTERVAL = 50
+
+# Bytes a client may have waiting to be sent before frames to it are
+# skipped and it is sent a keyframe once it catches up
+WRITE_LIMIT = 256 * 1024
+
+# Worm numbers whose cell values still fit in a CELL's u16
+MAX_WORMS = (0x10000 - WORM) // 2
+
+HELLO = struct.Struct("<cHHH")
+FRAME = struct.Struct("<cIIBI")
+CELL = struct.Struct("<IH")
+
+class Worm(object):
+    """One player's worm on a SharedBoard"""
+
+    def __init__(self, number: int):
+        self.number = number
+        self.body = collections.deque()     # Cells from tail to head
+        self.direction = wormstate.RIGHT
+        self.grow_count = 0
+        self.score = 0
+        self.alive = False
+
+class SharedBoard(object):
+    """
+    The state of a multiplayer game: many worms and a few targets on one
+    board, following the rules of wormstate.WormState. A worm dies when it
+    runs into a wall or into any worm's body, and worms whose heads move
+    into the same cell all die. Dead worms disappear from the board.
+
+    Every change to a cell is noted in changes so that the server only has
+    to send those.
+    """
+
+    def __init__(self, width: int, height: int, targets: int = 4,
+            seed=None):
+        self.width = width
+        self.height = height
+        self.cells = wormstate.CellIndex(width, height)
+        self.prng = random.Random(seed)
+        self.worms = {}
+        self.targets = {}       # Cell to target value
+        self.ticks = 0
+        self.display = {}       # Every non-empty cell to its value
+        self.changes = {}       # Cell to new value since the last tick
+        for i in range(targets):
+            self.spawn_target()
+
+    def set_cell(self, cell: int, value: int):
+        """Notes the new value of a cell"""
+        if value == EMPTY:
+            self.display.pop(cell, None)
+        else:
+            self.display[cell] = value
+        self.changes[cell] = value
+
+    def spawn_target(self):
+        """Puts a new target on a free cell that doesn't have one"""
+        for attempt in range(100):
+            xy = self.cells.random_free(self.prng)
+            if xy == None:
+                return
+            cell = xy[1] * self.width + xy[0]
+            if cell not in self.targets:
+                value = self.prng.randint(1, 9)
+                self.targets[cell] = value
+                self.set_cell(cell, value)
+                return
+
+    def add_worm(self, number: int):
+        """Adds a worm for a new player. It starts dead."""
+        worm = self.worms[number] = Worm(number)
+        return worm
+
+    def remove_worm(self, number: int):
+        """Takes a player's worm off the board"""
+        worm = self.worms.pop(number)
+        if worm.alive:
+            self.kill(worm)
+
+    def spawn(self, worm: Worm):
+        """Puts a dead worm back on the board as a single segment"""
+        if worm.alive:
+            return
+        for attempt in range(100):
+            xy = self.cells.random_free(self.prng)
+            if xy == None:
+                return
+            cell = xy[1] * self.width + xy[0]
+            if cell not in self.targets:
+                break
+        else:
+            return
+        self.cells.occupy(*xy)
+        worm.body.clear()
+        worm.body.append(cell)
+        worm.grow_count = 0
+        worm.direction = self.prng.randrange(4)
+        worm.alive = True
+        self.set_cell(cell, WORM + 2 * worm.number + 1)
+
+    def kill(self, worm: Worm):
+        """Takes a worm off the board"""
+        worm.alive = False
+        for cell in worm.body:
+            self.cells.vacate(cell % self.width, cell // self.width)
+            self.set_cell(cell, EMPTY)
+        worm.body.clear()
+
+    def step(self):
+        """
+        Advances every living worm by one step. Returns the cells that
+        changed as a dict of cell to value.
+        """
+        self.ticks += 1
+        width = self.width
+        height = self.height
+
+        # Work out where every head goes and kill those that hit something
+        moves = {}
+        dying = []
+        for worm in self.worms.values():
+            if not worm.alive:
+                continue
+            head = worm.body[-1]
+            dx, dy = wormstate.DIRECTIONS[worm.direction]
+            x = head % width + dx
+            y = head // width + dy
+            if (x < 0 or x >= width or y < 0 or y >= height or
+                    self.cells.occupied[y * width + x]):
+                dying.append(worm)
+                continue
+            moves.setdefault(y * width + x, []).append(worm)
+
+        # Heads that meet in the same cell all die
+        for cell, worms in list(moves.items()):
+            if len(worms) > 1:
+                dying.extend(worms)
+                del moves[cell]
+        for worm in dying:
+            self.kill(worm)
+
+        # Move the rest
+        eaten = 0
+        for cell, (worm,) in moves.items():
+            self.set_cell(worm.body[-1], WORM + 2 * worm.number)
+            worm.body.append(cell)
+            self.cells.occupy(cell % width, cell // width)
+            self.set_cell(cell, WORM + 2 * worm.number + 1)
+            if worm.grow_count == 0:
+                tail = worm.body.popleft()
+                self.cells.vacate(tail % width, tail // width)
+                self.set_cell(tail, EMPTY)
+            else:
+                worm.grow_count -= 1
+            value = self.targets.pop(cell, None)
+            if value != None:
+                worm.grow_count += value
+                worm.score += value
+                eaten += 1
+        for i in range(eaten):
+            self.spawn_target()
+
+        changes = self.changes
+        self.changes = {}
+        return changes
+
+def encode_cells(cells):
+    """Packs (cell, value) pairs for a frame"""
+    data = bytearray(CELL.size * len(cells))
+    offset = 0
+    for cell, value in cells:
+        CELL.pack_into(data, offset, cell, value)
+        offset += CELL.size
+    return data
+
+class Player(object):
+    """A connected client"""
+
+    def __init__(self, worm: Worm, writer):
+        self.worm = worm
+        self.writer = writer
+        self.needs_keyframe = True
+        self.bytes_sent = 0
+
+class Server(object):
+    """
+    Runs a SharedBoard at a fixed tick rate and keeps the connected
+    players in sync with it.
+    """
+
+    def __init__(self, board: SharedBoard, rate: float):
+        self.board = board
+        self.interval = 1 / rate
+        self.players = {}
+        self.next_number = 0
+        self.free_numbers = []  # Heap of numbers players have given back
+        self.tick_times = []
+
+    async def serve(self, host: str, port: int):
+        """Accepts players and runs the game until cancelled"""
+        server = await asyncio.start_server(self.handle_player, host, port,
+            backlog=1024)
+        async with server:
+            await self.run()
+
+    async def handle_player(self, reader, writer):
+        """Sets up a new player and applies its input until it leaves"""
+        if self.free_numbers:
+            number = heapq.heappop(self.free_numbers)
+        elif self.next_number < MAX_WORMS:
+            number = self.next_number
+            self.next_number += 1
+        else:
+            # Every worm number is taken so there's no room for this player
+            writer.close()
+            return
+        worm = self.board.add_worm(number)
+        self.board.spawn(worm)
+        self.players[number] = Player(worm, writer)
+        writer.write(HELLO.pack(b"H", number, self.board.width,
+            self.board.height))
+        try:
+            while True:
+                data = await reader.read(64)
+                if not data:
+                    break
+                for code in data:
+                    if code < 4:
+                        worm.direction = code
+                    elif code == RESPAWN:
+                        self.board.spawn(worm)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            del self.players[number]
+            self.board.remove_worm(number)
+            heapq.heappush(self.free_numbers, number)
+            writer.close()
+
+    async def run(self):
+        """Ticks the game at a steady rate"""
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        while True:
+            next_tick += self.interval
+            delay = next_tick - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                # Running late. Don't try to make up for lost ticks.
+                next_tick = loop.time()
+            start = time.perf_counter()
+            self.tick()
+            self.tick_times.append(time.perf_counter() - start)
+
+    def tick(self):
+        """Advances the board and sends every player its frame"""
+        board = self.board
+        changes = board.step()
+        keyframe = board.ticks % KEYFRAME_INTERVAL == 0
+        delta = None
+        full = None
+        for player in self.players.values():
+            transport = player.writer.transport
+            if transport.is_closing():
+                continue
+            if transport.get_write_buffer_size() > WRITE_LIMIT:
+                # Skip frames until this player catches up
+                player.needs_keyframe = True
+                continue
+            if keyframe or player.needs_keyframe:
+                if full == None:
+                    full = encode_cells(board.display.items())
+                kind, cells, count = b"K", full, len(board.display)
+                player.needs_keyframe = False
+            else:
+                if delta == None:
+                    delta = encode_cells(changes.items())
+                kind, cells, count = b"D", delta, len(changes)
+            worm = player.worm
+            header = FRAME.pack(kind, board.ticks & 0xFFFFFFFF,
+                worm.score & 0xFFFFFFFF, worm.alive, count)
+            player.writer.write(header)
+            player.writer.write(cells)
+            player.bytes_sent += len(header) + len(cells)
+
+    def report(self):
+        """Returns a summary of the tick times so far"""
+        times = sorted(self.tick_times)
+        if not times:
+            return "no ticks"
+        return ("%d ticks, %d players: tick time p50 %.3fms p99 %.3fms "
+            "max %.3fms (budget %.3fms)" % (len(times), len(self.players),
+            times[len(times) // 2] * 1000,
+            times[len(times) * 99 // 100] * 1000, times[-1] * 1000,
+            self.interval * 1000))
+
+async def read_frame(reader):
+    """Reads one frame. Returns (kind, tick, score, alive, cells)"""
+    header = await reader.readexactly(FRAME.size)
+    (kind, tick, score, alive, count) = FRAME.unpack(header)
+    data = await reader.readexactly(count * CELL.size)
+    return (kind, tick, score, alive, data)
+
+async def load_client(host: str, port: int, seconds: float, stats: dict):
+    """
+    A headless player that turns at random and respawns when it dies,
+    counting what it receives.
+    """
+    (reader, writer) = await asyncio.open_connection(host, port)
+    await reader.readexactly(HELLO.size)
+    prng = random.Random()
+    end = time.monotonic() + seconds
+    last = None
+    while time.monotonic() < end:
+        (kind, tick, score, alive, data) = await read_frame(reader)
+        now = time.monotonic()
+        stats["frames"] += 1
+        stats["bytes"] += FRAME.size + len(data)
+        if kind == b"K":
+            stats["keyframes"] += 1
+        if last != None:
+            stats["gaps"].append(now - last)
+        last = now
+        if not alive:
+            writer.write(bytes([RESPAWN]))
+        elif prng.random() < 0.2:
+            writer.write(bytes([prng.randrange(4)]))
+    writer.close()
+
+async def load(host: str, port: int, clients: int, seconds: float):
+    """Runs clients headless players and reports what they saw"""
+    stats = {"frames": 0, "bytes": 0, "keyframes": 0, "gaps": []}
+    await asyncio.gather(*[load_client(host, port, seconds, stats)
+        for i in range(clients)])
+    gaps = sorted(stats["gaps"])
+    if not gaps:
+        print("%d clients for %.0fs: no frames received" % (clients,
+            seconds))
+        return
+    print("%d clients for %.0fs: %.1f frames/s and %.0f bytes/s per "
+        "client, %d keyframes, frame gap p50 %.1fms p99 %.1fms" % (
+        clients, seconds, stats["frames"] / clients / seconds,
+        stats["bytes"] / clients / seconds, stats["keyframes"],
+        gaps[len(gaps) // 2] * 1000, gaps[len(gaps) * 99 // 100] * 1000))
+
+async def play(host: str, port: int):
+    """Plays on a server in the terminal with curses"""
+    import curses
+
+    (reader, writer) = await asyncio.open_connection(host, port)
+    (_, number, width, height) = HELLO.unpack(
+        await reader.readexactly(HELLO.size))
+    stdscr = curses.initscr()
+    curses.noecho()
+    curses.cbreak()
+    curses.curs_set(0)
+    stdscr.keypad(True)
+    stdscr.nodelay(True)
+    moves = {curses.KEY_LEFT: wormstate.LEFT, ord('h'): wormstate.LEFT,
+        curses.KEY_DOWN: wormstate.DOWN, ord('j'): wormstate.DOWN,
+        curses.KEY_UP: wormstate.UP, ord('k'): wormstate.UP,
+        curses.KEY_RIGHT: wormstate.RIGHT, ord('l'): wormstate.RIGHT}
+    mine = (WORM + 2 * number, WORM + 2 * number + 1)
+    try:
+        while True:
+            (kind, tick, score, alive, data) = await read_frame(reader)
+            if kind == b"K":
+                stdscr.erase()
+            for offset in range(0, len(data), CELL.size):
+                (cell, value) = CELL.unpack_from(data, offset)
+                if value == EMPTY:
+                    c = ' '
+                elif value < WORM:
+                    c = str(value)
+                elif value in mine:
+                    c = '@' if value & 1 else 'o'
+                else:
+                    c = '#' if value & 1 else '+'
+                try:
+                    stdscr.addch(cell // width + 1, cell % width, c)
+                except curses.error:
+                    pass
+            status = "Score: %d" % score
+            if not alive:
+                status += "  You died! Hit R to respawn or Q to quit"
+            stdscr.move(0, 0)
+            stdscr.clrtoeol()
+            stdscr.addstr(0, 0, status)
+            stdscr.refresh()
+            ch = stdscr.getch()
+            while ch != -1:
+                if ch in moves:
+                    writer.write(bytes([moves[ch]]))
+                elif ch in (ord('r'), ord('R')):
+                    writer.write(bytes([RESPAWN]))
+                elif ch in (ord('q'), ord('Q')):
+                    return
+                ch = stdscr.getch()
+    finally:
+        writer.close()
+        stdscr.keypad(False)
+        curses.curs_set(1)
+        curses.nocbreak()
+        curses.echo()
+        curses.endwin()
+
+def main():
+    parser = argparse.ArgumentParser(description="Multiplayer worm")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7777)
+    commands = parser.add_subparsers(dest="command", required=True)
+    s = commands.add_parser("serve", help="run a server")
+    s.add_argument("--width", type=int, default=200)
+    s.add_argument("--height", type=int, default=60)
+    s.add_argument("--targets", type=int, default=16)
+    s.add_argument("--rate", type=float, default=20.0,
+        help="ticks per second")
+    s.add_argument("--seconds", type=float, default=None,
+        help="stop after this long and report tick times")
+    commands.add_parser("play", help="join a server and play")
+    l = commands.add_parser("load", help="measure a server with bots")
+    l.add_argument("--clients", type=int, default=64)
+    l.add_argument("--seconds", type=float, default=10.0)
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        board = SharedBoard(args.width, args.height, args.targets)
+        server = Server(board, args.rate)
+        try:
+            asyncio.run(asyncio.wait_for(server.serve(args.host, args.port),
+                args.seconds))
+        except (KeyboardInterrupt, asyncio.TimeoutError):
+            pass
+        print(server.report())
+    elif args.command == "play":
+        asyncio.run(play(args.host, args.port))
+    else:
+        asyncio.run(load(args.host, args.port, args.clients, args.seconds))
+
+if __name__ == "__main__":
+    main()
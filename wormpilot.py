@@ -0,0 +1,396 @@
+"""
+An autopilot that plays worm by itself.
+
+Autopilot is a policy in the sense of wormsim: called with a WormState it
+returns the direction to go next, or None to keep going.
+
+It steers along a cycle that visits every cell of the board. Once the body
+lies along the cycle in order the worm can never be trapped, however long
+it gets, as long as every move goes forward along the cycle without
+skipping past its own tail. Within that rule it finds a path to the target
+with A* and keeps following it on later calls, only planning again when
+the target moves or the next cell of the path is taken. When there is no
+such path it cuts across the cycle as far toward the target as it safely
+can, which is just a handful of lookups.
+
+Boards with no cycle, with an odd number of both rows and columns, and
+levels with walls get plain paths to the target and a move into the most
+room when there are none.
+
+However big the board or long the worm, a decision looks at no more than
+PLAN_LIMIT cells with A* and counts no more than FLOOD_LIMIT cells of
+room. On a slow machine A* took about 0.5ms on average and counting room
+about 0.6ms. Following a path takes a few microseconds, but on a board
+with no cycle a long worm counts room on about half its moves, so on
+201x61 the median decision took from 4us to 0.5ms depending on the game,
+the 99th percentile 1 to 1.5ms and the slowest a few milliseconds, mostly
+from the process being preempted.
+
+    python pyworm.py simulate --policy wormpilot:autopilot
+"""
+
+import collections
+import heapq
+import weakref
+
+import wormstate
+
+# Most cells A* looks at before giving up on finding a path
+PLAN_LIMIT = 300
+
+# Ticks to wait after failing to find a path before trying again. The wait
+# doubles with each failure in a row, up to the longest.
+RETRY_TICKS = 8
+LONGEST_RETRY = 256
+
+# Cells kept free between the head and the tail when moving forward along
+# the cycle, on top of what the worm is due to grow. This covers eating
+# the biggest target with a little to spare.
+SLACK = 9 + 4
+
+# Past this much of the board the worm stops cutting across the cycle. The
+# cells it skips stay free behind it until its tail gets to them, so a long
+# worm that keeps skipping can run out of room ahead even with the board
+# far from full.
+SHORTCUT_LIMIT = 0.5
+
+# Most cells counted when measuring how much room each move leaves, for all
+# the moves together
+FLOOD_LIMIT = 512
+
+# Direction codes by the (dx, dy) they move the head by
+DIRECTION_CODES = {d: code for code, d in enumerate(wormstate.DIRECTIONS)}
+
+class Autopilot(object):
+    """
+    Steers a WormState toward its target. Keep one per game, as it
+    remembers its path between calls.
+    """
+
+    def __init__(self):
+        self.plans = 0                      # Number of times A* was run
+        self.forget()
+
+    def forget(self):
+        """Drops everything remembered about the game being played"""
+        self.path = collections.deque()     # Cells still to go to the goal
+        self.goal = None                    # Cell the path leads to
+        self.retry_tick = 0                 # Tick to plan again after
+        self.retry_wait = RETRY_TICKS
+        self.aligned = 0                    # Moves in a row along the cycle
+        self.ticks = -1                     # Tick of the last decision
+
+    def __call__(self, state: wormstate.WormState):
+        """Returns the direction code to take next, or None"""
+        if state.ticks < self.ticks:
+            # New game
+            self.forget()
+        self.ticks = state.ticks
+        head = state.worm.head()
+
+        # The worm lies along the cycle in order once each of its segments
+        # got where it is by a move forward along it. Until then just
+        # follow the cycle.
+        cycle = Cycle.of(state)
+        if cycle != None and self.aligned < len(state.worm):
+            cell = cycle.next(*head)
+            if not free(state, *cell):
+                self.aligned = 0
+                return survive(state, head)
+            self.aligned += 1
+            return direction(head, cell)
+
+        path = self.path
+        if path and path[0] == head:
+            path.popleft()
+        goal = None
+        if state.target_value != None:
+            goal = (state.target_x, state.target_y)
+        if goal != self.goal:
+            self.goal = goal
+            path.clear()
+            self.retry_tick = 0
+        if path and not usable(state, head, path[0]):
+            path.clear()
+
+        if (cycle != None and len(state.worm) + state.grow_count >
+                SHORTCUT_LIMIT * cycle.cells):
+            # Stick to the cycle from here on
+            self.aligned += 1
+            return direction(head, cycle.next(*head))
+
+        if not path and goal != None and state.ticks >= self.retry_tick:
+            self.plans += 1
+            found = find_path(state, head, goal, PLAN_LIMIT, cycle)
+            if found == None:
+                self.retry_tick = state.ticks + self.retry_wait
+                self.retry_wait = min(2 * self.retry_wait, LONGEST_RETRY)
+            else:
+                self.retry_wait = RETRY_TICKS
+                path.extend(found)
+
+        if cycle == None:
+            if path:
+                return direction(head, path[0])
+            return survive(state, head)
+
+        d = cycle.shortcut(state, head) if not path else direction(head,
+            path[0])
+        if d == None:
+            self.aligned = 0
+            return survive(state, head)
+        self.aligned += 1
+        return d
+
+# One Autopilot per game for the autopilot policy function
+pilots = weakref.WeakKeyDictionary()
+
+def autopilot(state: wormstate.WormState):
+    """
+    The autopilot as a plain policy function, keeping an Autopilot for each
+    WormState it is called with.
+    """
+    pilot = pilots.get(state)
+    if pilot == None:
+        pilot = pilots[state] = Autopilot()
+    return pilot(state)
+
+class Cycle(object):
+    """
+    A cycle that visits every cell of a board once. Rows are swept back and
+    forth from column 1 and column 0 leads back to the top, which needs an
+    even number of rows. Boards with an odd number of rows but an even
+    number of columns use the same cycle turned on its side, and boards
+    with both odd have no such cycle at all.
+    """
+
+    # Cycles already worked out by board size
+    cycles = {}
+
+    @classmethod
+    def of(cls, state: wormstate.WormState):
+        """
+        Returns the Cycle for the board of state, or None. Levels have
+        walls in the way, so they get None too.
+        """
+        if state.level != None:
+            return None
+        size = (state.width, state.height)
+        if size not in cls.cycles:
+            (w, h) = size
+            if h % 2 == 0 and w > 1:
+                cls.cycles[size] = cls(w, h, False)
+            elif w % 2 == 0 and h > 1:
+                cls.cycles[size] = cls(h, w, True)
+            else:
+                cls.cycles[size] = None
+        return cls.cycles[size]
+
+    def __init__(self, width: int, height: int, transposed: bool):
+        # The width and height of the board with rows and columns swapped
+        # if transposed
+        self.width = width
+        self.height = height
+        self.transposed = transposed
+        self.cells = width * height
+
+    def index(self, x: int, y: int):
+        """Returns the position of x, y along the cycle"""
+        if self.transposed:
+            (x, y) = (y, x)
+        if x == 0:
+            return self.height * (self.width - 1) + self.height - 1 - y
+        if y % 2 == 0:
+            return y * (self.width - 1) + x - 1
+        return y * (self.width - 1) + self.width - 1 - x
+
+    def next(self, x: int, y: int):
+        """Returns the cell after x, y along the cycle"""
+        if self.transposed:
+            (y, x) = self.next_rows(y, x)
+            return (x, y)
+        return self.next_rows(x, y)
+
+    def next_rows(self, x: int, y: int):
+        if x == 0:
+            return (1, 0) if y == 0 else (0, y - 1)
+        if y % 2 == 0:
+            return (x + 1, y) if x < self.width - 1 else (x, y + 1)
+        if x > 1 or y == self.height - 1:
+            return (x - 1, y)
+        return (x, y + 1)
+
+    def room(self, state: wormstate.WormState, head):
+        """
+        Returns how far ahead of head along the cycle a move can go while
+        leaving enough room between the head and the tail
+        """
+        h = self.index(*head)
+        gap = (self.index(*state.worm.tail()) - h) % self.cells or self.cells
+        return gap - state.grow_count - SLACK
+
+    def ahead(self, head, x: int, y: int):
+        """Returns how far x, y is ahead of head along the cycle"""
+        return (self.index(x, y) - self.index(*head)) % self.cells
+
+    def shortcut(self, state: wormstate.WormState, head):
+        """
+        Returns the direction that gets the head furthest along the cycle
+        toward the target without passing it or leaving too little room.
+        The worm must lie along the cycle in order. Returns None if the
+        next cell along the cycle is taken and there's no other way on.
+        """
+        room = self.room(state, head)
+        goal = self.cells - 1
+        if state.target_value != None:
+            goal = self.ahead(head, state.target_x, state.target_y)
+        best = None
+        best_ahead = 0
+        for d, (dx, dy) in enumerate(wormstate.DIRECTIONS):
+            (x, y) = (head[0] + dx, head[1] + dy)
+            if not free(state, x, y):
+                continue
+            ahead = self.ahead(head, x, y)
+            if ahead == 1 or (best_ahead < ahead <= goal and ahead < room):
+                if ahead > best_ahead:
+                    best = d
+                    best_ahead = ahead
+        return best
+
+def direction(head, cell):
+    """Returns the direction code that moves head into cell next to it"""
+    return DIRECTION_CODES[(cell[0] - head[0], cell[1] - head[1])]
+
+def usable(state: wormstate.WormState, head, cell):
+    """Returns True if the worm can move from head into cell"""
+    (x, y) = cell
+    return abs(x - head[0]) + abs(y - head[1]) == 1 and free(state, x, y)
+
+def free(state: wormstate.WormState, x: int, y: int):
+    """Returns True if x, y is on the board and not taken by the worm"""
+    return (0 <= x < state.width and 0 <= y < state.height and
+        not state.cells.is_occupied(x, y))
+
+def find_path(state: wormstate.WormState, start, goal, limit: int,
+        cycle=None):
+    """
+    Returns the cells of a shortest path from start to goal that avoids the
+    worm and the walls, not including start, or None if there isn't one or
+    more than limit cells had to be looked at to find it. The worm is taken
+    to stay where it is, which only errs on the side of caution since its
+    tail moves out of the way as it goes.
+
+    If a Cycle is given the path must also keep going forward along it and
+    leave enough room behind the tail, as Cycle.shortcut does.
+    """
+    width = state.width
+    height = state.height
+    is_occupied = state.cells.is_occupied
+    (gx, gy) = goal
+    came_from = {start: None}
+    cost = {start: 0}
+    if cycle != None:
+        room = min(cycle.room(state, start), cycle.ahead(start, gx, gy) + 1)
+        order = {start: 0}
+
+    # Ties between equally promising cells go to the one furthest along, so
+    # on an open board this heads straight for the goal
+    heap = [(abs(start[0] - gx) + abs(start[1] - gy), 0, start)]
+    looked = 0
+    while heap:
+        (f, g, cell) = heapq.heappop(heap)
+        g = -g
+        if cell == goal:
+            path = []
+            while cell != start:
+                path.append(cell)
+                cell = came_from[cell]
+            path.reverse()
+            return path
+        if g > cost[cell]:
+            continue
+        looked += 1
+        if looked > limit:
+            return None
+        (x, y) = cell
+        g += 1
+        for (dx, dy) in wormstate.DIRECTIONS:
+            nx = x + dx
+            ny = y + dy
+            if (nx < 0 or nx >= width or ny < 0 or ny >= height or
+                    is_occupied(nx, ny)):
+                continue
+            n = (nx, ny)
+            if cycle != None:
+                ahead = cycle.ahead(start, nx, ny)
+                if not order[cell] < ahead < room:
+                    continue
+            if g < cost.get(n, g + 1):
+                cost[n] = g
+                came_from[n] = cell
+                if cycle != None:
+                    order[n] = ahead
+                heapq.heappush(heap,
+                    (g + abs(nx - gx) + abs(ny - gy), -g, n))
+    return None
+
+def survive(state: wormstate.WormState, head):
+    """
+    Picks a move when neither a path nor the cycle will do: into whichever
+    free neighbor leads to the most room. Room for the whole worm, what it
+    is due to grow and SLACK is enough, so the first move found with that
+    much is taken without counting any further, and a neighbor in a space
+    already counted has no more room than the move that counted it. Moves
+    are tried nearest the target first, so that while A* waits to try
+    again the worm still closes in on it. No more than FLOOD_LIMIT cells
+    are counted in all, the best move so far being taken once they have
+    been. Returns None if every move is fatal.
+    """
+    (x, y) = head
+    enough = min(len(state.worm) + state.grow_count + SLACK, FLOOD_LIMIT)
+    budget = FLOOD_LIMIT
+    seen = set()
+    best = None
+    best_room = 0
+    moves = list(enumerate(wormstate.DIRECTIONS))
+    if state.target_value != None:
+        (gx, gy) = (state.target_x, state.target_y)
+        moves.sort(key=lambda move: abs(x + move[1][0] - gx) +
+            abs(y + move[1][1] - gy))
+    for d, (dx, dy) in moves:
+        if (x + dx, y + dy) not in seen and free(state, x + dx, y + dy):
+            room = flood(state, x + dx, y + dy, min(enough, budget), seen)
+            if room >= enough:
+                return d
+            if room > best_room:
+                best = d
+                best_room = room
+            budget -= room
+            if budget <= 0:
+                break
+    return best
+
+def flood(state: wormstate.WormState, x: int, y: int, limit: int,
+        seen=None):
+    """
+    Counts the free cells reachable from x, y, stopping at limit. The
+    cells counted are added to seen if given, which must not already hold
+    any cell reachable from x, y.
+    """
+    width = state.width
+    height = state.height
+    is_occupied = state.cells.is_occupied
+    if seen == None:
+        seen = set()
+    seen.add((x, y))
+    queue = [(x, y)]
+    for (x, y) in queue:
+        if len(queue) >= limit:
+            break
+        for n in ((x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)):
+            (nx, ny) = n
+            if (0 <= nx < width and 0 <= ny < height and n not in seen and
+                    not is_occupied(nx, ny)):
+                seen.add(n)
+                queue.append(n)
+    return len(queue)
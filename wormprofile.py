@@ -0,0 +1,217 @@
+"""
+Opt-in profiling of the worm game.
+
+A Profiler keeps a Histogram of call times per phase of a tick and a few
+counters. Nothing in the game knows about it: profiling is turned on by
+instrument, which replaces methods of one object with timed wrappers on
+that instance, and turned off by uninstrument, which removes them again. So
+code that isn't being profiled runs exactly as it would without this module.
+
+Histograms have a bucket per power of two nanoseconds, which is cheap to
+update and plenty to tell where the time goes. Profiles can be merged, so
+worker processes can each keep their own, and exported as JSON or CSV.
+"""
+
+import csv
+import json
+import os
+import time
+
+# Buckets in a Histogram. Bucket i counts times needing i bits in
+# nanoseconds, so the last is over a day.
+BUCKETS = 48
+
+class Histogram(object):
+    """Counts of times in nanoseconds in power of two buckets"""
+
+    def __init__(self):
+        self.buckets = [0] * BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, ns: int):
+        """Adds a time in nanoseconds"""
+        self.buckets[min(ns.bit_length(), BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+
+    def merge(self, other):
+        """Adds the counts of another Histogram to this one"""
+        for i, n in enumerate(other.buckets):
+            self.buckets[i] += n
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def mean(self):
+        """Returns the mean time in nanoseconds"""
+        return self.total / max(self.count, 1)
+
+    def percentile(self, p: float):
+        """
+        Returns the time in nanoseconds that a fraction p of the times were
+        at or below, rounded up to the top of its bucket.
+        """
+        wanted = p * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= wanted:
+                return min((1 << i) - 1, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "total_ns": self.total,
+            "mean_ns": round(self.mean()),
+            "p50_ns": self.percentile(0.50),
+            "p90_ns": self.percentile(0.90),
+            "p99_ns": self.percentile(0.99),
+            "max_ns": self.max,
+            "buckets": self.buckets,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        histogram = cls()
+        histogram.buckets = list(data["buckets"])
+        histogram.count = data["count"]
+        histogram.total = data["total_ns"]
+        histogram.max = data["max_ns"]
+        return histogram
+
+class Profiler(object):
+    """
+    Histograms of time spent in each phase of the game, by name, and
+    counters of things that happen.
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self.counters = {}
+
+    def phase(self, name: str):
+        """Returns the Histogram for a phase, creating it if needed"""
+        histogram = self.phases.get(name)
+        if histogram == None:
+            histogram = self.phases[name] = Histogram()
+        return histogram
+
+    def count(self, name: str, n: int = 1):
+        """Adds n to a counter"""
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def wrap(self, name: str, function):
+        """Returns function wrapped so that each call is timed as phase name"""
+        add = self.phase(name).add
+        clock = time.perf_counter_ns
+        def timed(*args, **kwargs):
+            start = clock()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                add(clock() - start)
+        return timed
+
+    def merge(self, other):
+        """Adds another Profiler's histograms and counters to this one"""
+        for name, histogram in other.phases.items():
+            self.phase(name).merge(histogram)
+        for name, n in other.counters.items():
+            self.count(name, n)
+
+    def to_dict(self):
+        return {
+            "phases": {name: histogram.to_dict()
+                for name, histogram in self.phases.items()},
+            "counters": dict(self.counters),
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        profiler = cls()
+        for name, histogram in data["phases"].items():
+            profiler.phases[name] = Histogram.from_dict(histogram)
+        profiler.counters = dict(data["counters"])
+        return profiler
+
+    def summary(self):
+        """Returns a one line summary of the phases and counters"""
+        parts = ["%s p50 %s p99 %s" % (name, format_ns(h.percentile(0.50)),
+            format_ns(h.percentile(0.99)))
+            for name, h in self.phases.items() if h.count]
+        parts.extend("%s %d" % item for item in self.counters.items())
+        return " | ".join(parts)
+
+    def export(self, path: str):
+        """
+        Writes the profile to path, as CSV if it ends in .csv and JSON
+        otherwise. The file is replaced in one go so that a run exporting
+        periodically never leaves it half written.
+        """
+        temporary = path + ".tmp"
+        with open(temporary, "w", newline="") as f:
+            if path.endswith(".csv"):
+                self.write_csv(f)
+            else:
+                json.dump(self.to_dict(), f, indent=1)
+                f.write("\n")
+        os.replace(temporary, path)
+
+    def write_csv(self, f):
+        """Writes a row per phase and per counter"""
+        writer = csv.writer(f)
+        writer.writerow(["kind", "name", "count", "total_ns", "mean_ns",
+            "p50_ns", "p90_ns", "p99_ns", "max_ns"])
+        for name, histogram in self.phases.items():
+            d = histogram.to_dict()
+            writer.writerow(["phase", name, d["count"], d["total_ns"],
+                d["mean_ns"], d["p50_ns"], d["p90_ns"], d["p99_ns"],
+                d["max_ns"]])
+        for name, n in self.counters.items():
+            writer.writerow(["counter", name, n, "", "", "", "", "", ""])
+
+def format_ns(ns: int):
+    """Formats nanoseconds for a person to read"""
+    if ns < 1000:
+        return "%dns" % ns
+    if ns < 1000000:
+        return "%.1fus" % (ns / 1000)
+    return "%.1fms" % (ns / 1000000)
+
+def instrument(profiler: Profiler, obj, name: str, *methods):
+    """Times calls to each of obj's methods as phase name"""
+    for method in methods:
+        setattr(obj, method, profiler.wrap(name, getattr(obj, method)))
+
+def uninstrument(obj, *methods):
+    """Undoes instrument, putting obj's methods back as they were"""
+    for method in methods:
+        obj.__dict__.pop(method, None)
+
+def instrument_state(profiler: Profiler, state):
+    """
+    Profiles a wormstate.WormState: next_step as the step phase, advance
+    as the advance phase and generate_target, which both call, as the
+    target phase. The random cells that a sparse board had to reject while
+    placing targets are counted as target_misses.
+    """
+    instrument(profiler, state, "step", "next_step")
+    instrument(profiler, state, "advance", "advance")
+    generate_target = profiler.wrap("target", state.generate_target)
+    def counted():
+        misses = getattr(state.cells, "misses", 0)
+        try:
+            return generate_target()
+        finally:
+            profiler.count("target_misses",
+                getattr(state.cells, "misses", 0) - misses)
+    state.generate_target = counted
+
+def uninstrument_state(state):
+    """Stops profiling a wormstate.WormState"""
+    uninstrument(state, "next_step", "advance", "generate_target")
@@ -0,0 +1,219 @@
+"""
+Recording and replaying games of worm.
+
+Since a game is fully determined by its seed, board size, level, number of
+targets and the moves made, a recording only stores those. The file format
+is little endian:
+
+    magic       4 bytes  b"WORM"
+    version     1 byte   1, 2 for a game played on a level, or 3 for a game
+                         with more than one target
+    width       4 bytes  unsigned
+    height      4 bytes  unsigned
+    seed        8 bytes  unsigned
+    targets     version 3 only, 4 bytes unsigned, then a byte that is 1 if
+                a level follows
+    level       version 2, or 3 if flagged, the level in the level pack
+                format of wormlevel, so the recording replays without the
+                pack
+    events      varints until the end event
+
+Each event is a varint holding (ticks since the previous event << 3) | code
+where code is a direction code from wormstate for a turn, or END when the
+recording stops.
+"""
+
+import struct
+
+import wormlevel
+import wormstate
+
+MAGIC = b"WORM"
+VERSION = 1
+LEVEL_VERSION = 2
+TARGETS_VERSION = 3
+HEADER = struct.Struct("<4sBIIQ")
+
+# Largest seed the header can hold. Seeds are unsigned.
+MAX_SEED = (1 << 64) - 1
+TARGETS = struct.Struct("<IB")
+
+# Event code marking the end of a recording
+END = 4
+
+class Recording(object):
+    """
+    A recorded game: the board size, the seed, the level if there was one,
+    the number of targets, the ticks at which the worm turned and the tick
+    the recording stopped at.
+    """
+
+    def __init__(self, width: int, height: int, seed: int, level=None,
+            targets: int = 1):
+        self.width = width
+        self.height = height
+        self.seed = seed
+        self.level = level
+        self.targets = targets
+        self.turns = []     # (tick, direction) in tick order
+        self.end = 0
+
+    def start(self, state: wormstate.WormState):
+        """Starts the recorded game on state"""
+        state.reset(self.width, self.height, self.seed, self.level,
+            self.targets)
+
+    def to_bytes(self):
+        """Returns the recording in the binary format"""
+        if not 0 <= self.seed <= MAX_SEED:
+            raise ValueError("Can't record seed %d, which isn't from 0 to %d"
+                % (self.seed, MAX_SEED))
+        version = VERSION if self.level == None else LEVEL_VERSION
+        if self.targets != 1:
+            version = TARGETS_VERSION
+        data = bytearray(HEADER.pack(MAGIC, version, self.width, self.height,
+            self.seed))
+        if version == TARGETS_VERSION:
+            data += TARGETS.pack(self.targets, self.level != None)
+        if self.level != None:
+            data += self.level.to_bytes()
+        last = 0
+        for (tick, direction) in self.turns:
+            write_varint(data, (tick - last) << 3 | direction)
+            last = tick
+        write_varint(data, (self.end - last) << 3 | END)
+        return bytes(data)
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        """Parses a recording from the binary format"""
+        (magic, version, width, height, seed) = HEADER.unpack_from(data)
+        if magic != MAGIC or version not in (VERSION, LEVEL_VERSION,
+                TARGETS_VERSION):
+            raise ValueError("Not a version %d to %d worm recording" % (
+                VERSION, TARGETS_VERSION))
+        level = None
+        targets = 1
+        has_level = version == LEVEL_VERSION
+        offset = HEADER.size
+        if version == TARGETS_VERSION:
+            (targets, has_level) = TARGETS.unpack_from(data, offset)
+            offset += TARGETS.size
+        if has_level:
+            (level, offset) = wormlevel.Level.from_buffer(data, offset)
+        recording = cls(width, height, seed, level, targets)
+        tick = 0
+        while True:
+            (value, offset) = read_varint(data, offset)
+            tick += value >> 3
+            code = value & 7
+            if code == END:
+                break
+            recording.turns.append((tick, code))
+        recording.end = tick
+        return recording
+
+    def save(self, path: str):
+        """Writes the recording to a file"""
+        with open(path, "wb") as f:
+            f.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, path: str):
+        """Reads a recording from a file"""
+        with open(path, "rb") as f:
+            return cls.from_bytes(f.read())
+
+def write_varint(data: bytearray, value: int):
+    """Appends value to data as an unsigned LEB128 varint"""
+    while value >= 0x80:
+        data.append(value & 0x7f | 0x80)
+        value >>= 7
+    data.append(value)
+
+def read_varint(data: bytes, offset: int):
+    """Reads a varint at offset and returns it with the offset after it"""
+    value = 0
+    shift = 0
+    while True:
+        b = data[offset]
+        offset += 1
+        value |= (b & 0x7f) << shift
+        if b < 0x80:
+            return (value, offset)
+        shift += 7
+
+class Recorder(object):
+    """
+    Builds a Recording while a game is played. Call turn after changing the
+    direction of the worm and finish when the game stops.
+    """
+
+    def __init__(self, state: wormstate.WormState):
+        self.recording = Recording(state.width, state.height, state.seed,
+            state.level, state.target_count)
+        self.direction = state.direction
+
+    def turn(self, state: wormstate.WormState):
+        """Notes the current direction of the worm if it has changed"""
+        if state.direction != self.direction:
+            self.direction = state.direction
+            turns = self.recording.turns
+            if turns and turns[-1][0] == state.ticks:
+                # Only the last turn before a step matters
+                turns.pop()
+            turns.append((state.ticks, state.direction))
+
+    def finish(self, state: wormstate.WormState):
+        """Marks the end of the recording and returns it"""
+        self.recording.end = state.ticks
+        return self.recording
+
+class Replayer(object):
+    """
+    Drives a WormState through a Recording one step at a time. The state
+    must already have been started with Recording.start.
+    """
+
+    def __init__(self, recording: Recording, state: wormstate.WormState):
+        self.recording = recording
+        self.state = state
+        self.next_turn = 0
+
+    def finished(self):
+        """Returns True once the recording or the game is over"""
+        return (self.state.game_over or
+            self.state.ticks >= self.recording.end)
+
+    def apply_turns(self):
+        """Turns the worm if the recording turned it at the current tick"""
+        turns = self.recording.turns
+        while (self.next_turn < len(turns) and
+                turns[self.next_turn][0] <= self.state.ticks):
+            self.state.go(turns[self.next_turn][1])
+            self.next_turn += 1
+
+    def step(self):
+        """Advances the replay by one step, like WormState.next_step"""
+        self.apply_turns()
+        return self.state.next_step()
+
+def fast_forward(recording: Recording, state=None, until=None):
+    """
+    Replays a recording headless as fast as possible up to tick until (or
+    the end of the recording) and returns the resulting WormState.
+    """
+    if state == None:
+        state = wormstate.WormState(wormstate.RingBody)
+    end = recording.end if until == None else min(until, recording.end)
+    recording.start(state)
+
+    # Run straight to each turn without checking for turns in between
+    for (tick, direction) in recording.turns + [(end, None)]:
+        tick = min(tick, end)
+        if state.ticks < tick and not state.game_over:
+            state.advance(tick - state.ticks, until_eaten=False)
+        if state.game_over or tick == end:
+            break
+        state.go(direction)
+    return state
@@ -0,0 +1,219 @@
+"""
+Renderers draw the worm screen for WormCurses.
+
+Renderer lays out the screen as pictured at the top of wormcurses on top of
+a few primitives that each backend provides: the screen size, writing text
+at a position, clearing the screen or a line, drawing the border and
+flushing. CursesRenderer draws with curses, FramebufferRenderer draws into
+a bytearray for tests and benchmarks, and AnsiRenderer writes ANSI escapes
+straight to the terminal in a single write per frame.
+"""
+
+import curses
+import os
+
+class Renderer(object):
+    """
+    Draws the parts of the worm screen. Play area cells are given relative
+    to the play area. Nothing need appear until flush is called.
+    """
+
+    def resize(self):
+        """Works out the layout for the current size of the screen"""
+        (self.maxy, self.maxx) = self.size()
+        self.play_maxx = self.maxx - 2  # account for border on both sides
+        self.play_maxy = self.maxy - 4  # account for border, header, and footer
+
+    def draw_static(self):
+        """Clears the screen and draws everything that never changes"""
+        self.clear_screen()
+        self.write(0, 1, "Grow By:")
+        self.write(0, self.maxx - 12, "Score:")
+        self.draw_box()
+
+    def put(self, y: int, x: int, c: str):
+        """Draws a character in a cell of the play area"""
+        self.write(y + 2, x + 1, c)
+
+    def erase(self):
+        """Blanks the play area"""
+        blank = ' ' * self.play_maxx
+        for y in range(self.play_maxy):
+            self.write(y + 2, 1, blank)
+
+    def grow_by(self, text: str):
+        """Draws the grow by field"""
+        self.write(0, 10, text.ljust(4))
+
+    def score(self, text: str):
+        """Draws the score field"""
+        self.write(0, self.maxx - 5, text.ljust(4))
+
+    def status(self, text: str):
+        """Draws the status line centered at the bottom"""
+        y = self.maxy - 1
+        self.clear_line(y)
+        self.write(y, max((self.maxx - len(text)) // 2, 0), text)
+
+    def hud(self, text: str):
+        """Draws a line of information over the top of the border"""
+        self.draw_box()
+        self.write(1, 2, " %s " % text[:self.maxx - 6])
+
+    def size(self):
+        """Returns the size of the screen as (rows, columns)"""
+        raise NotImplementedError
+
+    def write(self, y: int, x: int, text: str):
+        """Writes text at a row and column of the screen"""
+        raise NotImplementedError
+
+    def clear_screen(self):
+        """Blanks the whole screen"""
+        raise NotImplementedError
+
+    def clear_line(self, y: int):
+        """Blanks a row of the screen"""
+        self.write(y, 0, ' ' * self.maxx)
+
+    def draw_box(self):
+        """Draws the border around the play area"""
+        line = '+' + '-' * (self.maxx - 2) + '+'
+        self.write(1, 0, line)
+        for y in range(2, self.maxy - 2):
+            self.write(y, 0, '|')
+            self.write(y, self.maxx - 1, '|')
+        self.write(self.maxy - 2, 0, line)
+
+    def flush(self):
+        """Shows everything drawn since the last flush"""
+        raise NotImplementedError
+
+class CursesRenderer(Renderer):
+    """Draws with curses on a window, normally stdscr"""
+
+    def __init__(self, stdscr):
+        self.stdscr = stdscr
+
+    def resize(self):
+        super().resize()
+        self.border_area = self.stdscr.subwin(self.maxy - 2, self.maxx, 1, 0)
+        self.play_area = self.stdscr.subwin(self.play_maxy, self.play_maxx,
+            2, 1)
+
+    def size(self):
+        return self.stdscr.getmaxyx()
+
+    def put(self, y: int, x: int, c: str):
+        # addch throws an exception when writing to the lower right corner
+        # of a window
+        try:
+            self.play_area.addch(y, x, c)
+        except curses.error:
+            pass
+
+    def erase(self):
+        self.play_area.erase()
+
+    def write(self, y: int, x: int, text: str):
+        try:
+            self.stdscr.addstr(y, x, text)
+        except curses.error:
+            pass
+
+    def clear_screen(self):
+        self.stdscr.clear()
+
+    def clear_line(self, y: int):
+        try:
+            self.stdscr.move(y, 0)
+            self.stdscr.clrtoeol()
+        except curses.error:
+            pass
+
+    def draw_box(self):
+        self.border_area.box()
+
+    def flush(self):
+        self.stdscr.noutrefresh()
+        self.play_area.noutrefresh()
+        curses.doupdate()
+
+class FramebufferRenderer(Renderer):
+    """
+    Draws into a bytearray holding a byte per character of a screen of a
+    fixed size, a row at a time. Nothing is ever shown, which makes it
+    handy for tests and benchmarks.
+    """
+
+    def __init__(self, columns: int, rows: int):
+        self.columns = columns
+        self.rows = rows
+        self.cells = bytearray(b' ' * (columns * rows))
+        self.flushes = 0
+
+    def size(self):
+        return (self.rows, self.columns)
+
+    def put(self, y: int, x: int, c: str):
+        if 0 <= x < self.play_maxx and 0 <= y < self.play_maxy:
+            self.cells[(y + 2) * self.columns + x + 1] = ord(c)
+
+    def write(self, y: int, x: int, text: str):
+        if not 0 <= y < self.rows or x >= self.columns:
+            return
+        data = text.encode("ascii", "replace")[:self.columns - x]
+        start = y * self.columns + x
+        self.cells[start:start + len(data)] = data
+
+    def clear_screen(self):
+        self.cells[:] = b' ' * len(self.cells)
+
+    def flush(self):
+        self.flushes += 1
+
+    def row(self, y: int):
+        """Returns a row of the screen as a string"""
+        return self.cells[y * self.columns:(y + 1) * self.columns].decode()
+
+    def text(self):
+        """Returns the whole screen as lines of text"""
+        return "\n".join(self.row(y) for y in range(self.rows))
+
+class AnsiRenderer(Renderer):
+    """
+    Writes ANSI escapes to a terminal without going through curses. Each
+    frame is built up in a list and sent with a single write when flushed,
+    skipping the cursor move between characters that are side by side.
+    """
+
+    def __init__(self, fd: int):
+        self.fd = fd
+        self.pending = []
+        self.cursor = None      # Where the terminal's cursor is, if known
+
+    def size(self):
+        (columns, rows) = os.get_terminal_size(self.fd)
+        return (rows, columns)
+
+    def write(self, y: int, x: int, text: str):
+        if self.cursor != (y, x):
+            self.pending.append("\x1b[%d;%dH" % (y + 1, x + 1))
+        self.pending.append(text)
+        self.cursor = (y, x + len(text))
+
+    def clear_screen(self):
+        self.pending.append("\x1b[2J")
+        self.cursor = None
+
+    def clear_line(self, y: int):
+        self.pending.append("\x1b[%d;1H\x1b[2K" % (y + 1))
+        self.cursor = (y, 0)
+
+    def flush(self):
+        if not self.pending:
+            return
+        data = "".join(self.pending).encode("ascii", "replace")
+        self.pending.clear()
+        while data:
+            data = data[os.write(self.fd, data):]
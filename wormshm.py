@@ -0,0 +1,597 @@
+"""
+Split play: the game runs in a process of its own and the screen is drawn
+from shared memory, so a slow terminal can never hold up a tick.
+
+The simulation process owns the WormState and ticks it on its own monotonic
+clock. After each round of ticks it writes a frame to a block of
+multiprocessing.shared_memory: a header with the tick, score, grow count,
+head and status, and a byte per cell of the board, targets and all, so
+however many targets there are only the cells that change are drawn.
+The block has
+two frame slots. The writer always fills the one that isn't the latest and
+then makes it the latest, so the slot a reader is looking at is only
+written to if the reader falls a whole frame behind.
+
+Each slot starts with a sequence number that is odd while the slot is
+being written, a seqlock. The drawing process reads the latest slot in
+place, draws what differs from the last frame it read and then checks the
+sequence number again. If it changed the frame was torn and is read again,
+and nothing is shown until a frame reads cleanly. The writer never waits on
+the reader, so when drawing falls behind frames are skipped and ticks are
+not.
+
+Keys go the other way as commands over a multiprocessing pipe.
+
+    python pyworm.py play --split
+"""
+
+import collections
+import curses
+import multiprocessing
+import random
+import struct
+import time
+from multiprocessing import shared_memory
+
+import wormcurses
+import wormlevel
+import wormpilot
+import wormrecord
+import wormrender
+import wormstate
+
+# Codes for the cells of the board in a frame, and how each is drawn. A
+# target of value v has the code TARGET + v - 1.
+EMPTY, BODY, HEAD, WALL, TARGET = range(5)
+CHARACTERS = " o@#123456789"
+
+# What the game is doing in a frame
+PLAYING, PAUSED, OVER = range(3)
+
+# Number of the slot holding the latest frame, at the start of the block
+LATEST = struct.Struct("<Q")
+
+# Header of a frame slot: sequence number, tick, ticks dropped, score, grow
+# count, head x and y, what the game is doing and the status line. The
+# board follows it.
+STATUS_BYTES = 107
+SLOT = struct.Struct("<QQIIIiiB%ds" % STATUS_BYTES)
+SEQUENCE = struct.Struct("<Q")
+
+# Most late ticks run at once to catch up before the rest are dropped
+MAX_CATCHUP = 5
+
+# Milliseconds the drawing process waits for a key before looking for a
+# new frame
+FRAME_WAIT = 5
+
+def slot_size(width: int, height: int):
+    """Returns the bytes a frame slot takes, rounded up to 8"""
+    return (SLOT.size + width * height + 7) & ~7
+
+def block_size(width: int, height: int):
+    """Returns the bytes of shared memory needed for a board"""
+    return LATEST.size + 2 * slot_size(width, height)
+
+class Frame(object):
+    """The header of a frame read from shared memory"""
+
+    __slots__ = ("number", "tick", "dropped", "score", "grow", "head",
+        "mode", "status")
+
+    def __init__(self, number: int, fields):
+        (sequence, self.tick, self.dropped, self.score, self.grow, x, y,
+            self.mode, status) = fields
+        self.number = number
+        self.head = (x, y)
+        self.status = status.rstrip(b"\0").decode("utf-8", "replace")
+
+class FrameWriter(object):
+    """
+    Writes frames of a game to a block of shared memory made for a board of
+    width by height. Changes to the board are kept for each slot until it
+    is next written, so a frame only costs as much as the cells that
+    changed since that slot was last written.
+    """
+
+    def __init__(self, memory: shared_memory.SharedMemory, width: int,
+            height: int):
+        self.buffer = memory.buf
+        self.width = width
+        self.height = height
+        self.slot_size = slot_size(width, height)
+        self.number = 0         # Number of the last frame written
+        self.latest = 1         # Slot holding it
+        self.dropped = 0        # Ticks skipped to catch up
+        self.redraw()
+
+    def redraw(self):
+        """Makes the next frame of each slot copy the whole board"""
+        self.pending = [None, None]
+
+    def set(self, x: int, y: int, code: int):
+        """Notes the new code of the cell at x, y for both slots"""
+        i = y * self.width + x
+        for changes in self.pending:
+            if changes != None:
+                changes.append((i, code))
+
+    def update(self, state: wormstate.WormState, start,
+            result: wormstate.AdvanceResult):
+        """
+        Notes the cells changed by a wormstate.AdvanceResult of state, whose
+        head was at start
+        """
+        previous = start
+        for (head, tail) in zip(result.heads, result.tails):
+            self.set(*previous, BODY)
+            self.set(*head, HEAD)
+            if tail != None:
+                self.set(*tail, EMPTY)
+            previous = head
+
+        # Only the targets placed that weren't eaten again straight away
+        for (x, y, value) in result.placed:
+            if state.targets.get(y * self.width + x) == value:
+                self.set(x, y, TARGET + value - 1)
+
+    def write(self, state: wormstate.WormState, mode: int, status: str):
+        """Writes a frame of state and makes it the latest"""
+        slot = 1 - self.latest
+        base = LATEST.size + slot * self.slot_size
+        board = base + SLOT.size
+        buffer = self.buffer
+        self.number += 1
+
+        # Odd while writing
+        SEQUENCE.pack_into(buffer, base, 2 * self.number - 1)
+        changes = self.pending[slot]
+        if changes == None:
+            self.copy_board(state, board)
+        else:
+            for (i, code) in changes:
+                buffer[board + i] = code
+        self.pending[slot] = []
+        (x, y) = state.worm.head()
+        SLOT.pack_into(buffer, base, 2 * self.number - 1, state.ticks,
+            self.dropped, state.score, state.grow_count, x, y, mode,
+            status.encode("utf-8")[:STATUS_BYTES])
+
+        # Even once complete
+        SEQUENCE.pack_into(buffer, base, 2 * self.number)
+        LATEST.pack_into(buffer, 0, slot)
+        self.latest = slot
+
+    def copy_board(self, state: wormstate.WormState, board: int):
+        """Writes every cell of state's board at offset board"""
+        width = self.width
+        buffer = self.buffer
+        buffer[board:board + width * self.height] = bytes(width * self.height)
+        if state.level != None:
+            for (x, y) in state.level.wall_cells():
+                buffer[board + y * width + x] = WALL
+        for (x, y, value) in state.target_cells():
+            buffer[board + y * width + x] = TARGET + value - 1
+        for (x, y) in state.worm:
+            buffer[board + y * width + x] = BODY
+        (x, y) = state.worm.head()
+        buffer[board + y * width + x] = HEAD
+
+class FrameReader(object):
+    """
+    Reads the frames a FrameWriter writes to shared memory. shown holds the
+    board as of the last frame read.
+    """
+
+    def __init__(self, memory: shared_memory.SharedMemory, width: int,
+            height: int):
+        self.buffer = memory.buf
+        self.width = width
+        self.height = height
+        self.slot_size = slot_size(width, height)
+        self.shown = bytearray(width * height)
+        self.number = 0         # Number of the last frame read
+        self.skipped = 0        # Frames written that were never read
+
+    def read(self, changed):
+        """
+        Reads the latest frame if it is newer than the last one read,
+        calling changed(x, y, code) for each cell of the board that differs
+        from the last frame, and returns its Frame. Returns None if there is
+        no newer frame or it was being written while it was read, in which
+        case changed may have been called for cells of a torn frame.
+        """
+        (slot,) = LATEST.unpack_from(self.buffer, 0)
+        base = LATEST.size + slot * self.slot_size
+        (sequence,) = SEQUENCE.unpack_from(self.buffer, base)
+        if sequence & 1 or sequence >> 1 <= self.number:
+            return None
+        fields = SLOT.unpack_from(self.buffer, base)
+
+        # Compare a row at a time and only look closer at rows that differ
+        width = self.width
+        board = self.buffer[base + SLOT.size:
+            base + SLOT.size + width * self.height]
+        shown = memoryview(self.shown)
+        for y in range(self.height):
+            start = y * width
+            if board[start:start + width] == shown[start:start + width]:
+                continue
+            for i in range(start, start + width):
+                code = board[i]
+                if code != shown[i]:
+                    shown[i] = code
+                    changed(i - start, y, code)
+        board.release()
+        shown.release()
+
+        if SEQUENCE.unpack_from(self.buffer, base)[0] != sequence:
+            return None
+        number = sequence >> 1
+        if self.number != 0:
+            self.skipped += number - self.number - 1
+        self.number = number
+        return Frame(number, fields)
+
+class Simulation(object):
+    """
+    The game as run in the simulation process: a WormState ticked on its
+    own clock, taking commands from the drawing process and writing a frame
+    after every round of ticks.
+    """
+
+    def __init__(self, writer: FrameWriter, tick_rate: float, seed=None,
+            record_path=None, level=None, targets: int = 1):
+        self.writer = writer
+        self.interval = 1 / tick_rate
+        self.seed = seed
+        self.record_path = record_path
+        self.level = level
+        self.targets = targets
+        self.state = wormstate.WormState()
+        self.prng = random.Random(time.time())
+        self.moves = collections.deque()
+        self.paused = False
+        self.pilot = None
+        self.recorder = None
+        self.status = ""
+
+    def new_game(self, seed=None):
+        """Starts a new game and writes its first frame"""
+        self.state.reset(self.writer.width, self.writer.height, seed,
+            self.level, self.targets)
+        if self.record_path != None:
+            self.recorder = wormrecord.Recorder(self.state)
+        self.moves.clear()
+        self.paused = False
+        self.status = ""
+        if self.pilot != None:
+            self.status = wormcurses.AUTOPILOT_STATUS
+        self.writer.redraw()
+        self.publish()
+
+    def publish(self):
+        """Writes a frame of the game as it is"""
+        mode = PLAYING
+        if self.state.game_over:
+            mode = OVER
+        elif self.paused:
+            mode = PAUSED
+        self.writer.write(self.state, mode, self.status)
+
+    def save_recording(self):
+        """Writes the recording of the current game, if there is one"""
+        if self.recorder != None:
+            self.recorder.finish(self.state).save(self.record_path)
+
+    def turn(self, direction: int):
+        """Points the worm in a new direction, recording it if needed"""
+        self.state.go(direction)
+        if self.recorder != None:
+            self.recorder.turn(self.state)
+
+    def handle(self, command):
+        """Acts on a command. Returns False to quit."""
+        playing = not (self.state.game_over or self.paused)
+        match command:
+            case ("move", direction, steps):
+                if playing and len(self.moves) < wormcurses.MOVE_QUEUE_LIMIT:
+                    self.moves.append((direction, steps))
+            case ("pilot",):
+                if playing:
+                    if self.pilot == None:
+                        self.pilot = wormpilot.Autopilot()
+                        self.status = wormcurses.AUTOPILOT_STATUS
+                    else:
+                        self.pilot = None
+                        self.status = ""
+                    self.publish()
+            case ("pause",):
+                if not self.state.game_over:
+                    self.paused = not self.paused
+                    self.status = ("Paused: Hit P to continue" if self.paused
+                        else "")
+                    self.publish()
+            case ("new",):
+                if self.state.game_over:
+                    self.new_game()
+            case ("quit",):
+                return False
+        return True
+
+    def tick(self, ticks: int):
+        """
+        Runs ticks ticks, each taking the next queued move or asking the
+        autopilot, and then writes one frame
+        """
+        state = self.state
+        for i in range(ticks):
+            steps = 1
+            if self.moves:
+                (direction, steps) = self.moves.popleft()
+                self.turn(direction)
+            elif self.pilot != None:
+                direction = self.pilot(state)
+                if direction != None:
+                    self.turn(direction)
+            start = state.worm.head()
+            result = state.advance(steps)
+            self.writer.update(state, start, result)
+            if result.stop == wormstate.DIED:
+                self.status = (result.message() +
+                    ": Hit 'N' for new game or Q to quit")
+                self.save_recording()
+                break
+            if result.stop == wormstate.ATE:
+                self.status = wormcurses.worm_quotes[self.prng.randint(0,
+                    wormcurses.worm_max_quote)]
+        self.publish()
+
+    def run(self, connection, max_catchup: int = MAX_CATCHUP):
+        """
+        Plays until told to quit, taking commands from connection. Ticks
+        run on a monotonic clock like WormCurses.run, with late ticks
+        caught up a few at a time and the rest dropped.
+        """
+        self.new_game(self.seed)
+        interval = self.interval
+        next_tick = time.monotonic() + interval
+        try:
+            while True:
+                waiting = self.state.game_over or self.paused
+                timeout = None
+                if not waiting:
+                    timeout = max(next_tick - time.monotonic(), 0)
+                if connection.poll(timeout):
+                    while connection.poll():
+                        if not self.handle(connection.recv()):
+                            return
+
+                # The clock only runs while the game is being played
+                if waiting or self.state.game_over or self.paused:
+                    next_tick = time.monotonic() + interval
+                    continue
+
+                now = time.monotonic()
+                if now < next_tick:
+                    continue
+                due = int((now - next_tick) / interval) + 1
+                ticks = min(due, max_catchup)
+                self.writer.dropped += due - ticks
+                next_tick += due * interval
+                self.tick(ticks)
+        except (EOFError, KeyboardInterrupt):
+            # The drawing process went away
+            pass
+        finally:
+            self.save_recording()
+
+def simulate(memory, width: int, height: int, connection, tick_rate: float,
+        seed=None, record_path=None, level=None, targets: int = 1):
+    """
+    The body of the simulation process. level is the bytes of a
+    wormlevel.Level, if any, since a level read from a pack can't be
+    handed between processes.
+    """
+    if level != None:
+        level = wormlevel.Level.from_buffer(level)[0]
+    writer = FrameWriter(memory, width, height)
+    Simulation(writer, tick_rate, seed, record_path, level,
+        targets).run(connection)
+
+class Screen(object):
+    """
+    Draws the frames read by a FrameReader with a wormrender.Renderer,
+    through a view that follows the head on boards bigger than the screen.
+    """
+
+    def __init__(self, renderer: wormrender.Renderer, reader: FrameReader):
+        self.renderer = renderer
+        self.reader = reader
+        self.frame = None
+        self.frames = 0         # Frames drawn
+        self.shown = {}         # Header fields as last drawn
+        self.exit_code = None   # Of the simulation if it stopped by itself
+
+    def layout(self):
+        """Works out the layout and the view for the size of the screen"""
+        renderer = self.renderer
+        renderer.resize()
+        self.view_width = min(renderer.play_maxx, self.reader.width)
+        self.view_height = min(renderer.play_maxy, self.reader.height)
+        (x, y) = self.frame.head if self.frame != None else (0, 0)
+        self.view_x = wormcurses.center(x, self.view_width, self.reader.width)
+        self.view_y = wormcurses.center(y, self.view_height,
+            self.reader.height)
+
+    def put(self, x: int, y: int, code: int):
+        """Draws a cell of the board if it is in view"""
+        x -= self.view_x
+        y -= self.view_y
+        if 0 <= x < self.view_width and 0 <= y < self.view_height:
+            self.renderer.put(y, x, CHARACTERS[code])
+
+    def draw_fields(self, frame: Frame):
+        """Draws the header fields and status line that changed"""
+        for (field, value, draw) in (
+                ("grow", frame.grow, self.renderer.grow_by),
+                ("score", frame.score, self.renderer.score),
+                ("status", frame.status, self.renderer.status)):
+            if self.shown.get(field) != value:
+                self.shown[field] = value
+                draw(str(value))
+
+    def draw_all(self):
+        """Redraws the whole screen from the last frame read"""
+        self.renderer.draw_static()
+        self.shown.clear()
+        shown = self.reader.shown
+        width = self.reader.width
+        for y in range(self.view_y, self.view_y + self.view_height):
+            for x in range(self.view_x, self.view_x + self.view_width):
+                code = shown[y * width + x]
+                if code != EMPTY:
+                    self.put(x, y, code)
+        if self.frame != None:
+            self.draw_fields(self.frame)
+        self.renderer.flush()
+
+    def update(self):
+        """
+        Draws the latest frame if there is a new one. Returns True if it
+        did.
+        """
+        frame = self.reader.read(self.put)
+        if frame == None:
+            return False
+        self.frame = frame
+        self.frames += 1
+
+        # Scroll the view if the head got too close to its edge
+        (x, y) = frame.head
+        view_x = wormcurses.scroll(x, self.view_x, self.view_width,
+            self.reader.width)
+        view_y = wormcurses.scroll(y, self.view_y, self.view_height,
+            self.reader.height)
+        if (view_x, view_y) != (self.view_x, self.view_y):
+            (self.view_x, self.view_y) = (view_x, view_y)
+            self.renderer.erase()
+            self.draw_all()
+            return True
+
+        self.draw_fields(frame)
+        self.renderer.flush()
+        return True
+
+# Commands sent for each key while playing
+KEY_COMMANDS = {
+    wormcurses.keys.KEY_h: ("move", wormstate.LEFT, 1),
+    curses.KEY_LEFT: ("move", wormstate.LEFT, 1),
+    wormcurses.keys.KEY_j: ("move", wormstate.DOWN, 1),
+    curses.KEY_DOWN: ("move", wormstate.DOWN, 1),
+    wormcurses.keys.KEY_k: ("move", wormstate.UP, 1),
+    curses.KEY_UP: ("move", wormstate.UP, 1),
+    wormcurses.keys.KEY_l: ("move", wormstate.RIGHT, 1),
+    curses.KEY_RIGHT: ("move", wormstate.RIGHT, 1),
+    wormcurses.keys.KEY_H: ("move", wormstate.LEFT, 5),
+    curses.KEY_SLEFT: ("move", wormstate.LEFT, 5),
+    wormcurses.keys.KEY_J: ("move", wormstate.DOWN, 5),
+    wormcurses.keys.KEY_SDOWN: ("move", wormstate.DOWN, 5),
+    wormcurses.keys.KEY_K: ("move", wormstate.UP, 5),
+    wormcurses.keys.KEY_SUP: ("move", wormstate.UP, 5),
+    wormcurses.keys.KEY_L: ("move", wormstate.RIGHT, 5),
+    curses.KEY_SRIGHT: ("move", wormstate.RIGHT, 5),
+    wormcurses.keys.KEY_a: ("pilot",),
+    wormcurses.keys.KEY_A: ("pilot",),
+    wormcurses.keys.KEY_p: ("pause",),
+    wormcurses.keys.KEY_P: ("pause",),
+    wormcurses.keys.KEY_n: ("new",),
+    wormcurses.keys.KEY_N: ("new",),
+}
+
+def play(tick_rate: float = 1.0, seed=None, board_size=None, level=None,
+        record_path=None, renderer=None, targets: int = 1):
+    """
+    Plays a game in the terminal with the simulation in a process of its
+    own, with targets targets on the board at once. The board fits the
+    screen unless board_size is given as (width, height) or a
+    wormlevel.Level is given. The screen is drawn with
+    renderer, a wormrender.Renderer, or with curses if none is given.
+    Returns the Screen, whose reader counts the frames skipped and which
+    has the exit code of the simulation if it stopped without being told.
+    """
+    stdscr = curses.initscr()
+    curses.noecho()
+    curses.cbreak()
+    curses.curs_set(0)
+    stdscr.keypad(True)
+    memory = None
+    process = None
+    connection = None
+    try:
+        # Keys are read from a tiny window of their own, as reading them
+        # from stdscr refreshes it and could show a frame half drawn
+        if renderer == None:
+            renderer = wormrender.CursesRenderer(stdscr)
+        keyboard = curses.newwin(1, 1, 0, 0)
+        keyboard.keypad(True)
+        keyboard.refresh()
+        renderer.resize()
+        if level != None:
+            (width, height) = (level.width, level.height)
+        elif board_size != None:
+            (width, height) = board_size
+        else:
+            (width, height) = (renderer.play_maxx, renderer.play_maxy)
+
+        memory = shared_memory.SharedMemory(create=True,
+            size=block_size(width, height))
+        (connection, child) = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=simulate, args=(memory,
+            width, height, child, tick_rate, seed, record_path,
+            level.to_bytes() if level != None else None, targets),
+            daemon=True)
+        process.start()
+
+        reader = FrameReader(memory, width, height)
+        screen = Screen(renderer, reader)
+        screen.layout()
+        keyboard.timeout(FRAME_WAIT)
+        first = True
+        while process.is_alive():
+            ch = keyboard.getch()
+            while ch != wormcurses.keys.TIMEOUT:
+                if ch in (wormcurses.keys.KEY_q, wormcurses.keys.KEY_Q):
+                    return screen
+                if ch in (curses.KEY_RESIZE, wormcurses.keys.KEY_CTRL_L,
+                        curses.KEY_REFRESH):
+                    screen.layout()
+                    screen.draw_all()
+                elif ch in KEY_COMMANDS:
+                    connection.send(KEY_COMMANDS[ch])
+                ch = keyboard.getch()
+            if screen.update() and first:
+                # Center the view on where the worm starts
+                first = False
+                screen.layout()
+                screen.draw_all()
+
+        # The simulation stopped without being told to
+        process.join()
+        screen.exit_code = process.exitcode
+        return screen
+    finally:
+        if process != None:
+            try:
+                connection.send(("quit",))
+            except (BrokenPipeError, OSError):
+                pass
+            process.join(1)
+        stdscr.keypad(False)
+        curses.curs_set(1)
+        curses.nocbreak()
+        curses.echo()
+        curses.endwin()
+        if memory != None:
+            memory.close()
+            memory.unlink()
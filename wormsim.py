@@ -0,0 +1,181 @@
+"""
+Headless simulation of many games of worm.
+
+A policy is any callable that takes a WormState and returns a direction
+code from wormstate, or None to keep going the same way. Policies are
+named as "module:function" so that worker processes can import them.
+"""
+
+import concurrent.futures
+import importlib
+import json
+import os
+import sys
+import time
+
+import wormlevel
+import wormprofile
+import wormstate
+
+def greedy(state: wormstate.WormState):
+    """
+    A simple policy that heads for the target along whichever axis is
+    furthest away, preferring moves that don't kill the worm right away.
+    """
+    x, y = state.worm.head()
+    dx = state.target_x - x
+    dy = state.target_y - y
+    moves = []
+    if dx > 0:
+        moves.append(wormstate.RIGHT)
+    elif dx < 0:
+        moves.append(wormstate.LEFT)
+    if dy > 0:
+        moves.append(wormstate.DOWN)
+    elif dy < 0:
+        moves.append(wormstate.UP)
+    if abs(dy) > abs(dx):
+        moves.reverse()
+    moves.extend((wormstate.RIGHT, wormstate.DOWN, wormstate.LEFT,
+        wormstate.UP))
+
+    for d in moves:
+        mx, my = wormstate.DIRECTIONS[d]
+        nx = x + mx
+        ny = y + my
+        if (0 <= nx < state.width and 0 <= ny < state.height and
+                not state.cells.is_occupied(nx, ny)):
+            return d
+    return None
+
+def load_policy(name: str):
+    """Returns the callable named by a "module:function" string"""
+    module, _, function = name.partition(":")
+    return getattr(importlib.import_module(module), function)
+
+def play_game(seed: int, width: int, height: int, policy, max_steps: int,
+        profiler=None, level=None):
+    """
+    Plays one game to the end, or for max_steps steps, and returns a dict
+    describing how it went. If a wormprofile.Profiler is given the steps
+    and the policy are timed into it. If a wormlevel.Level is given the
+    game is played on it instead of an empty board of width by height.
+    """
+    state = wormstate.WormState(wormstate.RingBody)
+    if profiler != None:
+        wormprofile.instrument_state(profiler, state)
+        policy = profiler.wrap("policy", policy)
+    state.reset(width, height, seed, level)
+    steps = 0
+    cause = "Out of steps"
+    while steps < max_steps:
+        d = policy(state)
+        if d != None:
+            state.go(d)
+        result = state.next_step()
+        if result.cause != wormstate.PLAYING:
+            cause = result.message()
+            break
+        steps += 1
+    return {
+        "seed": seed,
+        "score": state.score,
+        "length": len(state.worm),
+        "steps": steps,
+        "cause": cause,
+    }
+
+def play_games(seeds, width: int, height: int, policy_name: str,
+        max_steps: int, profile: bool = False, levels_path=None):
+    """
+    Plays a game for each seed. This is the unit of work handed to each
+    worker process, so several games share the cost of a round trip.
+    Returns the results and, if profile is set, the profile of the games as
+    a dict.
+
+    If levels_path names a wormlevel level pack the game for seed is played
+    on level seed modulo the number of levels. Each worker maps the pack
+    once, so all of them share the one copy of it.
+    """
+    policy = load_policy(policy_name)
+    profiler = wormprofile.Profiler() if profile else None
+    pack = None
+    if levels_path != None:
+        pack = wormlevel.open_pack(levels_path)
+    results = []
+    for seed in seeds:
+        level = None
+        if pack != None:
+            level = pack[seed % len(pack)]
+        result = play_game(seed, width, height, policy, max_steps, profiler,
+            level)
+        if pack != None:
+            result["level"] = seed % len(pack)
+        results.append(result)
+    return (results, profiler.to_dict() if profile else None)
+
+def simulate(games: int, width: int = 80, height: int = 20,
+        policy_name: str = "wormsim:greedy", max_steps: int = 100000,
+        seed: int = 0, workers=None, chunk_size: int = 64, out=sys.stdout,
+        profile_path=None, profile_every: float = 10.0, levels_path=None):
+    """
+    Plays games games with seeds seed, seed + 1, ... spread over a pool of
+    worker processes. Each result is written to out as a line of JSON as
+    soon as its chunk of games finishes, so results arrive in completion
+    order rather than seed order. Returns the number of games played.
+
+    If profile_path is given the games are profiled and the profile of all
+    the games finished so far is exported there, as JSON or as CSV if the
+    path ends in .csv, at most every profile_every seconds and at the end.
+
+    If levels_path names a level pack the games are played on its levels,
+    as play_games describes, rather than on empty boards.
+    """
+    if workers == None:
+        workers = os.cpu_count() or 1
+    profiler = None
+    if profile_path != None:
+        profiler = wormprofile.Profiler()
+    exported = time.monotonic()
+
+    chunks = (range(start, min(start + chunk_size, seed + games))
+        for start in range(seed, seed + games, chunk_size))
+    played = 0
+
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        # Keep a couple of chunks queued per worker so no worker sits idle
+        # without holding every future for a huge sweep in memory
+        pending = set()
+        for seeds in chunks:
+            pending.add(executor.submit(play_games, seeds, width, height,
+                policy_name, max_steps, profiler != None, levels_path))
+            if len(pending) < 2 * workers:
+                continue
+            done, pending = concurrent.futures.wait(pending,
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            played += write_results(done, out, profiler)
+            if (profiler != None and
+                    time.monotonic() - exported >= profile_every):
+                profiler.export(profile_path)
+                exported = time.monotonic()
+        played += write_results(
+            concurrent.futures.wait(pending).done, out, profiler)
+    if profiler != None:
+        profiler.export(profile_path)
+    return played
+
+def write_results(futures, out, profiler=None):
+    """
+    Writes the results of finished futures to out as JSON lines, adding
+    their profiles to profiler if one is given
+    """
+    written = 0
+    for future in futures:
+        (results, profile) = future.result()
+        for result in results:
+            out.write(json.dumps(result) + "\n")
+            written += 1
+        if profiler != None:
+            profiler.merge(wormprofile.Profiler.from_dict(profile))
+    out.flush()
+    return written
@@ -0,0 +1,486 @@
+#!/usr/bin/env python3
+
+"""
+Spectating live games of worm over a local socket.
+
+A SpectatorServer runs an asyncio event loop in a background thread and
+streams the changes of one or more games to any number of viewers. Games
+hand their changes over through a Publisher, which only queues a callback
+on the event loop, so a game never waits on a viewer. Every viewer has its
+own bounded queue; a viewer that falls so far behind that its queue fills
+up has its queue thrown away and is sent a fresh snapshot instead.
+
+Messages are lines of JSON. A viewer connects, sends the name of the game
+it wants to watch on a line of its own and then receives:
+
+    {"type": "snapshot", "width": w, "height": h, "body": [[x, y], ...],
+     "walls": [[x, y], ...], "target": [x, y, value], "score": s, "grow": g,
+     "status": text}
+    {"type": "step", "head": [x, y], "tail": [x, y] or null,
+     "target": [x, y, value], "score": s, "grow": g, "status": text}
+    {"type": "status", "status": text}
+
+The body in a snapshot runs from head to tail and walls are those of the
+level being played, if any. A step only has target, score, grow and status
+when they changed.
+
+Addresses are either "unix:/path/to/socket" or "host:port".
+
+    python wormspectate.py view ADDRESS [GAME]
+    python wormspectate.py bench [--viewers N]
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import os
+import sys
+import threading
+import time
+
+# Messages a viewer can fall behind by before it is resynchronized
+QUEUE_LIMIT = 256
+
+def parse_address(address: str):
+    """Splits an address into ("unix", path) or ("tcp", (host, port))"""
+    if address.startswith("unix:"):
+        return ("unix", address[5:])
+    host, _, port = address.rpartition(":")
+    return ("tcp", (host or "127.0.0.1", int(port)))
+
+class Channel(object):
+    """
+    The server's own copy of a game, kept up to date from the messages
+    published for it so that snapshots never have to touch the game.
+    """
+
+    def __init__(self):
+        self.snapshot = None
+        self.body = collections.deque()
+        self.viewers = set()
+
+    def apply(self, message: dict):
+        """Update the copy of the game from a published message"""
+        if message["type"] == "snapshot":
+            self.snapshot = dict(message)
+            self.body = collections.deque(message["body"])
+            return
+        if message["type"] == "step":
+            self.body.appendleft(message["head"])
+            if message["tail"] != None:
+                self.body.pop()
+        for field in ("target", "score", "grow", "status"):
+            if field in message:
+                self.snapshot[field] = message[field]
+
+    def encode_snapshot(self):
+        """Returns a snapshot of the game as a line of JSON"""
+        self.snapshot["body"] = list(self.body)
+        return (json.dumps(self.snapshot) + "\n").encode()
+
+class Viewer(object):
+    """A connected viewer and the messages waiting to be sent to it"""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.queue = collections.deque()
+        self.ready = asyncio.Event()
+        self.resync = True
+        self.resyncs = 0
+
+class SpectatorServer(object):
+    """
+    Serves the games published to it to viewers on a Unix domain socket or
+    a localhost TCP port.
+    """
+
+    def __init__(self, address: str):
+        self.address = address
+        self.channels = {}
+        self.loop = None
+        self.thread = None
+
+    def start(self):
+        """Starts serving on a background thread"""
+        started = threading.Event()
+        self.thread = threading.Thread(target=self.serve, args=(started,),
+            daemon=True)
+        self.thread.start()
+        started.wait()
+
+    def stop(self):
+        """Stops serving and waits for the background thread to finish"""
+        asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    async def shutdown(self):
+        """Disconnects every viewer. Runs on the server thread."""
+        self.server.close()
+        tasks = [task for task in asyncio.all_tasks()
+            if task != asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def serve(self, started: threading.Event):
+        """Runs the event loop. This is the body of the server thread."""
+        self.loop = asyncio.new_event_loop()
+        (kind, where) = parse_address(self.address)
+        if kind == "unix":
+            if os.path.exists(where):
+                os.unlink(where)
+            server = asyncio.start_unix_server(self.handle_viewer, where,
+                backlog=1024)
+        else:
+            server = asyncio.start_server(self.handle_viewer, *where,
+                backlog=1024)
+        self.server = self.loop.run_until_complete(server)
+        started.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.server.close()
+            self.loop.close()
+
+    def call(self, function, *args):
+        """
+        Calls function with args on the server thread, where the channels
+        and their viewers change, waits for it and returns what it returned
+        """
+        async def run():
+            return function(*args)
+        return asyncio.run_coroutine_threadsafe(run(), self.loop).result()
+
+    def channel(self, name: str):
+        """Returns the named channel, creating it if needed"""
+        channel = self.channels.get(name)
+        if channel == None:
+            channel = self.channels[name] = Channel()
+        return channel
+
+    def publish(self, name: str, message: dict):
+        """
+        Hands a message for the named game to the server. This is safe to
+        call from any thread and returns without waiting for the server.
+        """
+        self.loop.call_soon_threadsafe(self.dispatch, name, message)
+
+    def dispatch(self, name: str, message: dict):
+        """Applies a message to its channel and queues it for its viewers"""
+        channel = self.channel(name)
+        channel.apply(message)
+        if message["type"] == "snapshot":
+            # Everyone needs to start over with the new game
+            for viewer in channel.viewers:
+                viewer.resync = True
+                viewer.ready.set()
+            return
+
+        data = (json.dumps(message) + "\n").encode()
+        for viewer in channel.viewers:
+            if viewer.resync:
+                continue
+            if len(viewer.queue) >= QUEUE_LIMIT:
+                # Too far behind. Drop what it hasn't seen and start over.
+                viewer.queue.clear()
+                viewer.resync = True
+                viewer.resyncs += 1
+            else:
+                viewer.queue.append(data)
+            viewer.ready.set()
+
+    async def handle_viewer(self, reader, writer):
+        """Streams the game a viewer asks for until it disconnects"""
+        name = (await reader.readline()).decode().strip()
+        channel = self.channel(name)
+        viewer = Viewer(writer)
+        channel.viewers.add(viewer)
+        viewer.ready.set()
+        try:
+            while True:
+                await viewer.ready.wait()
+                viewer.ready.clear()
+                if viewer.resync and channel.snapshot != None:
+                    # The snapshot covers anything still queued
+                    viewer.queue.clear()
+                    viewer.resync = False
+                    writer.write(channel.encode_snapshot())
+                while viewer.queue:
+                    writer.write(viewer.queue.popleft())
+                await writer.drain()
+        except (ConnectionError, OSError, asyncio.CancelledError):
+            pass
+        finally:
+            channel.viewers.discard(viewer)
+            writer.close()
+
+class Publisher(object):
+    """
+    Turns changes to a WormState into messages for one game on a
+    SpectatorServer.
+    """
+
+    def __init__(self, server: SpectatorServer, name: str = ""):
+        self.server = server
+        self.name = name
+
+    def snapshot(self, state, status: str = ""):
+        """
+        Publish the whole of the game. This is used when a game starts and
+        when it ends, since the last step of a game may not be a plain move.
+        """
+        self.status = status
+        self.server.publish(self.name, {
+            "type": "snapshot",
+            "width": state.width,
+            "height": state.height,
+            "body": list(state.worm),
+            "walls": list(state.level.wall_cells()) if state.level else [],
+            "target": [state.target_x, state.target_y, state.target_value],
+            "score": state.score,
+            "grow": state.grow_count,
+            "status": status,
+        })
+
+    def step(self, state, result):
+        """
+        Publish a step the worm took without ending the game, given the
+        wormstate.StepResult next_step returned. Only the fields the step
+        changed are sent.
+        """
+        self.publish_step(state, result.head, result.tail, result.eaten,
+            result.grow)
+
+    def advance(self, state, result):
+        """
+        Publish the steps of a wormstate.AdvanceResult that didn't end the
+        game, one message per step. What changed over all of them goes with
+        the last.
+        """
+        count = len(result.heads)
+        for i in range(count - 1):
+            self.server.publish(self.name, {"type": "step",
+                "head": result.heads[i], "tail": result.tails[i]})
+        if count:
+            self.publish_step(state, result.heads[-1], result.tails[-1],
+                result.eaten, result.grow)
+
+    def publish_step(self, state, head, tail, eaten: int, grow: int):
+        """Publish a step, with the target, score and grow if they changed"""
+        message = {"type": "step", "head": head, "tail": tail}
+        if eaten:
+            message["target"] = [state.target_x, state.target_y,
+                state.target_value]
+            message["score"] = state.score
+        if grow:
+            message["grow"] = state.grow_count
+        self.server.publish(self.name, message)
+
+    def set_status(self, status: str):
+        """Publish a new status line"""
+        if status != self.status:
+            self.status = status
+            self.server.publish(self.name, {"type": "status",
+                "status": status})
+
+class Board(object):
+    """A viewer's copy of a game, rebuilt from the stream of messages"""
+
+    def __init__(self):
+        self.width = self.height = 0
+        self.cells = {}
+        self.head = None
+        self.target = None
+        self.score = self.grow = 0
+        self.status = ""
+
+    def apply(self, message: dict):
+        """Update the board from a message"""
+        if message["type"] == "snapshot":
+            self.width = message["width"]
+            self.height = message["height"]
+            self.cells = {tuple(xy): '#' for xy in message.get("walls", ())}
+            self.cells.update((tuple(xy), 'o') for xy in message["body"])
+            self.head = tuple(message["body"][0]) if message["body"] else None
+            if self.head != None:
+                self.cells[self.head] = '@'
+        elif message["type"] == "step":
+            if self.head != None:
+                self.cells[self.head] = 'o'
+            if message["tail"] != None:
+                self.cells.pop(tuple(message["tail"]), None)
+            self.head = tuple(message["head"])
+            self.cells[self.head] = '@'
+        for field in ("target", "score", "grow", "status"):
+            if field in message:
+                setattr(self, field, message[field])
+
+    def render(self):
+        """Returns the board as text with a header and status line"""
+        rows = [[' '] * self.width for y in range(self.height)]
+        for (x, y), c in self.cells.items():
+            rows[y][x] = c
+        if self.target != None and self.target[2] != None:
+            rows[self.target[1]][self.target[0]] = str(self.target[2])
+        lines = ["Grow By: %-6d Score: %d" % (self.grow, self.score),
+            "+" + "-" * self.width + "+"]
+        lines.extend("|" + "".join(row) + "|" for row in rows)
+        lines.append("+" + "-" * self.width + "+")
+        lines.append(self.status)
+        return "\n".join(lines)
+
+async def connect(address: str, name: str):
+    """Connects to a server and asks for a game. Returns (reader, writer)"""
+    (kind, where) = parse_address(address)
+    if kind == "unix":
+        (reader, writer) = await asyncio.open_unix_connection(where,
+            limit=2 ** 24)
+    else:
+        (reader, writer) = await asyncio.open_connection(*where,
+            limit=2 ** 24)
+    writer.write((name + "\n").encode())
+    await writer.drain()
+    return (reader, writer)
+
+async def view(address: str, name: str, fps: float = 30.0):
+    """Draws a game on the terminal with ANSI escapes until it closes"""
+    (reader, writer) = await connect(address, name)
+    board = Board()
+    drawn = 0.0
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        board.apply(json.loads(line))
+        now = time.monotonic()
+        if now - drawn >= 1 / fps:
+            drawn = now
+            sys.stdout.write("\x1b[H\x1b[2J" + board.render() + "\n")
+            sys.stdout.flush()
+    writer.close()
+
+async def count_messages(address: str, name: str, viewers: int,
+        slow: int, seconds: float):
+    """
+    Connects viewers viewers, the first slow of which stall for a while
+    after each message, and returns how many messages they received.
+    """
+    async def watch(stall):
+        (reader, writer) = await connect(address, name)
+        received = 0
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                received += 1
+                if stall:
+                    await asyncio.sleep(0.01)
+        finally:
+            writer.close()
+        return received
+
+    tasks = [asyncio.ensure_future(watch(i < slow))
+        for i in range(viewers)]
+    await asyncio.sleep(seconds)
+    for task in tasks:
+        task.cancel()
+    return sum(task.result() if task.done() and not task.cancelled() else 0
+        for task in tasks)
+
+def run_watchers(address: str, name: str, viewers: int, slow: int,
+        seconds: float):
+    """
+    Runs count_messages in a process of its own. It's a plain function so
+    the process can be started however multiprocessing starts them.
+    """
+    asyncio.run(count_messages(address, name, viewers, slow, seconds))
+
+def bench(viewers: int, slow: int, ticks: int, rate: float):
+    """
+    Plays a game headless at rate ticks a second while publishing it to
+    viewers connected from another process, and reports how long
+    publishing took per tick.
+    """
+    import multiprocessing
+    import tempfile
+
+    import wormsim
+    import wormstate
+
+    address = "unix:" + os.path.join(tempfile.mkdtemp(), "worm.sock")
+    server = SpectatorServer(address)
+    server.start()
+    publisher = Publisher(server, "bench")
+
+    watchers = multiprocessing.Process(target=run_watchers, args=(address,
+        "bench", viewers, slow, 3600), daemon=True)
+    watchers.start()
+
+    # The viewers are only looked at on the server thread, which adds them
+    def connected():
+        return len(server.channel("bench").viewers)
+    while server.call(connected) < viewers:
+        time.sleep(0.05)
+
+    state = wormstate.WormState(wormstate.RingBody)
+    state.reset(78, 20, 0)
+    publisher.snapshot(state)
+    costs = []
+    start = time.perf_counter()
+    for i in range(ticks):
+        delay = start + i / rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        d = wormsim.greedy(state)
+        if d != None:
+            state.go(d)
+        result = state.next_step()
+        t = time.perf_counter_ns()
+        if result.cause != wormstate.PLAYING:
+            publisher.snapshot(state, result.message())
+            state.reset(78, 20, i)
+            publisher.snapshot(state)
+        else:
+            publisher.step(state, result)
+        costs.append(time.perf_counter_ns() - t)
+    elapsed = time.perf_counter() - start
+
+    # Let the server catch up before counting resyncs
+    time.sleep(1)
+    resyncs = server.call(lambda: sum(v.resyncs
+        for v in server.channel("bench").viewers))
+    costs.sort()
+    print("%d viewers (%d slow): %.0f ticks/s, publish p50 %dns p99 %dns, "
+        "%d resyncs" % (viewers, slow, ticks / elapsed,
+        costs[len(costs) // 2], costs[len(costs) * 99 // 100], resyncs))
+    watchers.terminate()
+    server.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description="Watch games of worm")
+    commands = parser.add_subparsers(dest="command", required=True)
+    v = commands.add_parser("view", help="watch a game")
+    v.add_argument("address", help="unix:/path or host:port")
+    v.add_argument("game", nargs="?", default="", help="game to watch")
+    b = commands.add_parser("bench", help="measure publishing overhead")
+    b.add_argument("--viewers", type=int, default=300)
+    b.add_argument("--slow", type=int, default=10,
+        help="viewers that read too slowly to keep up")
+    b.add_argument("--ticks", type=int, default=10000)
+    b.add_argument("--rate", type=float, default=1000.0,
+        help="ticks per second to play the game at")
+    args = parser.parse_args()
+
+    if args.command == "view":
+        try:
+            asyncio.run(view(args.address, args.game))
+        except KeyboardInterrupt:
+            pass
+    else:
+        bench(args.viewers, args.slow, args.ticks, args.rate)
+
+if __name__ == "__main__":
+    main()
@@ -1,32 +1,522 @@
 import random
 import time
+from array import array
+
 import yoke
 
+# Direction codes and the (dx, dy) each one moves the head by
+RIGHT, LEFT, DOWN, UP = range(4)
+DIRECTIONS = ((1, 0), (-1, 0), (0, 1), (0, -1))
+
+# Codes for how a step ended the game, with PLAYING for a step that didn't
+# and OVER for a step taken after the game had already ended
+PLAYING, WALL, SELF, FULL, OVER = range(5)
+
+# What to tell the player for each of those codes
+CAUSES = ("", "You ran into a wall!", "The worm ran into itself!",
+    "The worm filled the board!", "Game Over!")
+
+class StepResult(object):
+    """
+    Everything a step of WormState.next_step changed, so that whatever
+    shows or records the game can do just what the step calls for.
+
+    head is the (x, y) of the new head, or None if the worm didn't move.
+    tail is the (x, y) of the tail that was dropped, or None if the worm
+    grew or didn't move. eaten is the value of the target eaten, which is
+    also what the score went up by, or 0 if none was. grow is how much the
+    grow count changed by. cause is PLAYING, or the code for how the step
+    ended the game. crash is the cell the worm crashed into, which is off
+    the board for a wall, or None. placed is the (x, y, value) of the
+    target placed in place of the one eaten, or None if none was. Targets
+    only ever change when one is eaten.
+    """
+
+    __slots__ = ("head", "tail", "eaten", "grow", "cause", "crash",
+        "placed")
+
+    def __init__(self, head, tail, eaten: int, grow: int, cause: int,
+            crash=None, placed=None):
+        self.head = head
+        self.tail = tail
+        self.eaten = eaten
+        self.grow = grow
+        self.cause = cause
+        self.crash = crash
+        self.placed = placed
+
+    def message(self):
+        """Returns what to tell the player about how the game ended"""
+        return CAUSES[self.cause]
+
+# Why WormState.advance stopped: it took every step it was asked to, a
+# target was eaten, or the game ended
+FINISHED, ATE, DIED = range(3)
+
+class AdvanceResult(object):
+    """
+    Everything a call to WormState.advance changed, over all its steps.
+
+    steps is the number of steps taken, counting one that ended the game.
+    heads holds the (x, y) of each new head in turn and tails, alongside
+    it, the (x, y) of the tail dropped by the same step or None if the worm
+    grew. eaten is what the score went up by, grow how much the grow count
+    changed by, and cause and crash are as in StepResult for the step that
+    ended the game, if one did. placed holds the (x, y, value) of every
+    target placed. stop is FINISHED, ATE or DIED.
+    """
+
+    __slots__ = ("steps", "heads", "tails", "eaten", "grow", "cause",
+        "crash", "placed", "stop")
+
+    def __init__(self):
+        self.steps = 0
+        self.heads = []
+        self.tails = []
+        self.eaten = 0
+        self.grow = 0
+        self.cause = PLAYING
+        self.crash = None
+        self.placed = []
+        self.stop = FINISHED
+
+    def head(self):
+        """Returns the (x, y) of the last new head, or None"""
+        return self.heads[-1] if self.heads else None
+
+    def vacated(self):
+        """Returns the (x, y) of every tail dropped, in order"""
+        return [xy for xy in self.tails if xy != None]
+
+    def add(self, result: StepResult):
+        """Adds the changes of one step to the totals"""
+        self.steps += 1
+        if result.head != None:
+            self.heads.append(result.head)
+            self.tails.append(result.tail)
+        self.eaten += result.eaten
+        self.grow += result.grow
+        self.cause = result.cause
+        self.crash = result.crash
+        if result.placed != None:
+            self.placed.append(result.placed)
+
+    def message(self):
+        """Returns what to tell the player about how the game ended"""
+        return CAUSES[self.cause]
+
+class CellIndex(object):
+    """
+    Keeps track of which cells of the play area are taken by the worm.
+
+    Occupancy is a bytearray indexed by y * width + x. Next to it is a dense
+    array of all free cells plus, for every cell, its position in that
+    array. Claiming a cell swaps the last free cell into its slot, and
+    releasing a cell appends it, so both are O(1) and a random free cell can
+    be picked with a single draw.
+    """
+
+    def __init__(self, width: int, height: int):
+        self.width = width
+        self.height = height
+        self.occupied = bytearray(width * height)
+        self.free = array('i', range(width * height))
+        self.position = array('i', range(width * height))
+
+    def is_occupied(self, x: int, y: int):
+        """Returns true if the cell at x, y is taken"""
+        return self.occupied[y * self.width + x]
+
+    def occupy(self, x: int, y: int):
+        """
+        Marks the cell at x, y as taken and drops it from the free cells.
+        Returns the slot the cell had in the free cells, which unoccupy
+        needs to undo this.
+        """
+        i = y * self.width + x
+        self.occupied[i] = 1
+        p = self.position[i]
+        last = self.free.pop()
+        if last != i:
+            self.free[p] = last
+            self.position[last] = p
+        return p
+
+    def vacate(self, x: int, y: int):
+        """Marks the cell at x, y as free again"""
+        i = y * self.width + x
+        self.occupied[i] = 0
+        self.position[i] = len(self.free)
+        self.free.append(i)
+
+    def unoccupy(self, x: int, y: int, p: int):
+        """
+        Exactly undoes occupy of the cell at x, y, which returned p, so the
+        free cells end up in the same order as before.
+        """
+        i = y * self.width + x
+        self.occupied[i] = 0
+        if p < len(self.free):
+            moved = self.free[p]
+            self.position[moved] = len(self.free)
+            self.free.append(moved)
+            self.free[p] = i
+        else:
+            self.free.append(i)
+        self.position[i] = p
+
+    def unvacate(self, x: int, y: int):
+        """Exactly undoes the last vacate, which must have been of x, y"""
+        self.occupied[y * self.width + x] = 1
+        self.free.pop()
+
+    def free_count(self):
+        """Returns the number of cells not taken by the worm"""
+        return len(self.free)
+
+    def random_free(self, prng: random.Random):
+        """
+        Returns the (x, y) of a free cell chosen with prng, or None if every
+        cell is taken.
+        """
+        if not self.free:
+            return None
+        i = self.free[prng.randrange(len(self.free))]
+        return (i % self.width, i // self.width)
+
+# Boards with more cells than this keep their occupancy in a SparseCellIndex
+# and start the worm's body small, so memory follows the worm's length
+# rather than the size of the board
+SPARSE_AREA = 1 << 22
+
+# Sparse occupancy is kept in square chunks of 1 << CHUNK_BITS cells a side
+CHUNK_BITS = 6
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+# Random cells SparseCellIndex.random_free tries before it counts its way
+# to a free cell instead, and cells in a level's target zones tried before
+# settling for a free cell anywhere. Multi-target games also give up on
+# placing a target after this many free cells that already have one.
+RANDOM_TRIES = 64
+
+class SparseCellIndex(object):
+    """
+    Keeps track of which cells are taken by the worm on boards too big for
+    CellIndex. The board is split into square chunks and only chunks with
+    at least one taken cell have a bytearray, so memory grows with the
+    length of the worm and not the area of the board.
+
+    There is no list of free cells. A random free cell is found by drawing
+    random cells until one is free, which almost always succeeds at once
+    since the worm covers a tiny part of a huge board. If it keeps missing
+    the free cells are counted through chunk by chunk instead.
+    """
+
+    def __init__(self, width: int, height: int):
+        self.width = width
+        self.height = height
+        self.across = (width + CHUNK_MASK) >> CHUNK_BITS
+        self.chunks = {}    # Chunk number to a bytearray of its cells
+        self.counts = {}    # Chunk number to the number of its cells taken
+        self.taken = 0
+        self.misses = 0     # Random cells random_free found taken
+
+    def is_occupied(self, x: int, y: int):
+        """Returns true if the cell at x, y is taken"""
+        chunk = self.chunks.get((y >> CHUNK_BITS) * self.across +
+            (x >> CHUNK_BITS))
+        if chunk == None:
+            return 0
+        return chunk[(y & CHUNK_MASK) << CHUNK_BITS | (x & CHUNK_MASK)]
+
+    def occupy(self, x: int, y: int):
+        """
+        Marks the cell at x, y as taken. Returns 0 to match CellIndex, as
+        there is no slot to remember for unoccupy.
+        """
+        key = (y >> CHUNK_BITS) * self.across + (x >> CHUNK_BITS)
+        chunk = self.chunks.get(key)
+        if chunk == None:
+            chunk = self.chunks[key] = bytearray(1 << 2 * CHUNK_BITS)
+            self.counts[key] = 0
+        chunk[(y & CHUNK_MASK) << CHUNK_BITS | (x & CHUNK_MASK)] = 1
+        self.counts[key] += 1
+        self.taken += 1
+        return 0
+
+    def vacate(self, x: int, y: int):
+        """Marks the cell at x, y as free again, dropping empty chunks"""
+        key = (y >> CHUNK_BITS) * self.across + (x >> CHUNK_BITS)
+        self.chunks[key][(y & CHUNK_MASK) << CHUNK_BITS | (x & CHUNK_MASK)] = 0
+        self.taken -= 1
+        self.counts[key] -= 1
+        if self.counts[key] == 0:
+            del self.chunks[key]
+            del self.counts[key]
+
+    def unoccupy(self, x: int, y: int, p: int):
+        """Exactly undoes occupy of the cell at x, y"""
+        self.vacate(x, y)
+
+    def unvacate(self, x: int, y: int):
+        """Exactly undoes the last vacate, which must have been of x, y"""
+        self.occupy(x, y)
+
+    def free_count(self):
+        """Returns the number of cells not taken by the worm"""
+        return self.width * self.height - self.taken
+
+    def random_free(self, prng: random.Random):
+        """
+        Returns the (x, y) of a free cell chosen with prng, or None if every
+        cell is taken.
+        """
+        free = self.free_count()
+        if free == 0:
+            return None
+        for i in range(RANDOM_TRIES):
+            x = prng.randrange(self.width)
+            y = prng.randrange(self.height)
+            if not self.is_occupied(x, y):
+                return (x, y)
+            self.misses += 1
+
+        # The board is crowded. Pick which free cell we want and count
+        # through the chunks in order to find it.
+        n = prng.randrange(free)
+        size = 1 << CHUNK_BITS
+        down = (self.height + CHUNK_MASK) >> CHUNK_BITS
+        for key in range(self.across * down):
+            cx = (key % self.across) << CHUNK_BITS
+            cy = (key // self.across) << CHUNK_BITS
+            w = min(size, self.width - cx)
+            h = min(size, self.height - cy)
+            chunk_free = w * h - self.counts.get(key, 0)
+            if n >= chunk_free:
+                n -= chunk_free
+                continue
+            for y in range(cy, cy + h):
+                for x in range(cx, cx + w):
+                    if not self.is_occupied(x, y):
+                        if n == 0:
+                            return (x, y)
+                        n -= 1
+
+class LinkedBody(object):
+    """
+    The segments of the worm kept as a circular list of yoke.Node nodes.
+    The sentinel's left neighbor is the head and its right neighbor is the
+    tail. The sentinel reuses the node of each tail dropped for the next
+    head, so moving without growing allocates nothing.
+    """
+
+    def __init__(self, capacity: int):
+        # Sentinel node for linked list. A linked list has no fixed
+        # capacity so that argument is ignored.
+        self.sentinel = yoke.Sentinel()
+
+    def __len__(self):
+        return self.sentinel.length
+
+    def __iter__(self):
+        """Yields the (x, y) of every segment from the head to the tail"""
+        for w in reversed(self.sentinel):
+            yield (w.x, w.y)
+
+    def push_head(self, x: int, y: int):
+        """Adds a new head at x, y"""
+        self.sentinel.push_left(x, y)
+
+    def pop_tail(self):
+        """Removes the tail and returns its (x, y)"""
+        tail = self.sentinel.pop_right()
+        return (tail.x, tail.y)
+
+    def pop_head(self):
+        """Removes the head and returns its (x, y)"""
+        head = self.sentinel.pop_left()
+        return (head.x, head.y)
+
+    def push_tail(self, x: int, y: int):
+        """Adds a new tail at x, y"""
+        self.sentinel.push_right(x, y)
+
+    def head(self):
+        """Returns the (x, y) of the head"""
+        w = self.sentinel.left
+        return (w.x, w.y)
+
+    def neck(self):
+        """Returns the (x, y) of the segment behind the head, or None"""
+        w = self.sentinel.left.left
+        if w == self.sentinel:
+            return None
+        return (w.x, w.y)
+
+    def tail(self):
+        """Returns the (x, y) of the tail"""
+        w = self.sentinel.right
+        return (w.x, w.y)
+
+class RingBody(object):
+    """
+    The segments of the worm kept in a ring buffer of coordinates. The head
+    moves forward through the buffer and the tail follows it, so stepping
+    the worm only overwrites two integers and never allocates. If the worm
+    outgrows the buffer its capacity is doubled, so on huge boards it can
+    start small and only take as much memory as the worm needs.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.xs = array('i', bytes(4 * capacity))
+        self.ys = array('i', bytes(4 * capacity))
+        self.head_index = capacity - 1   # Slot of the head
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        """Yields the (x, y) of every segment from the head to the tail"""
+        i = self.head_index
+        for n in range(self.length):
+            yield (self.xs[i], self.ys[i])
+            i = i - 1 if i else self.capacity - 1
+
+    def grow(self):
+        """Doubles the capacity, laying the segments out from the tail"""
+        capacity = max(2 * self.capacity, 1)
+        xs = array('i', bytes(4 * capacity))
+        ys = array('i', bytes(4 * capacity))
+        i = self.length
+        for (x, y) in self:
+            i -= 1
+            xs[i] = x
+            ys[i] = y
+        self.xs = xs
+        self.ys = ys
+        self.capacity = capacity
+        self.head_index = self.length - 1 if self.length else capacity - 1
+
+    def push_head(self, x: int, y: int):
+        """Adds a new head at x, y"""
+        if self.length == self.capacity:
+            self.grow()
+        i = self.head_index + 1
+        if i == self.capacity:
+            i = 0
+        self.xs[i] = x
+        self.ys[i] = y
+        self.head_index = i
+        self.length += 1
+
+    def pop_tail(self):
+        """Removes the tail and returns its (x, y)"""
+        i = self.head_index - self.length + 1
+        if i < 0:
+            i += self.capacity
+        self.length -= 1
+        return (self.xs[i], self.ys[i])
+
+    def pop_head(self):
+        """Removes the head and returns its (x, y)"""
+        i = self.head_index
+        self.head_index = i - 1 if i else self.capacity - 1
+        self.length -= 1
+        return (self.xs[i], self.ys[i])
+
+    def push_tail(self, x: int, y: int):
+        """Adds a new tail at x, y"""
+        if self.length == self.capacity:
+            self.grow()
+        i = self.head_index - self.length
+        if i < 0:
+            i += self.capacity
+        self.xs[i] = x
+        self.ys[i] = y
+        self.length += 1
+
+    def head(self):
+        """Returns the (x, y) of the head"""
+        i = self.head_index
+        return (self.xs[i], self.ys[i])
+
+    def neck(self):
+        """Returns the (x, y) of the segment behind the head, or None"""
+        if self.length < 2:
+            return None
+        i = self.head_index - 1 if self.head_index else self.capacity - 1
+        return (self.xs[i], self.ys[i])
+
+    def tail(self):
+        """Returns the (x, y) of the tail"""
+        i = self.head_index - self.length + 1
+        if i < 0:
+            i += self.capacity
+        return (self.xs[i], self.ys[i])
+
 class WormState(object):
     """
     This class encapsulates the state of a game of worm.
     """
 
-    def reset(self, width: int, height: int):
+    def __init__(self, body_class=LinkedBody):
         """
-        Starts a new game with a specific with and height
+        body_class chooses how the worm's segments are stored. LinkedBody
+        uses a yoke.Node per segment while RingBody uses a preallocated
+        ring buffer.
         """
+        self.body_class = body_class
+
+        # Callables given the WormState and the StepResult of every step
+        self.listeners = []
+
+    def reset(self, width: int, height: int, seed=None, level=None,
+            targets: int = 1):
+        """
+        Starts a new game with a specific with and height. Games started
+        with the same seed play out identically given the same moves. If
+        level is given, a wormlevel.Level, the board has its size, walls,
+        spawn point and target zones and width and height are ignored.
+        targets is how many targets are on the board at once.
+        """
+        if level != None:
+            width = level.width
+            height = level.height
+        self.level = level
 
         # Size of the play area
         self.width = width
         self.height = height
 
         # Initial direction is to the right
-        self.dx, self.dy = 1, 0
+        self.go(RIGHT)
 
-        # Sentinel node for linked list
-        self.worm = yoke.Yoke()
+        # Segments of the worm from head to tail, and the cells taken by the
+        # worm. The cells mirror the body so that collisions can be checked
+        # and targets placed without walking the worm. Huge boards use
+        # structures that grow with the worm instead of the board.
+        if width * height <= SPARSE_AREA:
+            self.worm = self.body_class(width * height)
+            self.cells = CellIndex(width, height)
+        else:
+            self.worm = self.body_class(1 << 2 * CHUNK_BITS)
+            self.cells = SparseCellIndex(width, height)
 
-        # Start with the worm's head at the center
-        w = yoke.Yoke()
-        w.x = width // 2
-        w.y = height // 2
-        self.worm.insert_left(w)
+        # Walls are cells the worm can never have, so taking them up front
+        # means they cost nothing when moving or placing targets
+        if level != None:
+            for (x, y) in level.wall_cells():
+                self.cells.occupy(x, y)
+
+        # Start with the worm's head at the center or the level's spawn point
+        x = width // 2
+        y = height // 2
+        if level != None:
+            (x, y) = level.spawn
+        self.worm.push_head(x, y)
+        self.cells.occupy(x, y)
 
         # No growth until number eaten
         self.grow_count = 0
@@ -34,108 +524,371 @@ class WormState(object):
         # Score starts at 0
         self.score = 0
 
-        # Random number generator using current time as seed
-        # TODO - allow specifying seed on command line
-        self.prng = random.Random(time.time()) # Random number generator
+        # Random number generator using current time as seed if none given
+        if seed == None:
+            seed = time.time_ns()
+        self.seed = seed
+        self.prng = random.Random(seed) # Random number generator
+
+        # Number of steps taken so far
+        self.ticks = 0
 
-        # Generate a target number for the worm to eat
-        self.generate_target()
+        # Undo information for each step, kept only once snapshot is called
+        self.history = None
 
         # Ready to play
         self.game_over = False
 
+        # Targets by the index y * width + x of their cell, so finding the
+        # one under the head takes a single lookup however many there are.
+        # target_x, target_y and target_value are the newest target, which
+        # is the only one unless more were asked for.
+        self.target_count = targets
+        self.targets = {}
+
+        # Generate target numbers for the worm to eat
+        if not self.generate_target():
+            self.game_over = True
+        for i in range(targets - 1):
+            self.generate_target()
+
     def generate_target(self):
         """
         Generates a random number between 1 and 9 in a screen location
-        that isn't occupied by the worm.
+        that isn't occupied by the worm, a wall or another target, in the
+        level's target zones if it can. In a single-target game it replaces
+        the target. Returns False, leaving no target, if the worm fills
+        the whole play area.
+
+        A multi-target game where every free cell it tries already has a
+        target goes without the new one, as the worm has plenty to eat.
         """
+        width = self.width
+        targets = self.targets
+        if self.target_count == 1:
+            targets.clear()
+
         # Generate a number between 1 and 9 for the target
         tv = self.prng.randint(1, 9)
 
-        # Keep trying to generate a target that doesn't collide with worm
-        still_searching = True
-        while still_searching:
-            # Generate a random, x and y for the target
-            tx = self.prng.randint(0, self.width - 1)
-            ty = self.prng.randint(0, self.height - 1)
-
-            # Make sure no elements in the worm collide with the position
-            w = self.worm.left
-            still_searching = False
-            while w != self.worm:
-                if tx == w.x and ty == w.y:
-                    # We have a conflict. Generate another
-                    still_searching = True
+        # Try the level's target zones first, if it has any
+        xy = None
+        if self.level != None and self.level.zones:
+            for i in range(RANDOM_TRIES):
+                (x, y) = self.level.zone_cell(self.prng)
+                if (not self.cells.is_occupied(x, y) and
+                        y * width + x not in targets):
+                    xy = (x, y)
                     break
-                w = w.left
 
-        # No collisions with worm. Safe to use generated target
-        self.target_x = tx
-        self.target_y = ty
+        # Pick straight from the free cells so we never collide with the worm
+        if xy == None:
+            for i in range(RANDOM_TRIES):
+                xy = self.cells.random_free(self.prng)
+                if xy == None or xy[1] * width + xy[0] not in targets:
+                    break
+            else:
+                self.newest_target()
+                return True
+        if xy == None:
+            self.target_x, self.target_y = -1, -1
+            self.target_value = None
+            return False
+
+        self.target_x, self.target_y = xy
         self.target_value = tv
-        return
+        targets[xy[1] * width + xy[0]] = tv
+        return True
+
+    def newest_target(self):
+        """
+        Points target_x, target_y and target_value at a target still on
+        the board after the newest was eaten without a new one placed
+        """
+        i = self.target_y * self.width + self.target_x
+        if self.target_value != None and i in self.targets:
+            return
+        self.target_x, self.target_y = -1, -1
+        self.target_value = None
+        for (i, value) in self.targets.items():
+            self.target_x = i % self.width
+            self.target_y = i // self.width
+            self.target_value = value
+            break
+
+    def target_cells(self):
+        """Yields the (x, y, value) of every target on the board"""
+        width = self.width
+        for (i, value) in self.targets.items():
+            yield (i % width, i // width, value)
 
     def next_step(self):
         """
-        Advances the game by a single step
+        Advances the game by a single step and returns a StepResult saying
+        what changed, after handing it to each listener.
         """
         # Make sure we're still playing
+        history = self.history
         if self.game_over:
-            return (None, "Game Over!")
+            if history != None:
+                history.append(None)
+            return self.report(StepResult(None, None, 0, 0, OVER))
+
+        # Remember what undo_step will need to put back
+        if history != None:
+            before = (self.ticks, self.grow_count, self.score,
+                self.target_x, self.target_y, self.target_value)
+        self.ticks += 1
 
         # Get the position of the current head and figure out new position
-        w = self.worm.left
-        x = w.x + self.dx
-        y = w.y + self.dy
+        x, y = self.worm.head()
+        x += self.dx
+        y += self.dy
 
         # See if we ran into a wall
         if x < 0 or x >= self.width or y < 0 or y >= self.height:
             self.game_over = True
-            return ((x, y), "You ran into a wall!")
+            if history != None:
+                history.append(before + (None, None, None, 0, None))
+            return self.report(StepResult(None, None, 0, 0, WALL, (x, y)))
 
-        # See if the worm ran into itself
-        w = self.worm.left
-        while w != self.worm:
-            if x == w.x and y == w.y:
-                self.game_over = True
-                return ((x, y), "The worm ran into itself!")
-            w = w.left
+        # See if the worm ran into itself or a wall of the level
+        if self.cells.is_occupied(x, y):
+            self.game_over = True
+            if history != None:
+                history.append(before + (None, None, None, 0, None))
+            cause = SELF
+            if self.level != None and self.level.is_wall(x, y):
+                cause = WALL
+            return self.report(StepResult(None, None, 0, 0, cause, (x, y)))
 
-        # Create a new head and put it at the head of the list
-        head = yoke.Yoke()
-        head.x = x
-        head.y = y
-        self.worm.insert_left(head)
+        # Put a new head at the front of the worm
+        self.worm.push_head(x, y)
+        p = self.cells.occupy(x, y)
 
         # If we are not growing, delete the tail of the worm
         old_xy = None
+        grow = 0
         if self.grow_count == 0:
-            tail = self.worm.right
-            tail.remove()
-            old_xy = (tail.x, tail.y)
+            old_xy = self.worm.pop_tail()
+            self.cells.vacate(*old_xy)
         else:
             self.grow_count -= 1
+            grow = -1
 
-        # If head has hit the target add to grow count and generate new target
-        if self.target_x == head.x and self.target_y == head.y:
-            self.grow_count += self.target_value
-            self.score += self.target_value
-            self.generate_target()
+        # If head has hit a target add to grow count and generate new target
+        prng_state = None
+        placed = None
+        cause = PLAYING
+        eaten = self.targets.pop(y * self.width + x, 0)
+        if eaten:
+            self.grow_count += eaten
+            self.score += eaten
+            grow += eaten
+            if history != None:
+                prng_state = self.prng.getstate()
+            count = len(self.targets)
+            if not self.generate_target():
+                self.game_over = True
+                cause = FULL
+            elif len(self.targets) > count:
+                placed = (self.target_x, self.target_y, self.target_value)
+
+        if history != None:
+            history.append(before + (p, old_xy, prng_state, eaten, placed))
+        return self.report(StepResult((x, y), old_xy, eaten, grow, cause,
+            placed=placed))
+
+    def advance(self, n: int, directions=None, until_eaten: bool = True):
+        """
+        Takes up to n steps in one go and returns an AdvanceResult with
+        everything they changed. directions, if given, holds a direction
+        code or None for each step, which is turned to before it is taken;
+        once it runs out the worm keeps going the way it faces. Stops early
+        when the game ends or, if until_eaten, once a target is eaten.
+
+        The steps follow the same rules as next_step, in a single loop
+        without a StepResult each, unless undo information is being kept
+        or there are listeners, which need next_step for every step.
+        """
+        result = AdvanceResult()
+        scheduled = len(directions) if directions != None else 0
+        if self.game_over or self.history != None or self.listeners:
+            for i in range(n):
+                if i < scheduled and directions[i] != None:
+                    self.go(directions[i])
+                step = self.next_step()
+                result.add(step)
+                if step.cause != PLAYING:
+                    result.stop = DIED
+                    break
+                if until_eaten and step.eaten:
+                    result.stop = ATE
+                    break
+            return result
+
+        worm = self.worm
+        cells = self.cells
+        targets = self.targets
+        is_occupied = cells.is_occupied
+        heads = result.heads
+        tails = result.tails
+        (width, height) = (self.width, self.height)
+        (x, y) = worm.head()
+        (dx, dy) = (self.dx, self.dy)
+        grow_count = self.grow_count
+        start_grow_count = grow_count
+        for i in range(n):
+            if i < scheduled and directions[i] != None:
+                self.go(directions[i])
+                (dx, dy) = (self.dx, self.dy)
+            self.ticks += 1
+            result.steps += 1
+            x += dx
+            y += dy
+
+            # Walls and the worm itself end the game
+            if x < 0 or x >= width or y < 0 or y >= height:
+                result.cause = WALL
+            elif is_occupied(x, y):
+                result.cause = SELF
+                if self.level != None and self.level.is_wall(x, y):
+                    result.cause = WALL
+            if result.cause != PLAYING:
+                self.game_over = True
+                result.crash = (x, y)
+                result.stop = DIED
+                break
+
+            # Move the head and the tail, unless growing
+            worm.push_head(x, y)
+            cells.occupy(x, y)
+            heads.append((x, y))
+            if grow_count == 0:
+                tail = worm.pop_tail()
+                cells.vacate(*tail)
+                tails.append(tail)
+            else:
+                grow_count -= 1
+                tails.append(None)
+
+            # Eat the target and place another
+            eaten = targets.pop(y * width + x, 0)
+            if eaten:
+                grow_count += eaten
+                self.score += eaten
+                result.eaten += eaten
+                count = len(targets)
+                if not self.generate_target():
+                    self.game_over = True
+                    result.cause = FULL
+                    result.stop = DIED
+                    break
+                if len(targets) > count:
+                    result.placed.append((self.target_x, self.target_y,
+                        self.target_value))
+                if until_eaten:
+                    result.stop = ATE
+                    break
+        self.grow_count = grow_count
+        result.grow = grow_count - start_grow_count
+        return result
+
+    def report(self, result: StepResult):
+        """Hands the result of a step to each listener and returns it"""
+        for listener in self.listeners:
+            listener(self, result)
+        return result
+
+    def add_listener(self, listener):
+        """
+        Calls listener with this WormState and the StepResult after every
+        step from now on, across new games. Steps undone by undo_step or
+        restore are not reported.
+        """
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        """Stops calling a listener given to add_listener"""
+        self.listeners.remove(listener)
+
+    def snapshot(self):
+        """
+        Returns a token that restore can later use to bring the game back to
+        this point. Taking a snapshot starts keeping undo information for
+        every step, which costs a little per step until drop_history is
+        called. Snapshots can't be restored across a reset.
+        """
+        if self.history == None:
+            self.history = []
+        return (len(self.history), self.direction)
+
+    def restore(self, snapshot):
+        """
+        Undoes every step taken since snapshot was returned by snapshot and
+        turns the worm back the way it was facing then. This works in place
+        and only costs as much as the steps being undone.
+        """
+        (depth, direction) = snapshot
+        while len(self.history) > depth:
+            self.undo_step()
+        self.go(direction)
+
+    def undo_step(self):
+        """
+        Reverses the most recent next_step, including the head and tail
+        moves, growth, score, the target and the random number generator.
+        Only steps taken since the first snapshot can be undone.
+        """
+        record = self.history.pop()
+        if record == None:
+            # That step found the game already over and changed nothing
+            return
+        (self.ticks, self.grow_count, self.score, self.target_x,
+            self.target_y, self.target_value, p, old_xy, prng_state, eaten,
+            placed) = record
+        self.game_over = False
+        if p == None:
+            # The worm crashed without moving
+            return
+        if prng_state != None:
+            self.prng.setstate(prng_state)
+        if old_xy != None:
+            self.cells.unvacate(*old_xy)
+            self.worm.push_tail(*old_xy)
+        x, y = self.worm.pop_head()
+        self.cells.unoccupy(x, y, p)
+
+        # Take away the target placed and put back the one eaten
+        if placed != None:
+            del self.targets[placed[1] * self.width + placed[0]]
+        if eaten:
+            self.targets[y * self.width + x] = eaten
+
+    def drop_history(self):
+        """
+        Stops keeping undo information. Earlier snapshots can no longer be
+        restored.
+        """
+        self.history = None
 
-        return (old_xy, None)
+    def go(self, direction: int):
+        """Set the new direction from one of the direction codes"""
+        self.direction = direction
+        self.dx, self.dy = DIRECTIONS[direction]
 
     def go_right(self):
         """Set the new direction to right"""
-        self.dx, self.dy = 1, 0
+        self.go(RIGHT)
 
     def go_left(self):
         """Set the new direction to left"""
-        self.dx, self.dy = -1, 0
+        self.go(LEFT)
 
     def go_down(self):
         """Set the new direction to down"""
-        self.dx, self.dy = 0, 1
+        self.go(DOWN)
 
     def go_up(self):
         """Set the new direction to up"""
-        self.dx, self.dy = 0, -1
\ No newline at end of file
+        self.go(UP)
\ No newline at end of file
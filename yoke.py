@@ -71,8 +71,14 @@ class Yoke(object):
     the list in two by separating a from its left neighbor and
     separating p from its left neighbor to form two smaller circular
     lists.  Magic.
+
+    Yokes have __slots__ so each costs as little memory as it can. Node
+    adds a position to a Yoke, and Sentinel heads a list of Nodes, counting
+    them and keeping the ones taken out for reuse.
     """
 
+    __slots__ = ("left", "right")
+
     def __init__(self):
         self.left = self
         self.right = self
@@ -152,3 +158,102 @@ class Yoke(object):
         self.left = self
         self.right = self
         return self
+
+    def __iter__(self):
+        """
+        Yields the other Yokes in the list going right from this one, which
+        for a sentinel is every member of the list.
+        """
+        w = self.right
+        while w != self:
+            yield w
+            w = w.right
+
+    def __reversed__(self):
+        """Yields the other Yokes in the list going left from this one"""
+        w = self.left
+        while w != self:
+            yield w
+            w = w.left
+
+class Node(Yoke):
+    """A Yoke carrying the x, y of a cell"""
+
+    __slots__ = ("x", "y")
+
+    def __init__(self, x: int = 0, y: int = 0):
+        super().__init__()
+        self.x = x
+        self.y = y
+
+class Sentinel(Yoke):
+    """
+    The end of a list of Nodes, which knows how many Nodes it has. Nodes
+    popped off either end are kept as spares and handed out again by the
+    next push, so a list that grows at one end as fast as it shrinks at the
+    other allocates nothing after its first push.
+
+    The count is only right as long as the list is changed with push_left,
+    push_right, pop_left and pop_right, which link nodes in and out by hand
+    rather than through insert_left and remove as they are called so often.
+    """
+
+    __slots__ = ("length", "spares")
+
+    def __init__(self):
+        super().__init__()
+        self.length = 0
+        self.spares = []
+
+    def __len__(self):
+        return self.length
+
+    def push_left(self, x: int, y: int):
+        """Adds a Node at x, y as the left neighbor of the sentinel"""
+        node = self.spares.pop() if self.spares else Node()
+        node.x = x
+        node.y = y
+        left = self.left
+        node.left = left
+        node.right = self
+        left.right = node
+        self.left = node
+        self.length += 1
+
+    def push_right(self, x: int, y: int):
+        """Adds a Node at x, y as the right neighbor of the sentinel"""
+        node = self.spares.pop() if self.spares else Node()
+        node.x = x
+        node.y = y
+        right = self.right
+        node.right = right
+        node.left = self
+        right.left = node
+        self.right = node
+        self.length += 1
+
+    def pop_left(self):
+        """
+        Removes the left neighbor of the sentinel and returns it. It keeps
+        its x, y until the next push, which may reuse it.
+        """
+        node = self.left
+        left = node.left
+        left.right = self
+        self.left = left
+        self.spares.append(node)
+        self.length -= 1
+        return node
+
+    def pop_right(self):
+        """
+        Removes the right neighbor of the sentinel and returns it. It keeps
+        its x, y until the next push, which may reuse it.
+        """
+        node = self.right
+        right = node.right
+        right.left = self
+        self.right = right
+        self.spares.append(node)
+        self.length -= 1
+        return node